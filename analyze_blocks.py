@@ -1,25 +1,26 @@
 import argparse
+import asyncio
+import contextlib
+import io
 import json
 import os
+import random
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator
 
-from openai import OpenAI
+import openai
+
+from split_blocks import FilingBlocks, StaleBlocksError, blocks_file, split_filing
+from watchlist import TESLA
 
 year = 2018
 model = "gpt-4o-mini"
-conn = sqlite3.connect(os.environ.get('SQLITE_PATH', f'{year}.sqlite'))
-conn.row_factory = sqlite3.Row
-conn.execute("""
-CREATE TABLE IF NOT EXISTS votes (
-    id SERIAL PRIMARY KEY,
-    filing_url TEXT,
-    block_start INTEGER,
-    block_end INTEGER,
-    block_text TEXT,
-    vote TEXT
-);
-""")
-conn.commit()
 
 prompt_prefix = """
 Instructions:
@@ -42,71 +43,446 @@ Input:
 prompt_suffix = """
 """.strip()
 
-client = OpenAI()
 
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS votes (
+        id SERIAL PRIMARY KEY,
+        filing_url TEXT,
+        block_start INTEGER,
+        block_end INTEGER,
+        block_text TEXT,
+        vote TEXT
+    );
+    """)
+    conn.commit()
+    return conn
+
+
+class TransientError(Exception):
+    """
+    Error after which the request may succeed if it is sent again: rate limit (429), server error (5xx),
+    timeout or connection error.
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class OpenAIClient:
+    """ Client of the chat completions API: the OpenAI API, or any compatible server at `base_url`. """
+
+    def __init__(self, model_name: str = model, base_url: str | None = None, api_key: str | None = None):
+        self.model = model_name
+        # Retries are made by the engine, which also adapts the concurrency
+        self.client = openai.AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+
+    async def complete(self, content: str) -> str:
+        try:
+            completion = await self.client.chat.completions.create(model=self.model, messages=[
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant."
+                },
+                {
+                    'role': 'user',
+                    'content': content,
+                },
+            ])
+        except openai.APIStatusError as e:
+            if e.status_code == 429 or e.status_code >= 500:
+                retry_after = e.response.headers.get('retry-after')
+                try:
+                    retry_after = float(retry_after) if retry_after else None
+                except ValueError:  # HTTP date
+                    retry_after = None
+                raise TransientError(f"{e.status_code} {e.message}", retry_after) from e
+            raise
+        except (openai.APITimeoutError, openai.APIConnectionError) as e:
+            raise TransientError(str(e)) from e
+        return completion.choices[0].message.content
+
+    async def close(self):
+        await self.client.close()
+
+
+class StubClient:
+    """
+    Client answering `vote` after `latency` seconds without calling a model, for tests and benchmarks.
+    The first requests fail as listed in `failures`: 'rate_limit' or 'server_error' (TransientError), or 'hang'
+    (never answers).
+    """
+
+    def __init__(self, latency: float = 0.0, vote: str = "For", failures: list[str] | None = None):
+        self.latency = latency
+        self.vote = vote
+        self.failures = list(failures or [])
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def complete(self, content: str) -> str:
+        self.calls += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            failure = self.failures.pop(0) if self.failures else None
+            if failure == 'hang':
+                await asyncio.Event().wait()
+            await asyncio.sleep(self.latency)
+            if failure == 'rate_limit':
+                raise TransientError("429 Too Many Requests", retry_after=0.01)
+            if failure == 'server_error':
+                raise TransientError("503 Service Unavailable")
+            return self.vote
+        finally:
+            self.active -= 1
+
+    async def close(self):
+        pass
+
+
+class AdaptiveLimit:
+    """
+    Bound on the number of concurrent requests, adapted to the server: halved on each transient error, and
+    increased by one after as many successes as the current bound, up to `max_limit`.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    async def succeeded(self):
+        async with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    async def failed(self):
+        async with self.condition:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            self.condition.notify_all()
+
+
+class AnalyzeEngine:
+    """
+    Sends the prompts of the blocks to the client concurrently, at most `jobs` at a time, and stores the votes
+    as they complete. Requests taking more than `timeout` seconds are cancelled; rate limits, server errors
+    and timeouts are retried with an exponential backoff (or the delay requested by the server), and reduce
+    the concurrency until requests succeed again.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, client, jobs: int = 16, timeout: float = 60,
+                 max_attempts: int = 6, backoff: float = 1.0, max_backoff: float = 60):
+        self.conn = conn
+        self.client = client
+        self.jobs = jobs
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counts = {'votes': 0, 'retries': 0, 'failed': 0}
+
+    async def complete(self, limit: AdaptiveLimit, content: str) -> str:
+        for attempt in range(self.max_attempts):
+            try:
+                async with limit:
+                    vote = await asyncio.wait_for(self.client.complete(content), self.timeout)
+                await limit.succeeded()
+                return vote
+            except (TransientError, asyncio.TimeoutError) as e:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                await limit.failed()
+                self.counts['retries'] += 1
+                delay = getattr(e, 'retry_after', None)
+                if delay is None:
+                    delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+                print(f"Retrying in {delay:.1f}s ({str(e) or 'timeout'}), {limit.limit} concurrent requests")
+                await asyncio.sleep(delay)
+
+    async def worker(self, queue: asyncio.Queue, limit: AdaptiveLimit):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                filing_url, block_start, block_end, block_text = item
+                content = prompt_prefix + "\n" + block_text + "\n" + prompt_suffix
+                try:
+                    vote = await self.complete(limit, content)
+                except Exception as e:
+                    print(f"Error analyzing {filing_url} lines {block_start}-{block_end}: {e!r}", file=sys.stderr)
+                    self.counts['failed'] += 1
+                    continue
+                # Store vote
+                self.conn.execute("""
+                    INSERT INTO votes (
+                        filing_url, block_start, block_end, block_text, vote
+                    ) VALUES (?, ?, ?, ?, ?)
+                """, (
+                    filing_url, block_start, block_end, block_text, vote
+                ))
+                self.conn.commit()
+                self.counts['votes'] += 1
+            finally:
+                queue.task_done()
+
+    async def run(self, filings: Iterable[Iterable[tuple[str, int, int, str]]]) -> dict:
+        """
+        Analyze the blocks (filing URL, block start, block end, block text) of the filings. The blocks of a filing
+        are read in a thread when the queue empties, so that reading them does not hold up the requests in flight,
+        and only a few of them are held in memory.
+
+        :returns: the number of votes stored, of retries and of blocks that could not be analyzed.
+        """
+        limit = AdaptiveLimit(self.jobs)
+        queue = asyncio.Queue(maxsize=2 * self.jobs)
+
+        async def produce():
+            for filing in filings:
+                for item in await asyncio.to_thread(list, filing):
+                    await queue.put(item)
+            for _ in range(self.jobs):
+                await queue.put(None)
 
-def analyze_blocks(row):
-    filing_url = row['url']
-    filename = row['filename']
-    filename = filename.replace('.htm', '.txt')
-    filename = filename.replace('.txt', '.json')
-    filename = os.path.join('blocks', filename)
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(self.worker(queue, limit)) for _ in range(self.jobs)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self.counts
+
+
+def read_filing_blocks(row) -> Iterator[tuple[str, int, int, str]]:
+    """ :returns: the Tesla blocks of a filing, as read by the engine. """
+    filename = row['filename'].replace('.htm', '.txt')
     print(f"{row['cik']} {row['display_name']}")
-    with open(filename, 'r', encoding="utf-8") as f:
-        filing = json.loads(f.read())
-    for block in filing['blocks']:
-        block_start = block['start']
-        block_end = block['end']
-        block_text = "\n".join(block['lines'])
-        # block_text = re.sub(' +', ' ', block_text)  # Reduce LLM input size, it will match on pipes.
-        content = prompt_prefix + "\n" + block_text + "\n" + prompt_suffix
-        # print(block_text)
-        # print(f"  prompt size: {len(content)}")
-        completion = client.chat.completions.create(model=model, messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant."
-            },
-            {
-                'role': 'user',
-                'content': content,
-            },
-        ])
-        vote = completion.choices[0].message.content
-        # Store vote
-        conn.execute("""
-            INSERT INTO votes (
-                filing_url, block_start, block_end, block_text, vote
-            ) VALUES (?, ?, ?, ?, ?)
-        """, (
-            filing_url, block_start, block_end, block_text, vote
-        ))
-        conn.commit()
+    try:
+        with FilingBlocks(filename, security=TESLA.key) as blocks:
+            for block, block_text in blocks:
+                # block_text = re.sub(' +', ' ', block_text)  # Reduce LLM input size, it will match on pipes.
+                yield row['url'], block.start, block.end, block_text
+    except FileNotFoundError:
+        print(f"Warning: no blocks for {row['url']}")
+    except StaleBlocksError as e:
+        print(f"Warning: {e}, split it again")
 
 
-if __name__ == '__main__':
+def filing_blocks(rows) -> Iterator[Iterator[tuple[str, int, int, str]]]:
+    """ :returns: the blocks of each filing, read as they are iterated. """
+    return (read_filing_blocks(row) for row in rows)
+
+
+async def analyze_blocks(conn: sqlite3.Connection, rows, client, jobs: int = 16, timeout: float = 60) -> dict:
+    engine = AnalyzeEngine(conn, client, jobs, timeout)
+    try:
+        return await engine.run(filing_blocks(rows))
+    finally:
+        await client.close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for a chat completions server answering "For".
+    `server.errors` is the list of (status, headers) to answer the first requests with, `server.requests` counts
+    the requests.
+    """
+
+    def do_POST(self):
+        json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests += 1
+            error = self.server.errors.pop(0) if self.server.errors else None
+        if error is not None:
+            status, headers = error
+            body = json.dumps({'error': {'message': self.responses[status][0], 'type': 'stub'}}).encode('utf-8')
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+        else:
+            body = json.dumps({
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': "For"}}],
+            }).encode('utf-8')
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAnalyzeBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        for directory in ['filings', 'plain', 'blocks']:
+            os.makedirs(directory)
+        self.conn = connect('votes.sqlite')
+        self.conn.execute("CREATE TABLE filings (url TEXT, filename TEXT, cik TEXT, display_name TEXT)")
+        votes = "\n".join(f"Fund {i}\n---\nTesla\nFor" for i in range(20))
+        with open(os.path.join('filings', 'a.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"<DOCUMENT>\n<TYPE>N-PX\n<TEXT>\n{votes}\n</TEXT>\n</DOCUMENT>\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            split_filing('a.txt', blocks_file('a.txt'))
+        self.conn.executemany("INSERT INTO filings VALUES (?, ?, ?, ?)",
+                              [('url-a', 'a.txt', '1', 'A'), ('url-b', 'b.txt', '2', 'B')])  # No blocks for b
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def analyze(self, client: StubClient, **kwargs) -> dict:
+        rows = self.conn.execute("SELECT * FROM filings").fetchall()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return asyncio.run(analyze_blocks(self.conn, rows, client, **kwargs))
+
+    def test_analyze_blocks(self):
+        client = StubClient(latency=0.01)
+        self.assertEqual({'votes': 20, 'retries': 0, 'failed': 0}, self.analyze(client, jobs=4))
+        self.assertEqual(4, client.max_active)
+        self.assertEqual([('url-a', 'For')] * 20,
+                         [tuple(row) for row in self.conn.execute("SELECT filing_url, vote FROM votes")])
+        self.assertEqual(20, len({row[0] for row in self.conn.execute("SELECT block_start FROM votes")}))
+        # Filings are read outside of the event loop
+        threads = []
+
+        def read_filing():
+            threads.append(threading.current_thread())
+            yield 'url-c', 0, 1, "Tesla"
+
+        engine = AnalyzeEngine(self.conn, StubClient(), jobs=2)
+        self.assertEqual({'votes': 1, 'retries': 0, 'failed': 0}, asyncio.run(engine.run([read_filing()])))
+        self.assertEqual(1, len(threads))
+        self.assertIsNot(threading.main_thread(), threads[0])
+
+    def test_retries(self):
+        client = StubClient(latency=0.01, failures=['rate_limit', 'server_error', 'hang', 'rate_limit'])
+        engine = AnalyzeEngine(self.conn, client, jobs=4, timeout=0.1, backoff=0.01)
+        rows = self.conn.execute("SELECT * FROM filings").fetchall()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual({'votes': 20, 'retries': 4, 'failed': 0}, asyncio.run(engine.run(filing_blocks(rows))))
+        self.assertEqual(24, client.calls)
+        # Too many failures
+        client = StubClient(failures=['server_error'] * 3)
+        engine = AnalyzeEngine(self.conn, client, jobs=1, max_attempts=3, backoff=0.01)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual({'votes': 19, 'retries': 2, 'failed': 1}, asyncio.run(engine.run(filing_blocks(rows))))
+
+    def test_openai_client(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        server.lock = threading.Lock()
+        server.requests = 0
+        server.errors = [(429, {'Retry-After': '0'}), (503, {})]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        async def run(items):
+            client = OpenAIClient(base_url=f"http://127.0.0.1:{server.server_port}/v1", api_key='stub')
+            try:
+                return await AnalyzeEngine(self.conn, client, jobs=2, backoff=0.01).run(items)
+            finally:
+                await client.close()
+
+        try:
+            rows = self.conn.execute("SELECT * FROM filings").fetchall()
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual({'votes': 20, 'retries': 2, 'failed': 0}, asyncio.run(run(filing_blocks(rows))))
+            self.assertEqual(22, server.requests)
+            self.assertEqual([('For',)] * 20, [tuple(row) for row in self.conn.execute("SELECT vote FROM votes")])
+            # Errors which are not transient are not retried
+            server.errors = [(400, {})]
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                counts = asyncio.run(run([[('url-a', 0, 1, "Tesla")]]))
+            self.assertEqual({'votes': 0, 'retries': 0, 'failed': 1}, counts)
+            self.assertIn('BadRequestError', stderr.getvalue())
+            self.assertEqual(23, server.requests)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_adaptive_limit(self):
+        async def check():
+            limit = AdaptiveLimit(8)
+            await limit.failed()
+            await limit.failed()
+            self.assertEqual(2, limit.limit)
+            for _ in range(2 + 3):
+                await limit.succeeded()
+            self.assertEqual(4, limit.limit)
+        asyncio.run(check())
+
+
+def main():
     parser = argparse.ArgumentParser(
-        prog='split_blocks',
-        description='Split blocks from filings')
+        prog='analyze_blocks',
+        description='Extract the votes of the blocks with an LLM')
     parser.add_argument('-c', '--clear', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=16,
+                        help='maximum number of concurrent requests')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds before a request is cancelled and retried')
+    parser.add_argument('--base-url', type=str,
+                        help='URL of an OpenAI compatible server (default: OpenAI API)')
+    parser.add_argument('--stub', type=float, metavar='LATENCY',
+                        help='answer "For" after LATENCY seconds instead of calling the model, to measure the engine')
+    parser.add_argument('-t', '--test', action='store_true')
     parser.add_argument('filings', metavar='FILING', type=str, nargs='*',
-                        help='names of the filings to split (no path, with ext)')
+                        help='names of the filings to analyze (no path, with ext)')
     args = parser.parse_args()
 
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    conn = connect(os.environ.get('SQLITE_PATH', f'{year}.sqlite'))
     if args.clear:
         # Clear votes
         conn.execute("DELETE FROM votes")
+        conn.commit()
 
     if args.filings:
-        for row in conn.execute('SELECT * FROM filings WHERE filename IN ({})'.format(
-                ','.join('?' * len(args.filings))), args.filings):
-            analyze_blocks(row)
+        rows = conn.execute('SELECT * FROM filings WHERE filename IN ({})'.format(
+            ','.join('?' * len(args.filings))), args.filings).fetchall()
     else:
-        for row in conn.execute('SELECT * FROM filings'):
-            try:
-                analyze_blocks(row)
-            except FileNotFoundError:
-                print(f"Warning: no blocks for {row['url']}")
+        rows = conn.execute('SELECT * FROM filings').fetchall()
+    client = StubClient(args.stub) if args.stub is not None else OpenAIClient(base_url=args.base_url)
+    start_time = time.perf_counter()
+    counts = asyncio.run(analyze_blocks(conn, rows, client, args.jobs, args.timeout))
+    print(f"Stored {counts['votes']} votes in {time.perf_counter() - start_time:.2f}s "
+          f"({counts['retries']} retries, {counts['failed']} failed)")
+    exit(1 if counts['failed'] else 0)
+
 
-    exit(0)
+# main
+if __name__ == '__main__':
+    main()
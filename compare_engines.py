@@ -0,0 +1,132 @@
+import argparse
+import difflib
+import io
+import os
+import sys
+import time
+
+import filing_store
+import html_engines
+import manifest
+from sgml import Submission
+from utils import filing_format
+
+
+class EngineResult:
+
+    def __init__(self, engine: str, text: str, tables: str, elapsed: float):
+        self.engine = engine
+        self.text = text
+        self.tables = tables
+        self.elapsed = elapsed
+
+
+def run_engine(engine: str, html_content: str) -> EngineResult:
+    buffer = io.StringIO()
+    tables = io.StringIO()
+    start_time = time.perf_counter()
+    html_engines.convert(html_content, buffer, tables, engine)
+    return EngineResult(engine, buffer.getvalue(), tables.getvalue(), time.perf_counter() - start_time)
+
+
+def diff_lines(expected: str, actual: str) -> list[str]:
+    """ :returns: the removed and added lines of a unified diff, without context. """
+    return [line for line in difflib.unified_diff(expected.split('\n'), actual.split('\n'), n=0, lineterm='')
+            if line[:1] in '+-' and line[:3] not in ('+++', '---')]
+
+
+def compare_filing(filename: str, engines: list[str],
+                   verbose: bool) -> tuple[str, dict[str, EngineResult]] | None:
+    """
+    Convert a filing with the reference engine and the given engines, and print how they compare.
+
+    :returns: the hash of the text compared (see manifest.text_hash) and the results of the engines whose output
+        is identical to the reference, or None if the filing is not an HTML filing or could not be converted.
+    """
+    with Submission(os.path.join('filings', filename)) as submission:
+        text_section = next((section for section in submission.sections() if section.tag == 'TEXT'), None)
+        if text_section is None:
+            return None
+        filing = submission.text(text_section).strip()
+    if filing_format(filing) != 'html':
+        return None
+
+    try:
+        reference = run_engine(html_engines.REFERENCE_ENGINE, filing)
+    except Exception as e:
+        print(f"{filename}: {html_engines.REFERENCE_ENGINE} failed: {e!r}", file=sys.stderr)
+        return None
+    report = [f"{reference.engine} {reference.elapsed:.2f}s"]
+    equivalent = {reference.engine: reference}
+    for engine in engines:
+        try:
+            result = run_engine(engine, filing)
+        except Exception as e:
+            report.append(f"{engine} failed: {e!r}")
+            continue
+        if result.text == reference.text and result.tables == reference.tables:
+            equivalent[engine] = result
+            report.append(f"{engine} {result.elapsed:.2f}s")
+        else:
+            differences = diff_lines(reference.text, result.text)
+            report.append(f"{engine} {result.elapsed:.2f}s, {len(differences)} lines differ"
+                          + ("" if result.tables == reference.tables else ", tables differ"))
+            if verbose:
+                for line in differences[:20]:
+                    print(f"    {engine} {line}")
+    print(f"{filename}: {', '.join(report)}")
+    return manifest.text_hash(filing), equivalent
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='compare_engines',
+        description='Compare the output and speed of the HTML conversion engines with the reference (lxml)')
+    parser.add_argument('-e', '--engines', nargs='+', choices=sorted(html_engines.ENGINES),
+                        default=[engine for engine in html_engines.ENGINES
+                                 if engine != html_engines.REFERENCE_ENGINE],
+                        help='engines to compare with the reference')
+    parser.add_argument('-r', '--record', action='store_true',
+                        help=f'record the fastest equivalent engine of each filing in {html_engines.ENGINES_PATH}')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the first differing lines')
+    parser.add_argument('filings', metavar='FILING', type=str, nargs='*',
+                        help='names of the filings to compare (no path, with ext)')
+    args = parser.parse_args()
+
+    filenames = args.filings or [name for name in filing_store.listdir('filings') if name.endswith('.txt')]
+    choices = html_engines.load_engine_choices()
+    totals = {engine: 0.0 for engine in [html_engines.REFERENCE_ENGINE] + args.engines}
+    counts = {engine: 0 for engine in args.engines}
+    n_html = 0
+    for filename in filenames:
+        try:
+            compared = compare_filing(filename, args.engines, args.verbose)
+        except Exception as e:
+            print(f"Error reading {filename}: {e!r}", file=sys.stderr)
+            continue
+        if compared is None:
+            continue
+        text_hash, equivalent = compared
+        n_html += 1
+        for engine, result in equivalent.items():
+            totals[engine] += result.elapsed
+            if engine in counts:
+                counts[engine] += 1
+        fastest = min(equivalent.values(), key=lambda result: result.elapsed)
+        if fastest.engine == html_engines.REFERENCE_ENGINE:
+            choices.pop(filename, None)
+        else:
+            choices[filename] = {'engine': fastest.engine, 'hash': text_hash}
+
+    print(f"\n{n_html} HTML filings, {html_engines.REFERENCE_ENGINE} {totals[html_engines.REFERENCE_ENGINE]:.2f}s")
+    for engine, count in counts.items():
+        print(f"{engine}: identical output for {count}/{n_html} filings, {totals[engine]:.2f}s on those")
+    if args.record:
+        html_engines.save_engine_choices(choices)
+        print(f"Recorded engine choices in {html_engines.ENGINES_PATH}")
+    exit(0)
+
+
+# main
+if __name__ == '__main__':
+    main()
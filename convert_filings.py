@@ -0,0 +1,123 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+from multiprocessing import Pool
+
+import filing_store
+from sgml import Submission
+from utils import filing_format, load_tables, update_text_filing
+
+
+def convert_filing(args: tuple[str, bool]) -> tuple[str, str, str | None, float]:
+    """
+    Worker entry point: convert the first <TEXT> section of an HTML filing to plain/.
+    Errors are caught so that they do not stop the other filings.
+
+    :returns: the filename, what was done ('converted', 'cached' or 'plain'), the formatted error if any,
+        and the processing time.
+    """
+    filename, force = args
+    start_time = time.perf_counter()
+    try:
+        with Submission(os.path.join('filings', filename)) as submission:
+            text_section = next((section for section in submission.sections() if section.tag == 'TEXT'), None)
+            if text_section is None:
+                return filename, 'plain', None, time.perf_counter() - start_time
+            filing = submission.text(text_section).strip()
+        if filing_format(filing) != 'html':
+            return filename, 'plain', None, time.perf_counter() - start_time
+        if not update_text_filing(filename, filing, 'html', force):
+            return filename, 'cached', None, time.perf_counter() - start_time
+        return filename, 'converted', None, time.perf_counter() - start_time
+    except Exception:
+        return filename, 'failed', traceback.format_exc(), time.perf_counter() - start_time
+
+
+def convert_filings(filenames: list[str], jobs: int, force: bool = False) -> list[str]:
+    """
+    Convert HTML filings to plain text on a pool of `jobs` processes, largest filings first so that
+    they do not end up running alone at the end.
+
+    :returns: the names of the filings that could not be converted.
+    """
+    filenames = sorted(filenames, key=lambda name: filing_store.size(os.path.join('filings', name)), reverse=True)
+    os.makedirs('plain', exist_ok=True)
+    failed = []
+    counts = {'converted': 0, 'cached': 0, 'plain': 0}
+    start_time = time.perf_counter()
+    with Pool(jobs) as pool:
+        for filename, status, error, elapsed in pool.imap_unordered(convert_filing,
+                                                                    [(filename, force) for filename in filenames]):
+            if error is not None:
+                print(f"Error converting {filename}:\n{error}", file=sys.stderr)
+                failed.append(filename)
+                continue
+            counts[status] += 1
+            if status == 'converted':
+                print(f"{filename}: converted in {elapsed:.2f}s")
+    print(f"Converted {counts['converted']} HTML filings in {time.perf_counter() - start_time:.2f}s "
+          f"({counts['cached']} up to date, {counts['plain']} plain text, {len(failed)} failed)")
+    return failed
+
+
+class TestConvertFilings(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('filings')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def write_filing(filename: str, text: str):
+        with open(os.path.join('filings', filename), 'w', encoding='utf-8') as f:
+            f.write(f"<SEC-DOCUMENT>{filename}\n<DOCUMENT>\n<TYPE>N-PX\n<TEXT>\n{text}\n</TEXT>\n</DOCUMENT>\n")
+
+    def test_convert_filings(self):
+        self.write_filing('html.txt', "<html><body><p>Tesla</p><table><tr><td>For</td></tr></table></body></html>")
+        self.write_filing('plain.txt', "TESLA INC  For")
+        self.assertEqual([], convert_filings(['plain.txt', 'html.txt'], jobs=2))
+        with filing_store.open_text(os.path.join('plain', 'html.txt')) as f:
+            self.assertEqual("Tesla\n  | --- |\n  | For |\n", f.read())
+        self.assertEqual(1, len(load_tables('html.txt')))
+        self.assertFalse(filing_store.exists(os.path.join('plain', 'plain.txt')))
+        self.assertEqual(('html.txt', 'cached'), convert_filing(('html.txt', False))[:2])
+        # Re-downloaded filing
+        self.write_filing('html.txt', "<html><body><p>Tesla Inc</p></body></html>")
+        self.assertEqual(('html.txt', 'converted'), convert_filing(('html.txt', False))[:2])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='convert_filings',
+        description='Convert HTML filings to plain text ahead of the other stages')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of filings converted in parallel')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='convert filings again even if they are up to date')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('filings', metavar='FILING', type=str, nargs='*',
+                        help='names of the filings to convert (no path, with ext)')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    filenames = args.filings or [name for name in filing_store.listdir('filings') if name.endswith('.txt')]
+    failed = convert_filings(filenames, args.jobs, args.force)
+    exit(1 if failed else 0)
+
+
+# main
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,31 @@
+import argparse
+import contextlib
+import io
+import json
 import os
 import sqlite3
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
 
+import filing_store
+
 year = 2018
 
-# Create SQLite database
-conn = sqlite3.connect(os.environ.get('SQLITE_PATH', f'{year}.sqlite'))
-conn.row_factory = sqlite3.Row
-conn.execute("""
-CREATE TABLE IF NOT EXISTS filings (
-    url TEXT PRIMARY KEY,
-    num INTEGER,
-    filename TEXT,
-    file_date TEXT,
-    cik TEXT,
-    display_name TEXT,
-    note TEXT,
-    format TEXT,
-    num_lines INTEGER
-);
-""")
-conn.commit()
-
-# Prepare directories
-os.makedirs('filings', exist_ok=True)
-os.makedirs('blocks', exist_ok=True)
-
-# Fetch search results and download filings
-session = requests.Session()
+SEARCH_URL = 'https://efts.sec.gov/LATEST/search-index'
+ARCHIVES_URL = 'https://www.sec.gov/Archives/edgar/data'
+
+# The SEC allows at most 10 requests per second.
+MAX_REQUESTS_PER_SECOND = 10
+
+# Downloads are streamed to disk in chunks of this size.
+CHUNK_SIZE = 1 << 20
+
 headers = {
     'accept': 'application/json, text/javascript, */*; q=0.01',
     'accept-language': 'fr,en-US;q=0.9,en;q=0.8',
@@ -45,94 +42,495 @@ headers = {
     'sec-fetch-site': 'same-site',
     'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
 }
-# curl 'https://efts.sec.gov/LATEST/search-index?q=Tesla&dateRange=custom&category=custom&startdt=2018-08-15&enddt=2019-01-01&forms=N-PX&page=3&from=200'
-page = 1
-cursor = 0
-num = 0
-while True:
-    print(f"Downloading page {page}")
-    resp = session.get(
-        f'https://efts.sec.gov/LATEST/search-index?q=Tesla&dateRange=custom&category=custom&startdt={year}-01-01&enddt={year + 1}-01-01&forms=N-PX&page={page}&from={cursor}',
-        headers=headers)
-    data = resp.json()
-    total_hits = data['hits']['total']['value']
-    # Write to "results-{page}.json"
-    with open(f'results-{page}.json', 'w', encoding='utf-8') as f:
-        f.write(resp.text)
-    # Elasticsearch results format:
-    # {
-    #     "hits": {
-    #         "total": {
-    #             "value": 224,
-    #             ...
-    #         },
-    #         ...,
-    #         "hits": [
-    #             {
-    #                 "_id": "0001193125-18-261549:d611177dnpx.htm",
-    #                 "_source": {
-    #                     "ciks": [
-    #                         "0000916620"
-    #                     ],
-    #                     "adsh": "0001193125-18-261549",
-    #                     ...
-    #                 }
-    #             },
-    #             ...
-    #         ]
-    #     }
-    # }
-    # -> curl 'https://www.sec.gov/Archives/edgar/data/916620/000119312518261549/0001193125-18-261549.txt'
-    for hit in data['hits']['hits']:
-        num += 1
-        display_names = ", ".join(hit['_source']['display_names'])
-        cik = hit['_source']['ciks'][0]
-        adsh = hit['_source']['adsh']
-        file_date = hit['_source']['file_date']
-        print(f"Hit: {display_names} (CIK={cik}, id={hit['_id']})")
-        id = hit['_id']
-        # 0001104659-18-053437:a18-15410_5npx.htm -> 000110465918053437/a18-15410_5npx.htm
-        url = f"https://www.sec.gov/Archives/edgar/data/{str(int(cik))}/{adsh.replace('-', '')}/{adsh}.txt"
-        filename = f"{cik}-{adsh}.txt"
-        filepath = os.path.join("filings", filename)
-        # Find the row by filename
-        cu = conn.cursor()
-        cu.execute("SELECT * FROM filings WHERE url = ?", (url,))
-        if cu.fetchone():
-            print(f"Updating {filename}")
-            conn.execute(
-                "UPDATE filings SET num = ?, filename = ?, cik = ?, display_name = ?, file_date = ? WHERE url = ?",
-                (num, filename, cik, display_names, file_date, url)
-            )
-        else:
-            conn.execute(
-                "INSERT INTO filings (url, num, filename, cik, display_name, file_date) VALUES (?, ?, ?, ?, ?, ?)",
-                (url, num, filename, cik, display_names, file_date)
-            )
-        cu.close()
-        if not os.path.exists(filepath):
-            print(f"Downloading {url} to {filepath}")
-            file_data = session.get(url, headers=headers)
-            if file_data.status_code != 200:
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all threads: tokens are added at `rate` per second, up to `capacity`.
+    Each request takes one token, waiting for it if the bucket is empty.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Downloader:
+    """
+    Download filings on a bounded pool of worker threads.
+    All requests, including search requests made by the caller's thread, go through the shared rate limiter.
+    """
+
+    def __init__(self, limiter: RateLimiter, jobs: int):
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.num_files = 0
+        self.num_bytes = 0
+
+    def session(self) -> requests.Session:
+        # requests.Session is not guaranteed to be thread-safe, use one per thread
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def get(self, url: str, extra_headers: dict | None = None, stream: bool = False) -> requests.Response:
+        self.limiter.acquire()
+        request_headers = headers if not extra_headers else {**headers, **extra_headers}
+        return self.session().get(url, headers=request_headers, stream=stream)
+
+    def submit(self, url: str, filepath: str, hit: dict, etag: str | None, last_modified: str | None):
+        return self.executor.submit(self.download, url, filepath, hit, etag, last_modified)
+
+    def download(self, url: str, filepath: str, hit: dict,
+                 etag: str | None = None, last_modified: str | None = None) -> tuple[bool, str | None, str | None]:
+        """
+        Download `url` to `filepath`, streaming it through a `.part` file renamed once complete.
+        An existing file is revalidated with the ETag/Last-Modified recorded on the previous run, if any.
+        An existing `.part` file is resumed with a range request, conditional on the validators of the response
+        it was started from (saved in `.part.meta`): if the filing changed, the server sends all of it again.
+
+        :returns: whether the file is available, and the validators to record for the next run.
+        """
+        part_path = filepath + '.part'
+        meta_path = part_path + '.meta'
+        request_headers = {}
+        offset = 0
+        if filing_store.exists(filepath):
+            if not etag and not last_modified:
+                return True, etag, last_modified
+            if etag:
+                request_headers['If-None-Match'] = etag
+            if last_modified:
+                request_headers['If-Modified-Since'] = last_modified
+        elif os.path.exists(part_path):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    part_validator = json.load(f)['validator']
+            except (FileNotFoundError, ValueError, KeyError):
+                part_validator = None
+            if part_validator:
+                offset = os.stat(part_path).st_size
+                request_headers['Range'] = f'bytes={offset}-'
+                request_headers['If-Range'] = part_validator
+            else:  # Unknown version of the filing, download it again
+                os.remove(part_path)
+
+        print(f"Downloading {url} to {filepath}" + (f" from byte {offset}" if offset else ""))
+        with self.get(url, request_headers, stream=True) as file_data:
+            if file_data.status_code == 304:
+                print(f"Unchanged {filepath}")
+                return True, etag, last_modified
+            if file_data.status_code == 206 and file_data.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                mode = 'ab'
+            elif file_data.status_code == 200:
+                mode = 'wb'
+                # Validators of this version of the filing, to resume the download if it is interrupted
+                with open(meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'validator': file_data.headers.get('ETag') or file_data.headers.get('Last-Modified')},
+                              f)
+            elif offset:
+                # Range not satisfiable, or not the requested range: download the filing again
+                print(f"Cannot resume {filepath} (status code: {file_data.status_code}), downloading it again")
+                file_data.close()
+                os.remove(part_path)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(meta_path)
+                return self.download(url, filepath, hit, etag, last_modified)
+            else:
                 print(f"Failed to download {url}, status code: {file_data.status_code}")
                 print(hit)
-                continue
-            with open(filepath, 'wb') as f:
-                f.write(file_data.content)
-        if os.stat(filepath).st_size < 400:
+                return False, etag, last_modified
+            num_bytes = 0
+            with open(part_path, mode) as f:
+                for chunk in file_data.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    num_bytes += len(chunk)
+            etag = file_data.headers.get('ETag')
+            last_modified = file_data.headers.get('Last-Modified')
+        with self.lock:
+            self.num_files += 1
+            self.num_bytes += num_bytes
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(meta_path)
+        if os.stat(part_path).st_size < 400:
             print(f"File {filepath} is too small, deleting it")
-            os.remove(filepath)
-    cursor += len(data['hits']['hits'])
-    if cursor >= total_hits:
-        break
-    page += 1
-
-# Remove all but the last filing for each CIK
-conn.execute("""
-DELETE FROM filings WHERE url NOT IN (
-    SELECT MAX(url) FROM filings GROUP BY cik
-);
-""")
-
-conn.commit()
-session.close()
+            os.remove(part_path)
+            return False, None, None
+        os.replace(part_path, filepath)
+        return True, etag, last_modified
+
+    def report(self):
+        elapsed = time.monotonic() - self.start_time
+        with self.lock:
+            num_files, num_bytes = self.num_files, self.num_bytes
+        print(f"Downloaded {num_files} filings, {num_bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+              f"({num_files / elapsed:.2f} filings/s, {num_bytes / 1e6 / elapsed:.2f} MB/s)")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for session in self.sessions:
+            session.close()
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS filings (
+        url TEXT PRIMARY KEY,
+        num INTEGER,
+        filename TEXT,
+        file_date TEXT,
+        cik TEXT,
+        display_name TEXT,
+        note TEXT,
+        format TEXT,
+        num_lines INTEGER,
+        etag TEXT,
+        last_modified TEXT
+    );
+    """)
+    # Add the validator columns to databases created before they existed
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(filings)")]
+    for column in ['etag', 'last_modified']:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE filings ADD COLUMN {column} TEXT")
+    conn.commit()
+
+
+def fetch_filings(conn: sqlite3.Connection, downloader: Downloader,
+                  search_url: str = SEARCH_URL, archives_url: str = ARCHIVES_URL):
+    """
+    Page through the search results and queue the downloads of the filings.
+    Downloads start as soon as a page is read, while the next pages are being fetched.
+    The filings table is only accessed from the calling thread.
+    """
+    # curl 'https://efts.sec.gov/LATEST/search-index?q=Tesla&dateRange=custom&category=custom&startdt=2018-08-15&enddt=2019-01-01&forms=N-PX&page=3&from=200'
+    page = 1
+    cursor = 0
+    num = 0
+    futures = []
+    while True:
+        print(f"Downloading page {page}")
+        resp = downloader.get(
+            f'{search_url}?q=Tesla&dateRange=custom&category=custom&startdt={year}-01-01&enddt={year + 1}-01-01&forms=N-PX&page={page}&from={cursor}')
+        data = resp.json()
+        total_hits = data['hits']['total']['value']
+        # Write to "results-{page}.json"
+        with open(f'results-{page}.json', 'w', encoding='utf-8') as f:
+            f.write(resp.text)
+        # Elasticsearch results format:
+        # {
+        #     "hits": {
+        #         "total": {
+        #             "value": 224,
+        #             ...
+        #         },
+        #         ...,
+        #         "hits": [
+        #             {
+        #                 "_id": "0001193125-18-261549:d611177dnpx.htm",
+        #                 "_source": {
+        #                     "ciks": [
+        #                         "0000916620"
+        #                     ],
+        #                     "adsh": "0001193125-18-261549",
+        #                     ...
+        #                 }
+        #             },
+        #             ...
+        #         ]
+        #     }
+        # }
+        # -> curl 'https://www.sec.gov/Archives/edgar/data/916620/000119312518261549/0001193125-18-261549.txt'
+        for hit in data['hits']['hits']:
+            num += 1
+            display_names = ", ".join(hit['_source']['display_names'])
+            cik = hit['_source']['ciks'][0]
+            adsh = hit['_source']['adsh']
+            file_date = hit['_source']['file_date']
+            print(f"Hit: {display_names} (CIK={cik}, id={hit['_id']})")
+            # 0001104659-18-053437:a18-15410_5npx.htm -> 000110465918053437/a18-15410_5npx.htm
+            url = f"{archives_url}/{str(int(cik))}/{adsh.replace('-', '')}/{adsh}.txt"
+            filename = f"{cik}-{adsh}.txt"
+            filepath = os.path.join("filings", filename)
+            # Find the row by filename
+            cu = conn.cursor()
+            cu.execute("SELECT etag, last_modified FROM filings WHERE url = ?", (url,))
+            row = cu.fetchone()
+            etag, last_modified = None, None
+            if row:
+                etag, last_modified = row
+                print(f"Updating {filename}")
+                conn.execute(
+                    "UPDATE filings SET num = ?, filename = ?, cik = ?, display_name = ?, file_date = ? WHERE url = ?",
+                    (num, filename, cik, display_names, file_date, url)
+                )
+            else:
+                conn.execute(
+                    "INSERT INTO filings (url, num, filename, cik, display_name, file_date) VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, num, filename, cik, display_names, file_date)
+                )
+            cu.close()
+            futures.append((url, downloader.submit(url, filepath, hit, etag, last_modified)))
+        conn.commit()
+        downloader.report()
+        cursor += len(data['hits']['hits'])
+        if cursor >= total_hits or not data['hits']['hits']:
+            break
+        page += 1
+
+    # Wait for the remaining downloads
+    num_failed = 0
+    for url, future in futures:
+        try:
+            ok, etag, last_modified = future.result()
+        except Exception as e:  # Keep going with the other filings
+            print(f"Error downloading {url}: {e!r}")
+            num_failed += 1
+            continue
+        if not ok:
+            num_failed += 1
+        conn.execute("UPDATE filings SET etag = ?, last_modified = ? WHERE url = ?", (etag, last_modified, url))
+    conn.commit()
+    downloader.report()
+    if num_failed:
+        print(f"Warning: {num_failed} filings could not be downloaded")
+
+    # Remove all but the last filing for each CIK
+    conn.execute("""
+    DELETE FROM filings WHERE url NOT IN (
+        SELECT MAX(url) FROM filings GROUP BY cik
+    );
+    """)
+    conn.commit()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the EDGAR search and archive servers.
+    `server.hits` is the list of search hits, `server.filings` maps archive paths to contents.
+    """
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path == '/search-index':
+            params = dict(p.split('=', 1) for p in query.split('&'))
+            start = int(params['from'])
+            body = json.dumps({'hits': {
+                'total': {'value': len(self.server.hits)},
+                'hits': self.server.hits[start:start + self.server.page_size],
+            }}).encode('utf-8')
+        elif path in self.server.filings:
+            body = self.server.filings[path]
+            etag = f'"{hash(body) & 0xffffffff:x}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            range_header = self.headers.get('Range')
+            if range_header and self.headers.get('If-Range', etag) == etag:
+                start = int(range_header[len('bytes='):].rstrip('-'))
+                if start >= len(body):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+                body = body[start:]
+            else:
+                self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetchFilings(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('filings')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.page_size = 2
+        self.server.hits = []
+        self.server.filings = {}
+        for i in range(5):
+            cik = f"{1000 + i:010d}"
+            adsh = f"0000000000-18-{i:06d}"
+            self.server.hits.append({'_id': f"{adsh}:npx.htm", '_source': {
+                'ciks': [cik], 'adsh': adsh, 'display_names': [f"Fund {i}"], 'file_date': '2018-08-30'}})
+            self.server.filings[f"/{1000 + i}/{adsh.replace('-', '')}/{adsh}.txt"] = f"filing {i}\n".encode() * 100
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_fetch_filings(self):
+        conn = sqlite3.connect(':memory:')
+        create_tables(conn)
+        downloader = Downloader(RateLimiter(1000, 10), 3)
+        fetch_filings(conn, downloader, f"{self.base_url}/search-index", self.base_url)
+        downloader.close()
+        self.assertEqual(5, conn.execute("SELECT COUNT(*) FROM filings").fetchone()[0])
+        self.assertEqual(5, len(os.listdir('filings')))
+        with open(os.path.join('filings', '0000001003-0000000000-18-000003.txt'), 'rb') as f:
+            self.assertEqual(b"filing 3\n" * 100, f.read())
+
+    def test_download_error(self):
+        conn = sqlite3.connect(':memory:')
+        create_tables(conn)
+        # Not a file that can be resumed or removed
+        os.makedirs(os.path.join('filings', '0000001001-0000000000-18-000001.txt.part'))
+        downloader = Downloader(RateLimiter(1000, 10), 3)
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            fetch_filings(conn, downloader, f"{self.base_url}/search-index", self.base_url)
+        downloader.close()
+        self.assertIn("IsADirectoryError", log.getvalue())
+        self.assertIn("Warning: 1 filings could not be downloaded", log.getvalue())
+        self.assertEqual(4, len([name for name in os.listdir('filings') if name.endswith('.txt')]))
+
+    def test_resume_and_revalidate(self):
+        url = f"{self.base_url}/1001/000000000018000001/0000000000-18-000001.txt"
+        filepath = os.path.join('filings', 'partial.txt')
+        content = self.server.filings['/1001/000000000018000001/0000000000-18-000001.txt']
+        with open(filepath + '.part', 'wb') as f:
+            f.write(content[:300])
+        with open(filepath + '.part.meta', 'w', encoding='utf-8') as f:
+            json.dump({'validator': f'"{hash(content) & 0xffffffff:x}"'}, f)
+        downloader = Downloader(RateLimiter(1000, 10), 1)
+        ok, etag, last_modified = downloader.download(url, filepath, {})
+        self.assertTrue(ok)
+        self.assertIsNotNone(etag)
+        self.assertFalse(os.path.exists(filepath + '.part'))
+        self.assertFalse(os.path.exists(filepath + '.part.meta'))
+        with open(filepath, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(len(content) - 300, downloader.num_bytes)
+        # Second run: the server answers 304 and nothing is transferred
+        self.assertEqual((True, etag, None), downloader.download(url, filepath, {}, etag, None))
+        self.assertEqual(1, downloader.num_files)
+        downloader.close()
+
+    def test_resume_changed(self):
+        url = f"{self.base_url}/1001/000000000018000001/0000000000-18-000001.txt"
+        content = self.server.filings['/1001/000000000018000001/0000000000-18-000001.txt']
+        downloader = Downloader(RateLimiter(1000, 10), 1)
+        for name, part, validator in [
+                ('changed.txt', b"old version " * 30, '"old"'),  # The filing changed: downloaded again
+                ('unknown.txt', content[:300], None),  # No validators saved: downloaded again
+                ('too_long.txt', content + b"garbage", f'"{hash(content) & 0xffffffff:x}"')]:  # 416
+            filepath = os.path.join('filings', name)
+            with open(filepath + '.part', 'wb') as f:
+                f.write(part)
+            if validator is not None:
+                with open(filepath + '.part.meta', 'w', encoding='utf-8') as f:
+                    json.dump({'validator': validator}, f)
+            self.assertTrue(downloader.download(url, filepath, {})[0], name)
+            with open(filepath, 'rb') as f:
+                self.assertEqual(content, f.read(), name)
+            self.assertFalse(os.path.exists(filepath + '.part.meta'), name)
+        # The validators of an interrupted download are saved before its content
+        filepath = os.path.join('filings', 'interrupted.txt')
+        original_iter_content = requests.Response.iter_content
+
+        def interrupted(response, chunk_size):
+            yield content[:300]
+            raise requests.ConnectionError("interrupted")
+
+        requests.Response.iter_content = interrupted
+        try:
+            with self.assertRaises(requests.ConnectionError):
+                downloader.download(url, filepath, {})
+        finally:
+            requests.Response.iter_content = original_iter_content
+        with open(filepath + '.part.meta', 'r', encoding='utf-8') as f:
+            self.assertEqual(f'"{hash(content) & 0xffffffff:x}"', json.load(f)['validator'])
+        self.assertTrue(downloader.download(url, filepath, {})[0])
+        # Three downloads from the start, and the end of the interrupted one
+        self.assertEqual(len(content) * 3 + len(content) - 300, downloader.num_bytes)
+        downloader.close()
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='fetch_filings',
+        description='Fetch N-PX filings from EDGAR')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='number of concurrent downloads')
+    parser.add_argument('-r', '--rate', type=float, default=MAX_REQUESTS_PER_SECOND,
+                        help='maximum number of requests per second')
+    parser.add_argument('-t', '--test', action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    # Create SQLite database
+    conn = sqlite3.connect(os.environ.get('SQLITE_PATH', f'{year}.sqlite'))
+    conn.row_factory = sqlite3.Row
+    create_tables(conn)
+
+    # Prepare directories
+    os.makedirs('filings', exist_ok=True)
+    os.makedirs('blocks', exist_ok=True)
+
+    # Fetch search results and download filings
+    downloader = Downloader(RateLimiter(args.rate), args.jobs)
+    try:
+        fetch_filings(conn, downloader)
+    finally:
+        downloader.close()
+    exit(0)
+
+
+# main
+if __name__ == '__main__':
+    main()
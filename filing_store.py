@@ -0,0 +1,324 @@
+import argparse
+import bisect
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zlib
+from typing import BinaryIO, Iterator, TextIO
+
+# Compressed, content-addressed storage for filings/ and plain/.
+#
+# Layout:
+#   store/objects/ab/ab12...ef.gz   the content, as a series of gzip members of FRAME_SIZE uncompressed bytes
+#   store/objects/ab/ab12...ef.idx  JSON frame index: [[uncompressed_offset, compressed_offset], ...]
+#   store/refs/filings/x.txt        SHA-256 of the content stored for filings/x.txt
+#
+# The concatenated members form a regular .gz file (zcat works), and the frame index allows seeking
+# without decompressing from the start.
+#
+# Readers always look for the uncompressed file first, then in the store. Writers use the store if the
+# store directory exists (e.g. after running `python3 filing_store.py compact filings plain`).
+STORE_PATH = os.environ.get('FILING_STORE_PATH', 'store')
+
+FRAME_SIZE = 1 << 20
+
+# Files left out of compact(): downloads in progress and their validators, and indexes derived from the files
+NOT_COMPACTED = ('.part', '.part.meta', '.lines.idx', '.tables.jsonl')
+
+
+def enabled() -> bool:
+    return os.path.isdir(STORE_PATH)
+
+
+def _ref_path(path: str) -> str:
+    # Refs mirror the paths relative to the working directory, e.g. store/refs/plain/x.txt
+    return os.path.join(STORE_PATH, 'refs', os.path.relpath(path))
+
+
+def _object_path(digest: str) -> str:
+    return os.path.join(STORE_PATH, 'objects', digest[:2], digest)
+
+
+def _lookup(path: str) -> str | None:
+    try:
+        with open(_ref_path(path), 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def exists(path: str) -> bool:
+    return os.path.exists(path) or _lookup(path) is not None
+
+
+def digest(path: str) -> str | None:
+    """ SHA-256 of the content of a file in the store, None if the file is not in the store. """
+    if os.path.exists(path):
+        return None
+    return _lookup(path)
+
+
+def listdir(directory: str) -> list[str]:
+    """ Names of the files in `directory`, whether uncompressed or in the store. """
+    names = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+    refs_dir = _ref_path(directory)
+    if os.path.isdir(refs_dir):
+        names.update(name for name in os.listdir(refs_dir) if not name.startswith('.tmp-'))
+    return sorted(names)
+
+
+def size(path: str) -> int:
+    """ Uncompressed size of the file. """
+    if os.path.exists(path):
+        return os.stat(path).st_size
+    digest = _lookup(path)
+    if digest is None:
+        raise FileNotFoundError(path)
+    with open(_object_path(digest) + '.idx', 'r', encoding='utf-8') as f:
+        return json.load(f)['size']
+
+
+def put_file(path: str, source_path: str, frame_size: int = FRAME_SIZE) -> str:
+    """
+    Store the content of `source_path` under the name `path`.
+
+    :returns: the SHA-256 of the content.
+    """
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as f:
+        while chunk := f.read(frame_size):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+
+    object_path = _object_path(digest)
+    if not os.path.exists(object_path + '.idx'):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        frames = []
+        uncompressed_offset = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as compressed, open(source_path, 'rb') as f:
+            while chunk := f.read(frame_size):
+                frames.append([uncompressed_offset, compressed.tell()])
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip member
+                compressed.write(compressor.compress(chunk))
+                compressed.write(compressor.flush())
+                uncompressed_offset += len(chunk)
+            frames.append([uncompressed_offset, compressed.tell()])
+        os.replace(tmp_path, object_path + '.gz')
+        # Write the index last, it marks the object as complete
+        _write_atomic(object_path + '.idx', json.dumps({'size': uncompressed_offset, 'frames': frames}).encode())
+
+    _write_atomic(_ref_path(path), digest.encode())
+    return digest
+
+
+def remove(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(_ref_path(path))
+
+
+class FrameReader(io.RawIOBase):
+    """
+    Seekable reader over a stored object, decompressing only the frames that are read.
+    """
+
+    def __init__(self, digest: str):
+        super().__init__()
+        object_path = _object_path(digest)
+        with open(object_path + '.idx', 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.size = index['size']
+        self.frames = index['frames']
+        self.frame_starts = [frame[0] for frame in self.frames]
+        self.file = open(object_path + '.gz', 'rb')
+        self.pos = 0
+        self.frame_index = -1
+        self.frame_data = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def _load_frame(self, frame_index: int):
+        if frame_index != self.frame_index:
+            compressed_start = self.frames[frame_index][1]
+            compressed_end = self.frames[frame_index + 1][1]
+            self.file.seek(compressed_start)
+            self.frame_data = zlib.decompress(self.file.read(compressed_end - compressed_start), 31)
+            self.frame_index = frame_index
+
+    def readinto(self, buffer) -> int:
+        if self.pos >= self.size:
+            return 0
+        frame_index = bisect.bisect_right(self.frame_starts, self.pos) - 1
+        self._load_frame(frame_index)
+        start = self.pos - self.frame_starts[frame_index]
+        data = self.frame_data[start:start + len(buffer)]
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_binary(path: str) -> BinaryIO:
+    if os.path.exists(path):
+        return open(path, 'rb')
+    digest = _lookup(path)
+    if digest is None:
+        raise FileNotFoundError(path)
+    return io.BufferedReader(FrameReader(digest), buffer_size=FRAME_SIZE)
+
+
+def open_text(path: str) -> TextIO:
+    # Same decoding and newline translation as open(path, 'r', encoding='utf-8')
+    return io.TextIOWrapper(open_binary(path), encoding='utf-8')
+
+
+@contextlib.contextmanager
+def open_write(path: str) -> Iterator[TextIO]:
+    """
+    Write a text file atomically: readers never see a partially written file.
+    The file goes to the store if it is enabled, otherwise it is written uncompressed.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yield f
+        if enabled():
+            put_file(path, tmp_path)
+            os.remove(tmp_path)
+            if os.path.exists(path):  # Stale uncompressed version would shadow the stored one
+                os.remove(path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def compact(directory: str):
+    """ Move the uncompressed files in `directory` into the store. """
+    os.makedirs(STORE_PATH, exist_ok=True)
+    before = after = 0
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or name.startswith('.tmp-') or name.endswith(NOT_COMPACTED):
+            continue
+        digest = put_file(path, path)
+        before += os.stat(path).st_size
+        after += os.stat(_object_path(digest) + '.gz').st_size
+        os.remove(path)
+        print(f"Stored {path} as {digest}")
+    if before:
+        print(f"{directory}: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+
+
+class TestFilingStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs(STORE_PATH)
+        os.makedirs('plain')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        path = os.path.join('plain', 'a.txt')
+        content = ''.join(f"line {i} café\n" for i in range(5000))
+        source_path = 'source.txt'
+        with open(source_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        put_file(path, source_path, frame_size=1000)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(exists(path))
+        self.assertEqual(['a.txt'], listdir('plain'))
+        self.assertEqual(len(content.encode('utf-8')), size(path))
+        with open_text(path) as f:
+            self.assertEqual(content, f.read())
+        # Seek into the middle of a frame
+        with open_binary(path) as f:
+            f.seek(12345)
+            self.assertEqual(content.encode('utf-8')[12345:14000], f.read(14000 - 12345))
+
+    def test_open_write(self):
+        path = os.path.join('plain', 'b.txt')
+        with open_write(path) as f:
+            f.write("hello\nworld\n")
+        self.assertFalse(os.path.exists(path))
+        with open_text(path) as f:
+            self.assertEqual("hello\nworld\n", f.read())
+        self.assertEqual(['b.txt'], listdir('plain'))
+
+    def test_compact(self):
+        names = ['a.txt', 'a.txt.part', 'a.txt.part.meta', 'a.lines.idx', 'a.tables.jsonl', '.tmp-a']
+        for name in names:
+            with open(os.path.join('plain', name), 'w', encoding='utf-8') as f:
+                f.write(name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            compact('plain')
+        self.assertEqual(sorted(names[1:]), sorted(os.listdir('plain')))
+        with open_text(os.path.join('plain', 'a.txt')) as f:
+            self.assertEqual('a.txt', f.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='filing_store',
+        description='Compressed storage for filings and their plain text conversion')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('command', nargs='?', choices=['compact'])
+    parser.add_argument('directories', metavar='DIR', type=str, nargs='*',
+                        help='directories to move into the store (e.g. filings plain)')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    if args.command == 'compact':
+        for directory in args.directories:
+            compact(directory)
+    exit(0)
+
+
+# main
+if __name__ == '__main__':
+    main()
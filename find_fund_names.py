@@ -7,10 +7,18 @@ import time
 import unittest
 from multiprocessing import Pool
 
+import filing_store
+import manifest
+from html_to_plain import VERSION as HTML_TO_PLAIN_VERSION
+from sgml import Submission
 from utils import ensure_text_filing, longest_common_substring, levenshtein_distance
 
 year = 2018
 
+# Version of the fund matching, bump it when it changes so that filings are processed again
+VERSION = 1
+STAGE_VERSION = f"find_fund_names {VERSION}, html_to_plain {HTML_TO_PLAIN_VERSION}"
+
 def likely_security(text):
     return re.search(r'\b(INC|INCORPORATED|CORP|CORPORATION|CO|COMPANY|LIMITED|LTD|LLC|PLC)\.?$', text) is not None
 
@@ -606,14 +614,17 @@ def process_range(series, lines, start, end, verbose):
 def process_filing(conn, cik, filename, verbose=False):
     if verbose:
         print(f"\n\n\n---------- {filename} ----------\n")
-    with open(filename, 'r', encoding="utf-8") as f:
-        filing = f.read()
-
-    # Split at the "<TEXT>" line
-    parts = filing.split('<TEXT>\n')
-    preamble = parts[0]
-    filing = parts[1].split('</TEXT>\n')[0]
-    if verbose and len(parts) > 2:
+    # Extract the header and the first <TEXT> section
+    with Submission(filename) as submission:
+        preamble = ""
+        text_sections = []
+        for section in submission.sections():
+            if section.tag == 'SEC-HEADER':
+                preamble = submission.text(section)
+            elif section.tag == 'TEXT':
+                text_sections.append(section)
+        filing = submission.text(text_sections[0])
+    if verbose and len(text_sections) > 1:
         print("W Multiple <TEXT> sections")
 
     # Extract series from preamble
@@ -776,17 +787,30 @@ def process_filing(conn, cik, filename, verbose=False):
     conn.execute("COMMIT")
 
 
+def process_filing_recorded(conn, cik, filename, verbose=False):
+    """ Process a filing and record it in the manifest. """
+    input_hash = manifest.file_hash(filename)
+    process_filing(conn, cik, filename, verbose)
+    manifest.record('funds', os.path.basename(filename), input_hash, STAGE_VERSION, [])
+
+
 def process_filings(conn, filings, verbose=False):
     for filename in filings:
         cik = os.path.basename(filename).split('-')[0]
-        process_filing(conn, cik, filename, verbose)
+        process_filing_recorded(conn, cik, filename, verbose)
 
 
 def process_all_filings(conn, verbose=False):
-    for filename in os.listdir('filings'):
+    """ Process the filings whose funds are not up to date with the filing and the matching code. """
+    for filename in filing_store.listdir('filings'):
         if filename.endswith('.txt'):
             cik = filename.split('-')[0]
-            process_filing(conn, cik, os.path.join('filings', filename), verbose)
+            path = os.path.join('filings', filename)
+            if manifest.is_fresh('funds', filename, manifest.file_hash(path), STAGE_VERSION, []):
+                if verbose:
+                    print(f"Skipping {filename}")
+                continue
+            process_filing_recorded(conn, cik, path, verbose)
 
 
 def main():
@@ -825,6 +849,7 @@ def main():
     """)
     if args.clear:
         conn.execute("DELETE FROM funds")
+        manifest.forget('funds')
     conn.commit()
 
     if args.filings:
@@ -1,12 +1,13 @@
 import os
 import sqlite3
 
-from flask import Flask, render_template, make_response, redirect, url_for
+from flask import Flask, abort, render_template, make_response, redirect, url_for
 from flask import request
 from unpoly.up import Unpoly
 
 import find_fund_names
 from flask_adapter import FlaskAdapter
+from line_index import PlainLines
 from utils import align_texts
 
 DATABASE = '2018.sqlite'  # Path to your SQLite database file
@@ -92,6 +93,23 @@ def process_filing(cik):
     return redirect(url_for('filing_funds', cik=cik, processed=True))
 
 
+@app.route('/filings/<string:cik>/funds/<int:fund_id>/lines')
+def fund_lines(cik, fund_id):
+    # Lines of the plain text filing around the first line of a fund, read through the line index
+    context_lines = request.args.get('context', 10, type=int)
+    conn = get_db_connection()
+    filing = conn.execute('SELECT * FROM filings WHERE cik = ?', (cik,)).fetchone()
+    fund = conn.execute('SELECT * FROM funds WHERE id = ? AND cik = ?', (fund_id, cik)).fetchone()
+    conn.close()
+    if filing is None or fund is None or fund['first_line'] is None:
+        abort(404)
+    with PlainLines(os.path.join('plain', filing['filename'])) as lines:
+        first = max(0, fund['first_line'] - context_lines)
+        last = min(len(lines), fund['first_line'] + context_lines + 1)
+        numbered_lines = list(enumerate(lines[first:last], first))
+    return render_template('partials/lines.html', fund=fund, lines=numbered_lines)
+
+
 @app.route('/filings')
 def filings_list():
     conn = get_db_connection()
@@ -0,0 +1,284 @@
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from typing import Callable, TextIO
+
+from html_to_plain import (BLOCK_TAGS, HEADING_TAGS, Document, Table, Text, extract_pre_blocks, html_to_plain,
+                           html_to_plain_streaming, synthetic_filing)
+
+try:
+    from selectolax.lexbor import LexborHTMLParser, LexborNode
+except ImportError:  # selectolax is optional
+    LexborHTMLParser = LexborNode = None
+
+# HTML to plain text converters.
+#
+# 'lxml' is the reference converter (html_to_plain). Other engines render the same Document but may see a
+# different tree: lexbor is an HTML5 parser, libxml2 is not. compare_engines.py diffs their output against
+# the reference across the filings, and records in ENGINES_PATH the fastest engine whose output is identical
+# for each filing, with the hash of the text it was compared on; other filings, and filings whose text changed
+# since, are converted with the reference.
+ENGINES_PATH = os.environ.get('HTML_ENGINES_PATH', 'html_engines.json')
+
+REFERENCE_ENGINE = 'lxml'
+
+
+def _text_runs(node: LexborNode) -> list[tuple[str | None, LexborNode | None]]:
+    """
+    Children of a node as (text, None) for runs of adjacent text nodes, and (None, child) for other nodes:
+    the run after a child is what lxml calls its tail.
+    """
+    items = []
+    text_parts = []
+    child = node.child
+    while child is not None:
+        if child.is_text_node:
+            text_parts.append(child.text_content)
+        else:
+            if text_parts:
+                items.append((''.join(text_parts), None))
+                text_parts = []
+            items.append((None, child))
+        child = child.next
+    if text_parts:
+        items.append((''.join(text_parts), None))
+    return items
+
+
+def _leading_text(node: LexborNode) -> str | None:
+    """ Equivalent of lxml's element.text. """
+    items = _text_runs(node)
+    return items[0][0] if items else None
+
+
+def _tail(node: LexborNode) -> str | None:
+    """ Equivalent of lxml's element.tail. """
+    text_parts = []
+    sibling = node.next
+    while sibling is not None and sibling.is_text_node:
+        text_parts.append(sibling.text_content)
+        sibling = sibling.next
+    return ''.join(text_parts) if text_parts else None
+
+
+def _is_comment(node: LexborNode) -> bool:
+    # Processing instructions are parsed as (untagged) bogus comments
+    return node.is_comment_node or node.tag is None
+
+
+class LexborText(Text):
+    """ Text extraction from a lexbor node, same output as Text on the equivalent lxml element. """
+
+    def traverse(self, node: LexborNode):
+        self.traverse_content(node)
+        if node.tag in ('div', 'p', 'br'):
+            self.add_newline = True
+            self.add_space = False
+        tail = _tail(node)
+        if tail:
+            self.add_text(tail)
+
+    def traverse_content(self, node: LexborNode):
+        for text, child in _text_runs(node):
+            if text is not None:
+                if text:
+                    self.add_text(text)
+            elif _is_comment(child):
+                if child.comment_content:
+                    self.add_text(child.comment_content)
+            else:
+                self.traverse_content(child)
+                if child.tag in ('div', 'p', 'br'):
+                    self.add_newline = True
+                    self.add_space = False
+
+
+class LexborTable(Table):
+
+    def extract(self):
+        for child in self.table.iter():
+            self.traverse(child)
+
+    def traverse(self, node: LexborNode):
+        if node.tag == 'tr':
+            self.traverse_row(node)
+        elif node.tag in ['th', 'td']:
+            self.traverse_cell(node)
+            self.flush()
+        else:
+            for child in node.iter():
+                self.traverse(child)
+
+    def traverse_row(self, row: LexborNode):
+        for cell in row.iter():
+            if cell.tag in ['th', 'td']:
+                self.traverse_cell(cell)
+        self.flush()
+
+    def traverse_cell(self, cell: LexborNode):
+        self.add_cell(int(cell.attributes.get('colspan', 1)), str(LexborText(cell)))
+
+
+class LexborDocument(Document):
+    """
+    Document rendered from a lexbor tree. Text nodes are children of their parent in lexbor, so the
+    children are traversed in sequence: the text run following a child plays the role of its tail.
+    """
+
+    table_class = LexborTable
+    text_class = LexborText
+
+    def render(self):
+        self.traverse(self.root, 0)
+        self.add_newline = True  # <html> is a block
+        self.add_space = False
+
+    def write_pre(self, node: LexborNode):
+        text = _leading_text(node)
+        if text:
+            # Look up the pre block by index
+            self.emit(self.pre_blocks[int(text)])
+        self.add_newline = True
+        self.add_space = False
+
+    def traverse(self, node: LexborNode, depth: int):
+        skip_tail = False
+        for text, child in _text_runs(node):
+            if text is not None:
+                if text and not skip_tail:
+                    self.add_text(text)
+                skip_tail = False
+                continue
+            skip_tail = False
+            if _is_comment(child):
+                skip_tail = True
+            elif child.tag == 'table':
+                self.write_table(child)
+                skip_tail = True  # Junk inside the table
+            elif child.tag == 'pre':
+                self.write_pre(child)
+            else:
+                if child.tag in HEADING_TAGS:
+                    self.write_heading(child)
+                else:
+                    self.traverse(child, depth + 1)
+                if child.tag in BLOCK_TAGS:
+                    self.add_newline = True
+                    self.add_space = False
+
+
+def html_to_plain_lexbor(html_content: str, buffer: TextIO, tables: TextIO | None = None):
+    if LexborHTMLParser is None:
+        raise RuntimeError("The lexbor engine requires selectolax (pip install selectolax)")
+    html_content, pre_blocks = extract_pre_blocks(html_content)
+    LexborDocument(LexborHTMLParser(html_content).root, pre_blocks, buffer, tables).render()
+
+
+def html_to_plain_streaming_engine(html_content: str, buffer: TextIO, tables: TextIO | None = None):
+    html_to_plain_streaming(io.StringIO(html_content), buffer, tables)
+
+
+ENGINES: dict[str, Callable[[str, TextIO, TextIO | None], None]] = {
+    'lxml': html_to_plain,
+    'streaming': html_to_plain_streaming_engine,
+    'lexbor': html_to_plain_lexbor,
+}
+
+
+def load_engine_choices() -> dict[str, dict]:
+    """ Engine recorded for each filing by compare_engines.py, with the hash of its text (see manifest.text_hash). """
+    try:
+        with open(ENGINES_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_engine_choices(choices: dict[str, dict]):
+    tmp_path = ENGINES_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(choices, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, ENGINES_PATH)
+
+
+def engine_for(filename: str, text_hash: str) -> str:
+    """ :returns: the engine recorded for the filing, if its output was compared on the same text. """
+    choice = load_engine_choices().get(os.path.basename(filename))
+    if not isinstance(choice, dict) or choice.get('hash') != text_hash:
+        return REFERENCE_ENGINE
+    engine = choice['engine']
+    if engine not in ENGINES or engine == 'lexbor' and LexborHTMLParser is None:
+        return REFERENCE_ENGINE
+    return engine
+
+
+def convert(html_content: str, buffer: TextIO, tables: TextIO | None = None, engine: str = REFERENCE_ENGINE):
+    ENGINES[engine](html_content, buffer, tables)
+
+
+class TestHtmlEngines(unittest.TestCase):
+
+    HTML = ("<html><head><title>Proxy</title></head><body>Votes <b>cast</b> by<!-- x --> junk\n"
+            "<div>Fund<p>A&amp;amp;B  Fund</p>Series<br>1</div><h2>Tesla <i>Inc</i></h2>after heading\n"
+            "<table><tr><th>Issuer</th><th colspan=2>Vote</th></tr><tr><td>Tesla<br>Inc</td><td>For</td>"
+            "<td>Against</td></tr></table>junk<PRE>raw &amp; <b>x</b>\n</PRE>after pre<span> s </span> "
+            "<span>t</span><h1>end</h1></body></html>")
+
+    def check_engine(self, engine: str, html_content: str):
+        expected, expected_tables = io.StringIO(), io.StringIO()
+        html_to_plain(html_content, expected, expected_tables)
+        buffer, tables = io.StringIO(), io.StringIO()
+        convert(html_content, buffer, tables, engine)
+        self.assertEqual(expected.getvalue(), buffer.getvalue())
+        self.assertEqual(expected_tables.getvalue(), tables.getvalue())
+
+    def test_streaming(self):
+        self.check_engine('streaming', self.HTML)
+
+    def test_engine_for(self):
+        global ENGINES_PATH
+        path = ENGINES_PATH
+        with tempfile.TemporaryDirectory() as tmp:
+            ENGINES_PATH = os.path.join(tmp, 'html_engines.json')
+            try:
+                self.assertEqual(REFERENCE_ENGINE, engine_for('a.txt', 'hash-a'))
+                save_engine_choices({'a.txt': {'engine': 'streaming', 'hash': 'hash-a'}, 'b.txt': 'streaming'})
+                self.assertEqual('streaming', engine_for('filings/a.txt', 'hash-a'))
+                # Downloaded again since the engines were compared
+                self.assertEqual(REFERENCE_ENGINE, engine_for('a.txt', 'hash-a2'))
+                # Previous format, without hash
+                self.assertEqual(REFERENCE_ENGINE, engine_for('b.txt', 'hash-b'))
+            finally:
+                ENGINES_PATH = path
+
+    @unittest.skipIf(LexborHTMLParser is None, "selectolax is not installed")
+    def test_lexbor(self):
+        self.check_engine('lexbor', self.HTML)
+        self.check_engine('lexbor', synthetic_filing(20000))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='html_engines',
+        description='Convert HTML to plain text with one of the engines')
+    parser.add_argument('-e', '--engine', choices=sorted(ENGINES), default=REFERENCE_ENGINE)
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('input', nargs='?', default='input.html')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        convert(f.read(), sys.stdout, engine=args.engine)
+
+
+# main
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,40 @@
+import argparse
 import io
+import json
+import random
 import re
 import sys
+import time
+import unittest
 from typing import TextIO
 
 # lxml has a 10MB limit on text content; 0000814679-0000067590-18-001417 has 44MB of text
-from lxml import html
+from lxml import etree, html
+
+
+# Runs of spaces, including &nbsp; entities, collapse to one space; a few entities are decoded
+NORMALIZE_RE = re.compile(r'(?: |&nbsp;)+|&reg;|&amp;', re.IGNORECASE)
+ENTITY_REPLACEMENTS = {'&reg;': '(R)', '&amp;': '&'}
+
+
+def _normalize_replacement(match: re.Match) -> str:
+    return ENTITY_REPLACEMENTS.get(match.group().lower(), ' ')
+
+
+def normalize_text(text: str) -> str:
+    """ Replace newlines and &nbsp; with spaces, collapse spaces, and decode &reg; and &amp;. """
+    # Two str.replace are several times faster than str.translate
+    text = text.replace('\n', ' ').replace('\u00a0', ' ')
+    if '&' not in text and '  ' not in text:  # Already clean
+        return text
+    return NORMALIZE_RE.sub(_normalize_replacement, text)
+
+
+# Version of the plain text output, bump it when the output changes so that filings are converted again
+VERSION = 2
+
+BLOCK_TAGS = ['html', 'body', 'div', 'p', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+HEADING_TAGS = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']
 
 
 class ExtractorBase:
@@ -14,15 +44,10 @@ class ExtractorBase:
         self.add_newline = False
 
     def add_text(self, text: str):
-        text = text.replace('\n', ' ')
-        text_s = text.strip()
-        if not text_s:
+        if not text or text.isspace():
             self.add_space = True
             return
-        text = re.sub(r'&nbsp;', ' ', text, flags=re.IGNORECASE)
-        text = re.sub(r'&reg;', '(R)', text, flags=re.IGNORECASE)
-        text = re.sub(r'&amp;', '&', text, flags=re.IGNORECASE)
-        text = re.sub('[ \u00a0]+', ' ', text)
+        text = normalize_text(text)
         if self.add_newline and text:
             text = '\n' + text
             self.add_space = False
@@ -69,9 +94,10 @@ class Table:
 
     def __init__(self, table):
         self.table = table
-        self.table_data: list[list[tuple[int, str]]] = []
+        # Rows of (colspan, cell lines)
+        self.table_data: list[list[tuple[int, tuple[str, ...]]]] = []
         self.col_widths: list[int] = []
-        self.row_data: list[tuple[int, str]] = []
+        self.row_data: list[tuple[int, tuple[str, ...]]] = []
         self.col_index: int = 0
         self.extract()
         self.row_prefix = '  | '
@@ -80,57 +106,74 @@ class Table:
         # TODO: 0001120543-0000930413-18-002307 has headers only in the first table
         # 0000831114-0001398344-18-012865.json
 
-    def write(self, buffer: TextIO):
-
-        # Detect 0-width columns
-        zwc = [i for i, width in enumerate(self.col_widths) if width == 0]
-        col_widths = [width for width in self.col_widths if width != 0]
+    def write(self, buffer: TextIO, cells: list[list[str]] | None = None) -> list[int]:
+        """
+        Write the table as fixed-width text.
+        If `cells` is given, the cell values of each line after the column widths line are appended to it,
+        one value per non-zero-width column: a cell spanning several columns is the value of its first one.
+
+        :returns: the number of lines of each row.
+        """
+        col_widths = self.col_widths
+        sep_width = len(self.col_sep)
+
+        # Column model: zero-width columns are skipped, and prefix sums over the other columns give
+        # the width of any span of columns in constant time
+        zero_width = [width == 0 for width in col_widths]
+        nz_pads = [' ' * width for width in col_widths if width != 0]
+        nz_width_before = [0]  # Total width of the non-zero-width columns before column i
+        nz_count_before = [0]  # Number of non-zero-width columns before column i
+        for width in col_widths:
+            nz_width_before.append(nz_width_before[-1] + width)
+            nz_count_before.append(nz_count_before[-1] + (width != 0))
+        n_cols = len(col_widths)
+        n_nz_cols = nz_count_before[-1]
 
         # Table start row indicating column widths
-        table_cols = []
-        for i, width in enumerate(col_widths):
-            table_cols.append('-' * width)
+        table_cols = ['-' * width for width in col_widths if width != 0]
         table_start_row = f"{self.row_prefix}{self.col_sep.join(table_cols)}{self.row_suffix}\n"
         buffer.write("\n" + table_start_row)
 
         # Table data rows
+        row_lines = []
         for row in self.table_data:
             formatted_rows = [[]]
             formatted_end = [0]
+            row_cells = [[''] * n_nz_cols] if cells is not None else None
             i = 0
-            for colspan, cell in row:
-                if i in zwc:  # Skip zero-width column
+            for colspan, cell_lines in row:
+                if zero_width[i]:  # Skip zero-width column
                     i += 1
                     continue
-                # Calculate width of cell, taking into account colspan and skipping zero-width columns
-                nz_col_widths = [width for width in self.col_widths[i:i + colspan] if width != 0]
-                width = sum(nz_col_widths) + len(self.col_sep) * (len(nz_col_widths) - 1)
-                # Split cell text into lines, and fill formatted rows
-                cell_lines = cell.split('\n')
+                # Width of the cell, spanning non-zero-width columns
+                end = min(i + colspan, n_cols)
+                width = (nz_width_before[end] - nz_width_before[i] +
+                         sep_width * (nz_count_before[end] - nz_count_before[i] - 1))
+                # Fill formatted rows with the cell lines
                 for line_index, line in enumerate(cell_lines):
                     if line_index >= len(formatted_rows):
                         # Add a new formatted row
                         formatted_rows.append([])
                         formatted_end.append(0)
+                        if row_cells is not None:
+                            row_cells.append([''] * n_nz_cols)
                     formatted_row = formatted_rows[line_index]
                     # Fill in empty cells up to the current column
-                    j = formatted_end[line_index]
-                    while j < i:
-                        if j not in zwc:
-                            formatted_row.append(' ' * self.col_widths[j])
-                        j += 1
-                    formatted_row.append(f"{line.ljust(width)}")
+                    formatted_row.extend(nz_pads[nz_count_before[formatted_end[line_index]]:nz_count_before[i]])
+                    formatted_row.append(line.ljust(width))
+                    if row_cells is not None:
+                        row_cells[line_index][nz_count_before[i]] = line.strip()
                     formatted_end[line_index] = i + colspan
                 i += colspan
             for row_num, formatted_cells in enumerate(formatted_rows):
                 # Complete row with empty cells, if necessary
-                j = formatted_end[row_num]
-                while j < len(self.col_widths):
-                    if j not in zwc:
-                        formatted_cells.append(' ' * self.col_widths[j])
-                    j += 1
+                formatted_cells.extend(nz_pads[nz_count_before[min(formatted_end[row_num], n_cols)]:])
                 formatted_row = self.col_sep.join(formatted_cells)
                 buffer.write(f"{self.row_prefix}{formatted_row}{self.row_suffix}\n")
+            if row_cells is not None:
+                cells.extend(row_cells)
+            row_lines.append(len(formatted_rows))
+        return row_lines
 
     def extract(self):
         for element in self.table.iterchildren():
@@ -153,19 +196,24 @@ class Table:
         self.flush()
 
     def traverse_cell(self, cell: html.HtmlElement):
-        colspan = int(cell.get("colspan", 1))
+        self.add_cell(int(cell.get("colspan", 1)), str(Text(cell)))
+
+    def add_cell(self, colspan: int, cell_text: str):
         start_col = self.col_index
-        for _ in range(colspan):
-            if self.col_index >= len(self.col_widths):
-                self.col_widths.append(0)
-            self.col_index += 1
-        cell_text = str(Text(cell))
-        max_line_length = max(len(line) for line in cell_text.split("\n"))
+        col_widths = self.col_widths
+        if colspan > 0:
+            self.col_index += colspan
+            if self.col_index > len(col_widths):
+                col_widths.extend([0] * (self.col_index - len(col_widths)))
+        cell_lines = tuple(cell_text.split("\n"))
+        max_line_length = max(map(len, cell_lines))
         # Spread width of cell over the columns it spans
         length_per_col = (max_line_length + colspan - 1) // colspan
-        for i in range(start_col, self.col_index):
-            self.col_widths[i] = max(self.col_widths[i], length_per_col)
-        self.row_data.append((colspan, cell_text))
+        if length_per_col > 0:
+            for i in range(start_col, self.col_index):
+                if col_widths[i] < length_per_col:
+                    col_widths[i] = length_per_col
+        self.row_data.append((colspan, cell_lines))
 
     def flush(self):
         self.table_data.append(self.row_data)
@@ -173,13 +221,40 @@ class Table:
         self.col_index = 0
 
 
+class LineCountingWriter:
+    """ Text buffer wrapper counting the lines written. """
+
+    def __init__(self, buffer: TextIO):
+        self.buffer = buffer
+        self.lines = 0
+
+    def write(self, text: str) -> int:
+        self.lines += text.count('\n')
+        return self.buffer.write(text)
+
+
 class Document(ExtractorBase):
+    """
+    Plain text rendering of an HTML document.
+    Subclasses rendering other trees (see html_engines) override `table_class` and `text_class`.
+
+    If `tables` is given, a JSON line is written to it for each table, with the table id, the span
+    of its lines in the text (from the column widths line), its headers (the cells of the first row, joined
+    across its lines), the number of lines of the first row, and the cell values of the following lines:
+    {"table", "start", "end", "headers", "header_lines", "rows"}.
+    """
+
+    table_class = Table
+    text_class = Text
 
-    def __init__(self, root: html.HtmlElement, pre_blocks: list[str], buffer: io.TextIOBase):
+    def __init__(self, root: html.HtmlElement, pre_blocks: list[str], buffer: io.TextIOBase,
+                 tables: TextIO | None = None):
         super().__init__()
         self.root = root
         self.pre_blocks = pre_blocks
-        self.buffer = buffer
+        self.tables = tables
+        self.table_count = 0
+        self.buffer = buffer if tables is None else LineCountingWriter(buffer)
         self.add_space = False
         self.add_newline = False
 
@@ -189,66 +264,408 @@ class Document(ExtractorBase):
     def render(self):
         self.traverse(self.root, 0)
 
+    def write_table(self, element: html.HtmlElement):
+        if self.tables is None:
+            self.table_class(element).write(self.buffer)
+        else:
+            start = self.buffer.lines + 1  # The table starts with a line break
+            cells = []
+            row_lines = self.table_class(element).write(self.buffer, cells)
+            # The first row holds the headers, a header cell may span several lines
+            header_lines = row_lines[0] if row_lines else 0
+            self.tables.write(json.dumps({
+                'table': self.table_count,
+                'start': start,
+                'end': start + 1 + len(cells),
+                'headers': [' '.join(filter(None, column)) for column in zip(*cells[:header_lines])],
+                'header_lines': header_lines,
+                'rows': cells[header_lines:],
+            }) + '\n')
+            self.table_count += 1
+        self.add_newline = True
+        self.add_space = False
+
+    def write_pre(self, element: html.HtmlElement):
+        if element.text:
+            # Look up the pre block by index
+            self.emit(self.pre_blocks[int(element.text)])
+        self.add_newline = True
+        self.add_space = False
+
+    def write_heading(self, element: html.HtmlElement):
+        self.emit(f"{'#' * int(element.tag[1:])} f{self.text_class(element)}\n")
+
     def traverse(self, element: html.HtmlElement, depth: int):
         if isinstance(element, html.HtmlComment):
             return
         # print(f">{' ' * depth}{element.tag}")
         if element.tag == 'table':
-            Table(element).write(self.buffer)
-            self.add_newline = True
-            self.add_space = False
+            self.write_table(element)
             # ignore element.tail, it'll likely contain junk inside the table
         elif element.tag == 'pre':
-            if element.text:
-                # Look up the pre block by index
-                self.emit(self.pre_blocks[int(element.text)])
-            self.add_newline = True
-            self.add_space = False
+            self.write_pre(element)
             if element.tail:
                 self.add_text(element.tail)
         else:
-            if element.tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                self.emit(f"{'#' * int(element.tag[1:])} f{Text(element)}\n")
+            if element.tag in HEADING_TAGS:
+                self.write_heading(element)
             else:
                 if element.text:
                     self.add_text(element.text)
                 for child in element.iterchildren():
                     self.traverse(child, depth + 1)
-            if element.tag in ['html', 'body', 'div', 'p', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+            if element.tag in BLOCK_TAGS:
                 self.add_newline = True
                 self.add_space = False
             if element.tail:
                 self.add_text(element.tail)
 
 
-def html_to_plain(html_content: str, buffer: TextIO):
-    # Extract <PRE></PRE> blocks manipulating the string.
-    # PRE blocks may exceed the 10MB limit per text node of lxml.
-    # We replace the content with an index in an array, and then replace the index with the content.
-    pre_blocks: list[str] = []
-    pre_block_index = 0
-    pre_start_re = re.compile(r'<pre[^>]*>', re.IGNORECASE)
-    pre_end_re = re.compile(r'</pre>', re.IGNORECASE)
+class StreamingDocument(Document):
+    """
+    Document rendered while the HTML is parsed, with the same output as Document.
+
+    The text of an element is complete when its first child starts, and the tail of an element when
+    its next sibling starts, so text is emitted on these events and rendered elements are removed from
+    the tree. Tables, PRE blocks and headings are rendered whole once complete: the tree only holds the
+    current ancestors and the element being rendered.
+
+    PRE bodies are cut out of the input as it is fed, as html_to_plain does, since their raw content is
+    emitted verbatim.
+    """
+
+    def __init__(self, buffer: io.TextIOBase, tables: TextIO | None = None):
+        super().__init__(None, {}, buffer, tables)
+        self.parser = etree.HTMLPullParser(events=('start', 'end', 'comment', 'pi'), huge_tree=True)
+        self.parser.set_element_class_lookup(html.HtmlElementClassLookup())
+        self.pending = ''  # Input not fed yet: a possibly incomplete <pre> or </pre> tag
+        self.pre_parts: list[str] | None = None  # Body of the current PRE block, while in one
+        self.pre_block_index = 0
+        # Open elements being rendered: [element, last child started, whose tail is pending once it ends]
+        self.stack: list[list] = []
+        self.opaque = None  # Table, PRE block or heading being parsed
+        self.done = False
+
+    def feed(self, data: str):
+        text = self.pending + data
+        self.pending = ''
+        pos = 0
+        while True:
+            if self.pre_parts is None:
+                start_match = PRE_START_RE.search(text, pos)
+                if not start_match:
+                    # Keep a '<' that is not closed yet, it may start a <pre> tag
+                    end = text.find('<', max(pos, text.rfind('>') + 1))
+                    if end < 0:
+                        end = len(text)
+                    self.parse(text[pos:end])
+                    self.pending = text[end:]
+                    break
+                self.parse(text[pos:start_match.end()])
+                pos = start_match.end()
+                self.pre_parts = []
+            else:
+                end_match = PRE_END_RE.search(text, pos)
+                if not end_match:
+                    # Keep enough to find a </pre> across chunks
+                    end = max(pos, len(text) - len('</pre>') + 1)
+                    self.pre_parts.append(text[pos:end])
+                    self.pending = text[end:]
+                    break
+                self.pre_parts.append(text[pos:end_match.start()])
+                self.pre_blocks[self.pre_block_index] = ''.join(self.pre_parts)
+                self.parse(str(self.pre_block_index))
+                self.pre_block_index += 1
+                self.pre_parts = None
+                pos = end_match.start()
+
+    def close(self):
+        if self.pre_parts is not None:
+            # Unterminated PRE block: parsed as is
+            self.pending = ''.join(self.pre_parts) + self.pending
+            self.pre_parts = None
+        self.parse(self.pending)
+        self.pending = ''
+        self.parser.close()
+        self.render_events()
+
+    def parse(self, text: str):
+        if text:
+            self.parser.feed(text)
+            self.render_events()
+
+    def write_pre(self, element: html.HtmlElement):
+        if element.text:
+            self.emit(self.pre_blocks.pop(int(element.text)))
+        self.add_newline = True
+        self.add_space = False
+
+    def add_pending_text(self):
+        """ Add the text preceding the next child of the current element, or its end. """
+        entry = self.stack[-1]
+        element, last_child = entry
+        if last_child is None:
+            if element.text:
+                self.add_text(element.text)
+        else:
+            if last_child.tag in HEADING_TAGS:
+                # The text of a heading includes its tail: it is written once the tail is complete
+                self.write_heading(last_child)
+                self.add_newline = True
+                self.add_space = False
+            # Tails of comments and tables are ignored
+            if not isinstance(last_child, html.HtmlComment) and last_child.tag != 'table' and last_child.tail:
+                self.add_text(last_child.tail)
+            element.remove(last_child)
+
+    def render_events(self):
+        for event, element in self.parser.read_events():
+            if self.done:
+                continue
+            if self.opaque is not None:
+                if event == 'end' and element is self.opaque:
+                    self.opaque = None
+                    if element.tag == 'table':
+                        self.write_table(element)
+                    elif element.tag == 'pre':
+                        self.write_pre(element)
+                continue
+            if not self.stack:
+                if event == 'start':  # Root element
+                    self.stack.append([element, None])
+                continue
+            if event == 'start':
+                self.add_pending_text()
+                self.stack[-1][1] = element
+                if element.tag == 'table' or element.tag == 'pre' or element.tag in HEADING_TAGS:
+                    self.opaque = element
+                else:
+                    self.stack.append([element, None])
+            elif event == 'end':
+                self.add_pending_text()
+                self.stack.pop()
+                if element.tag in BLOCK_TAGS:
+                    self.add_newline = True
+                    self.add_space = False
+                if not self.stack:
+                    self.done = True
+            else:  # Comment or processing instruction, complete
+                self.add_pending_text()
+                if event == 'pi' and element.text:
+                    self.add_text(element.text)
+                self.stack[-1][1] = element
+
+
+PRE_START_RE = re.compile(r'<pre[^>]*>', re.IGNORECASE)
+PRE_END_RE = re.compile(r'</pre>', re.IGNORECASE)
+
+
+def find_pre_spans(html_content: str) -> list[tuple[int, int]]:
+    """ :returns: the (start, end) offsets of the content of each <PRE></PRE> block. """
+    spans = []
     start_pos = 0
     while True:
-        start_match = pre_start_re.search(html_content, start_pos)
+        start_match = PRE_START_RE.search(html_content, start_pos)
         if not start_match:
             break
         pre_text_start = start_match.end()
-        end_match = pre_end_re.search(html_content, pre_text_start)
+        end_match = PRE_END_RE.search(html_content, pre_text_start)
         if not end_match:
             break
         pre_text_end = end_match.start()
+        spans.append((pre_text_start, pre_text_end))
+        start_pos = pre_text_end
+    return spans
+
+
+def extract_pre_blocks(html_content: str) -> tuple[str, list[str]]:
+    """
+    Extract <PRE></PRE> blocks: their content is replaced with an index in the returned list.
+    The substituted document is built in a single pass.
+    """
+    pre_blocks: list[str] = []
+    parts: list[str] = []
+    last_end = 0
+    for pre_block_index, (pre_text_start, pre_text_end) in enumerate(find_pre_spans(html_content)):
         pre_blocks.append(html_content[pre_text_start:pre_text_end])
-        html_content = f"{html_content[:pre_text_start]}{pre_block_index}{html_content[pre_text_end:]}"
-        start_pos = start_match.end() + 1
-        pre_block_index += 1
+        parts.append(html_content[last_end:pre_text_start])
+        parts.append(str(pre_block_index))
+        last_end = pre_text_end
+    parts.append(html_content[last_end:])
+    return ''.join(parts), pre_blocks
+
 
-    Document(html.fromstring(html_content), pre_blocks, buffer).render()
+def html_to_plain(html_content: str, buffer: TextIO, tables: TextIO | None = None):
+    # Extract <PRE></PRE> blocks manipulating the string.
+    # PRE blocks may exceed the 10MB limit per text node of lxml.
+    # We replace the content with an index in an array, and then replace the index with the content.
+    html_content, pre_blocks = extract_pre_blocks(html_content)
+
+    Document(html.fromstring(html_content), pre_blocks, buffer, tables).render()
+
+
+def html_to_plain_streaming(source: TextIO, buffer: TextIO, tables: TextIO | None = None,
+                            chunk_size: int = 1 << 20):
+    """ Convert the HTML read from `source` chunk by chunk, writing the text as it is parsed. """
+    document = StreamingDocument(buffer, tables)
+    while chunk := source.read(chunk_size):
+        document.feed(chunk)
+    document.close()
+
+
+def synthetic_filing(size: int) -> str:
+    """ Build an HTML filing of about `size` characters, made of PRE blocks and tables. """
+    pre_block = "<PRE>\n" + "TESLA INC     TSLA   88160R101   Approve Stock Option Grant   For   Against\n" * 20 + "</PRE>\n"
+    table = ("<table><tr><th>Issuer</th><th>Proposal</th><th>Vote</th></tr>" +
+             "<tr><td>Tesla&nbsp;Inc</td><td>Approve&amp;ratify</td><td>For</td></tr>" * 20 + "</table>\n")
+    parts = ["<html><body>\n"]
+    length = 0
+    while length < size:
+        parts.append(pre_block)
+        parts.append(table)
+        length += len(pre_block) + len(table)
+    parts.append("</body></html>\n")
+    return ''.join(parts)
+
+
+def benchmark(size_mb: int):
+    html_content = synthetic_filing(size_mb * 1000000)
+    print(f"Synthetic filing: {len(html_content) / 1e6:.1f} MB, {len(find_pre_spans(html_content))} PRE blocks")
+    start_time = time.perf_counter()
+    extract_pre_blocks(html_content)
+    print(f"PRE extraction: {time.perf_counter() - start_time:.2f}s")
+    start_time = time.perf_counter()
+    html_to_plain(html_content, io.StringIO())
+    print(f"Conversion: {time.perf_counter() - start_time:.2f}s")
+    start_time = time.perf_counter()
+    html_to_plain_streaming(io.StringIO(html_content), io.StringIO())
+    print(f"Streaming conversion: {time.perf_counter() - start_time:.2f}s")
+
+
+class TestHtmlToPlain(unittest.TestCase):
+
+    @staticmethod
+    def normalize_text_reference(text: str) -> str:
+        # Previous implementation of ExtractorBase.add_text
+        text = text.replace('\n', ' ')
+        text = re.sub(r'&nbsp;', ' ', text, flags=re.IGNORECASE)
+        text = re.sub(r'&reg;', '(R)', text, flags=re.IGNORECASE)
+        text = re.sub(r'&amp;', '&', text, flags=re.IGNORECASE)
+        return re.sub('[ \u00a0]+', ' ', text)
+
+    def test_normalize_text(self):
+        random.seed(0)
+        tokens = [' ', '  ', '\n', '\u00a0', '&nbsp;', '&NBSP;', '&reg;', '&Reg;', '&amp;', '&AMP;', '&amp;nbsp;',
+                  '&', ';', 'nbsp', 'Tesla', 'é', '\t', '&#160;']
+        for _ in range(5000):
+            text = ''.join(random.choice(tokens) for _ in range(random.randint(1, 12)))
+            self.assertEqual(self.normalize_text_reference(text), normalize_text(text), repr(text))
+
+    @staticmethod
+    def extract_pre_blocks_quadratic(html_content: str) -> tuple[str, list[str]]:
+        # Previous implementation, rebuilding the document for each PRE block
+        pre_blocks: list[str] = []
+        pre_block_index = 0
+        start_pos = 0
+        while True:
+            start_match = PRE_START_RE.search(html_content, start_pos)
+            if not start_match:
+                break
+            pre_text_start = start_match.end()
+            end_match = PRE_END_RE.search(html_content, pre_text_start)
+            if not end_match:
+                break
+            pre_text_end = end_match.start()
+            pre_blocks.append(html_content[pre_text_start:pre_text_end])
+            html_content = f"{html_content[:pre_text_start]}{pre_block_index}{html_content[pre_text_end:]}"
+            start_pos = start_match.end() + 1
+            pre_block_index += 1
+        return html_content, pre_blocks
+
+    def test_extract_pre_blocks(self):
+        for html_content in [
+            synthetic_filing(20000),
+            "<html><pre></pre><PRE class=x>a<pre>b</PRE>c</pre><pre>unterminated",
+            "<html><body>no pre</body></html>",
+        ]:
+            self.assertEqual(self.extract_pre_blocks_quadratic(html_content), extract_pre_blocks(html_content))
+
+    def test_table(self):
+        # The second column is empty (zero-width), the vote header spans two columns
+        html_content = ("<html><body><table><tr><th>Issuer</th><td></td><th colspan=2>Vote</th></tr>"
+                        "<tr><td>Tesla<br>Inc</td><td></td><td>For</td><td>Against</td></tr>"
+                        "<tr><td>Approve</td></tr></table></body></html>")
+        buffer = io.StringIO()
+        html_to_plain(html_content, buffer)
+        self.assertEqual("\n"
+                         "  | ------- | --- | ------- |\n"
+                         "  | Issuer  | Vote          |\n"
+                         "  | Tesla   | For | Against |\n"
+                         "  | Inc     |     |         |\n"
+                         "  | Approve |     |         |\n", buffer.getvalue())
+
+    def test_tables_sidecar(self):
+        html_content = ("<html><body><p>Votes</p><table><tr><th>Issuer</th><th colspan=2>Vote</th></tr>"
+                        "<tr><td>Tesla<br>Inc</td><td>For</td><td>Against</td></tr></table><p>After</p></body></html>")
+        buffer = io.StringIO()
+        tables = io.StringIO()
+        html_to_plain(html_content, buffer, tables)
+        lines = buffer.getvalue().split('\n')
+        table = json.loads(tables.getvalue())
+        self.assertEqual({'table': 0, 'start': 1, 'end': 5, 'headers': ['Issuer', 'Vote', ''], 'header_lines': 1,
+                          'rows': [['Tesla', 'For', 'Against'], ['Inc', '', '']]}, table)
+        self.assertTrue(lines[table['start']].startswith('  | -'))
+        self.assertTrue(lines[table['end'] - 1].startswith('  | Inc'))
+        self.assertFalse(lines[table['end']].startswith('  |'))
+        # Headers on several lines
+        tables = io.StringIO()
+        html_to_plain(html_content.replace("<th>Issuer</th>", "<th>Issuer<br>Name</th>")
+                      .replace("<th colspan=2>Vote</th>", "<th colspan=2>Vote<br>Cast</th>"), io.StringIO(), tables)
+        table = json.loads(tables.getvalue())
+        self.assertEqual((['Issuer Name', 'Vote Cast', ''], 2, [['Tesla', 'For', 'Against'], ['Inc', '', '']]),
+                         (table['headers'], table['header_lines'], table['rows']))
+        self.assertEqual(6, table['end'])
+
+    def test_streaming(self):
+        for html_content in [
+            synthetic_filing(20000),
+            "<!DOCTYPE html><html><head><title>Proxy</title></head><body>Votes <b>cast</b> by<!-- x --> junk\n"
+            "<div>Fund<p>A&amp;amp;B  Fund</p>Series<br>1</div><h2>Tesla <i>Inc</i></h2>after heading\n"
+            "<table><tr><td>a<pre>x</pre></td><td colspan=2>b</td></tr></table>junk<PRE class=x>raw &amp; <b>x</b>\n"
+            "</PRE>after pre<span> s </span>  <span>t</span><h1>end</h1>"
+            "<table><tr><td><table><tr><td>n</td></tr></table></td></tr></table>x</body></html>",
+        ]:
+            expected = io.StringIO()
+            html_to_plain(html_content, expected)
+            for chunk_size in [1, 7, 1 << 20]:
+                buffer = io.StringIO()
+                html_to_plain_streaming(io.StringIO(html_content), buffer, chunk_size=chunk_size)
+                self.assertEqual(expected.getvalue(), buffer.getvalue())
 
 
 if __name__ == '__main__':
-    with open('input.html', 'r', encoding='utf-8') as f:
-        input_content = f.read()
-
-    html_to_plain(input_content, sys.stdout)
+    parser = argparse.ArgumentParser(
+        prog='html_to_plain',
+        description='Convert an HTML filing to plain text')
+    parser.add_argument('-b', '--bench', type=int, metavar='SIZE_MB', nargs='?', const=50,
+                        help='time the conversion of a synthetic filing')
+    parser.add_argument('-s', '--streaming', action='store_true',
+                        help='parse the input incrementally, with memory bounded by the largest table')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('input', nargs='?', default='input.html')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    if args.bench:
+        benchmark(args.bench)
+        exit(0)
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        if args.streaming:
+            html_to_plain_streaming(f, sys.stdout)
+        else:
+            html_to_plain(f.read(), sys.stdout)
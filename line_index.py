@@ -0,0 +1,258 @@
+import argparse
+import array
+import itertools
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+import unittest
+
+import filing_store
+
+# Line index of plain text files, for random access to their lines.
+#
+# plain/x.lines.idx holds a JSON header line {"key": ..., "lines": n}, followed by the byte offsets of the
+# start of each line (array of unsigned 64-bit integers). The key identifies the indexed content (SHA-256 in
+# the store, size and modification time otherwise): a stale index is rebuilt on first access.
+#
+# Lines are the same as in open_text(path).read().split('\n'): universal newlines.
+
+LINE_END_RE = re.compile(rb'\r\n?|\n')
+
+
+def index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.lines.idx'
+
+
+def _content_key(path: str) -> str:
+    digest = filing_store.digest(path)
+    if digest is not None:
+        return digest
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class PlainLines:
+    """
+    Lines of a plain text file, read on demand: `lines[a:b]` decodes only the requested lines.
+    The file is memory-mapped, or read through the filing store's seekable reader if it is compressed.
+    """
+
+    CHUNK_SIZE = 1 << 22
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = filing_store.open_binary(path)
+        self.data = None
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.data)
+        except (OSError, ValueError):  # Stored compressed, or empty file
+            self.size = self.file.seek(0, os.SEEK_END)
+        self.offsets = self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.file.close()
+
+    def read(self, start: int, end: int) -> bytes:
+        if self.data is not None:
+            return self.data[start:end]
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def _load_index(self) -> array.array:
+        key = _content_key(self.path)
+        try:
+            with open(index_path(self.path), 'rb') as f:
+                header = json.loads(f.readline())
+                if header['key'] == key:
+                    offsets = array.array('Q')
+                    offsets.frombytes(f.read())
+                    if len(offsets) == header['lines']:
+                        return offsets
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        offsets = self._build_index()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps({'key': key, 'lines': len(offsets)}).encode() + b'\n')
+            offsets.tofile(f)
+        os.replace(tmp_path, index_path(self.path))
+        return offsets
+
+    def _build_index(self) -> array.array:
+        # Chunk by chunk, so that only a chunk and the offsets are in memory
+        offsets = array.array('Q', [0])
+        pos = 0
+        while pos < self.size:
+            chunk = self.read(pos, pos + self.CHUNK_SIZE)
+            while chunk.endswith(b'\r') and pos + len(chunk) < self.size:  # Keep \r\n in the same chunk
+                chunk += self.read(pos + len(chunk), pos + len(chunk) + 1)
+            if b'\r' in chunk:
+                offsets.extend(pos + match.end() for match in LINE_END_RE.finditer(chunk))
+            else:  # Twice as fast
+                offsets.extend(itertools.islice(itertools.accumulate(
+                    (len(line) + 1 for line in chunk.split(b'\n')[:-1]), initial=pos), 1, None))
+            pos += len(chunk)
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _line_end(self, index: int) -> int:
+        """ Offset of the end of line `index`, excluding its line terminator. """
+        if index + 1 < len(self.offsets):
+            end = self.offsets[index + 1]
+            end -= 2 if self.read(end - 2, end) == b'\r\n' else 1
+            return end
+        return self.size
+
+    def __getitem__(self, index: int | slice) -> str | list[str]:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+            text = self.read(self.offsets[start], self._line_end(stop - 1)).decode('utf-8')
+            if '\r' in text:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            return text.split('\n')
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        return self.read(self.offsets[index], self._line_end(index)).decode('utf-8')
+
+
+class TestPlainLines(unittest.TestCase):
+
+    CONTENT = "Fund A\n  | Tesla | For |\r\nTesla café\rlast\n\n  Fund B"
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('plain')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def check_lines(self, path: str):
+        with filing_store.open_text(path) as f:
+            expected = f.read().split('\n')
+        with PlainLines(path) as lines:
+            self.assertEqual(len(expected), len(lines))
+            self.assertEqual(expected, lines[:])
+            bounds = sorted(set(range(8)) | set(range(len(expected) - 8, len(expected) + 1)))
+            for i in bounds:
+                if 0 <= i < len(expected):
+                    self.assertEqual(expected[i], lines[i])
+                for j in bounds:
+                    if 0 <= i <= j:
+                        self.assertEqual(expected[i:j], lines[i:j])
+            self.assertEqual(expected[-1], lines[-1])
+            self.assertEqual(expected[-3:], lines[-3:])
+            self.assertEqual(expected[::2], lines[::2])
+
+    def test_lines(self):
+        path = os.path.join('plain', 'a.txt')
+        for content in [self.CONTENT, self.CONTENT + "\n", "Fund A\n\nTesla café\n", "", "\n"]:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write(content)
+            self.check_lines(path)  # Builds the index
+            self.check_lines(path)  # Uses the index
+            os.remove(index_path(path))
+
+    def test_chunks(self):
+        path = os.path.join('plain', 'a.txt')
+        for content in [self.CONTENT, self.CONTENT + "\r", "a\r\r\nb\n\n\r\n"]:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write(content * 5)
+            with open(path, 'rb') as f:
+                expected_offsets = [0] + [match.end() for match in LINE_END_RE.finditer(f.read())]
+            for chunk_size in [1, 2, 3, 7]:
+                with PlainLines(path) as lines:
+                    lines.CHUNK_SIZE = chunk_size
+                    self.assertEqual(expected_offsets, lines._build_index().tolist(), (content, chunk_size))
+
+    def test_stale_index(self):
+        path = os.path.join('plain', 'a.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("a\nb\n")
+        with PlainLines(path) as lines:
+            self.assertEqual(3, len(lines))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("a\nb\nc\nd\n")
+        os.utime(path, ns=(0, 0))
+        with PlainLines(path) as lines:
+            self.assertEqual(['c', 'd'], lines[2:4])
+
+    def test_stored(self):
+        os.makedirs(filing_store.STORE_PATH)
+        path = os.path.join('plain', 'b.txt')
+        with filing_store.open_write(path) as f:
+            f.write(self.CONTENT * 1000)
+        self.assertFalse(os.path.exists(path))
+        self.check_lines(path)
+
+
+def benchmark(path: str):
+    start_time = time.perf_counter()
+    with filing_store.open_text(path) as f:
+        all_lines = f.read().split('\n')
+    print(f"Read and split {len(all_lines)} lines: {time.perf_counter() - start_time:.3f}s")
+    middle = len(all_lines) // 2
+    for label in ['Build index', 'Load index']:
+        start_time = time.perf_counter()
+        with PlainLines(path) as lines:
+            assert lines[middle:middle + 50] == all_lines[middle:middle + 50]
+        print(f"{label} and read 50 lines: {time.perf_counter() - start_time:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='line_index',
+        description='Random access to the lines of plain text filings')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('-b', '--bench', type=str, metavar='PATH',
+                        help='compare reading a plain text file with building and using its index')
+    parser.add_argument('path', nargs='?', help='plain text file')
+    parser.add_argument('first_line', nargs='?', type=int, default=0)
+    parser.add_argument('last_line', nargs='?', type=int, help='last line, included (default: first line)')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    if args.bench:
+        if os.path.exists(index_path(args.bench)):
+            os.remove(index_path(args.bench))
+        benchmark(args.bench)
+        exit(0)
+
+    if args.path:
+        last_line = args.first_line if args.last_line is None else args.last_line
+        with PlainLines(args.path) as lines:
+            for line_index, line in enumerate(lines[args.first_line:last_line + 1], args.first_line):
+                print(f"{line_index:6d}  {line}")
+    exit(0)
+
+
+# main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+import filing_store
+
+# Manifest of the outputs of the pipeline stages, for incremental runs.
+#
+# For each stage and filing, the manifest records the hash of the input, the version of the stage and the
+# hashes of the outputs. A stage reuses its previous outputs only if the input hash and version are the
+# same and the outputs still exist: re-downloaded filings and changes to a stage (bump its VERSION) are
+# recomputed, everything else is skipped.
+MANIFEST_PATH = os.environ.get('MANIFEST_PATH', 'manifest.sqlite')
+
+
+def _connect() -> sqlite3.Connection:
+    # Stages may run in several processes: wait for the other writers
+    conn = sqlite3.connect(MANIFEST_PATH, timeout=60)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS manifest (
+        stage TEXT,
+        name TEXT,
+        input_hash TEXT,
+        version TEXT,
+        outputs TEXT,
+        PRIMARY KEY (stage, name)
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS file_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        hash TEXT
+    )""")
+    return conn
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """
+    SHA-256 of the content of a file. Files in the store are addressed by their hash; for uncompressed
+    files, the hash is cached by size and modification time.
+    """
+    digest = filing_store.digest(path)
+    if digest is not None:
+        return digest
+    stat = os.stat(path)
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT hash FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                           (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                         (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+    finally:
+        conn.close()
+
+
+def record(stage: str, name: str, input_hash: str, version: str, outputs: list[str]):
+    """ Record the outputs of a stage for the input `name`, after they are written. """
+    output_hashes = {path: file_hash(path) for path in outputs}
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO manifest (stage, name, input_hash, version, outputs) "
+                         "VALUES (?, ?, ?, ?, ?)", (stage, name, input_hash, version, json.dumps(output_hashes)))
+    finally:
+        conn.close()
+
+
+def is_fresh(stage: str, name: str, input_hash: str, version: str, outputs: list[str],
+             adopt: bool = False, verify: bool = False) -> bool:
+    """
+    :param adopt: if nothing is recorded for `name` but all the outputs exist (written before the manifest
+        was introduced), record them as up to date.
+    :param verify: also check the hashes of the outputs.
+    :returns: True if the outputs recorded for the input `name` are up to date.
+    """
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT input_hash, version, outputs FROM manifest WHERE stage = ? AND name = ?",
+                           (stage, name)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        if adopt and outputs and all(filing_store.exists(path) for path in outputs):
+            record(stage, name, input_hash, version, outputs)
+            return True
+        return False
+    recorded_hash, recorded_version, recorded_outputs = row
+    recorded_outputs = json.loads(recorded_outputs)
+    if recorded_hash != input_hash or recorded_version != version or sorted(recorded_outputs) != sorted(outputs):
+        return False
+    if not all(filing_store.exists(path) for path in outputs):
+        return False
+    if verify:
+        return all(file_hash(path) == output_hash for path, output_hash in recorded_outputs.items())
+    return True
+
+
+def forget(stage: str, name: str | None = None):
+    """ Forget the outputs of a stage, for one input or all, so that they are recomputed. """
+    conn = _connect()
+    try:
+        with conn:
+            if name is None:
+                conn.execute("DELETE FROM manifest WHERE stage = ?", (stage,))
+            else:
+                conn.execute("DELETE FROM manifest WHERE stage = ? AND name = ?", (stage, name))
+    finally:
+        conn.close()
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def write(path: str, content: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def test_is_fresh(self):
+        self.write('input.txt', "filing")
+        input_hash = file_hash('input.txt')
+        self.assertFalse(is_fresh('blocks', 'input.txt', input_hash, '1', ['output.json']))
+        self.write('output.json', "{}")
+        record('blocks', 'input.txt', input_hash, '1', ['output.json'])
+        self.assertTrue(is_fresh('blocks', 'input.txt', input_hash, '1', ['output.json']))
+        # New stage version
+        self.assertFalse(is_fresh('blocks', 'input.txt', input_hash, '2', ['output.json']))
+        # Re-downloaded filing
+        self.write('input.txt', "amended filing")
+        self.assertNotEqual(input_hash, file_hash('input.txt'))
+        self.assertFalse(is_fresh('blocks', 'input.txt', file_hash('input.txt'), '1', ['output.json']))
+        # Modified output
+        self.write('output.json', "[]")
+        self.assertTrue(is_fresh('blocks', 'input.txt', input_hash, '1', ['output.json']))
+        self.assertFalse(is_fresh('blocks', 'input.txt', input_hash, '1', ['output.json'], verify=True))
+        # Missing output
+        os.remove('output.json')
+        self.assertFalse(is_fresh('blocks', 'input.txt', input_hash, '1', ['output.json']))
+        forget('blocks')
+        self.assertFalse(is_fresh('blocks', 'input.txt', input_hash, '1', []))
+
+    def test_adopt(self):
+        self.write('output.json', "{}")
+        self.assertTrue(is_fresh('blocks', 'input.txt', 'abc', '1', ['output.json'], adopt=True))
+        self.assertFalse(is_fresh('blocks', 'input.txt', 'def', '1', ['output.json'], adopt=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='manifest',
+        description='Manifest of the outputs of the pipeline stages')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('command', nargs='?', choices=['status', 'forget'])
+    parser.add_argument('stage', nargs='?', help='stage to forget (plain, blocks, funds)')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    if args.command == 'status':
+        conn = _connect()
+        for stage, version, count in conn.execute(
+                "SELECT stage, version, COUNT(*) FROM manifest GROUP BY stage, version ORDER BY stage, version"):
+            print(f"{stage} ({version}): {count} filings")
+        conn.close()
+    elif args.command == 'forget':
+        if not args.stage:
+            parser.error("forget requires a stage")
+        forget(args.stage)
+    exit(0)
+
+
+# main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import mmap
+import os
+import tempfile
+import unittest
+from typing import Iterator
+
+import filing_store
+
+
+class Section:
+    """
+    Section of an EDGAR submission, as byte offsets of its content:
+    the lines between the opening and closing tag lines, excluding the tag lines.
+    """
+
+    def __init__(self, tag: str, start: int, end: int):
+        self.tag = tag
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"Section({self.tag}, {self.start}, {self.end})"
+
+
+class Submission:
+    """
+    EDGAR submission (.txt file), split into sections without reading it all in memory.
+
+    The file is memory-mapped when it is stored uncompressed, otherwise it is read through the
+    filing store's seekable reader. Sections are located by scanning for their tag lines, skipping
+    over the content of <TEXT> sections, and decoded only when requested.
+    """
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = filing_store.open_binary(path)
+        self.data = None
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.data)
+        except (OSError, ValueError):  # Stored compressed, or empty file
+            self.size = self.file.seek(0, os.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.file.close()
+
+    def read(self, start: int, end: int) -> bytes:
+        if self.data is not None:
+            return self.data[start:end]
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def text(self, section: Section) -> str:
+        # Same result as reading the file in text mode: UTF-8, universal newlines
+        text = self.read(section.start, section.end).decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
+    def find(self, sub: bytes, start: int, end: int) -> int:
+        if self.data is not None:
+            return self.data.find(sub, start, end)
+        # Scan chunks, overlapping so that matches across chunk boundaries are found
+        while start < end:
+            chunk = self.read(start, min(end, start + self.CHUNK_SIZE + len(sub) - 1))
+            index = chunk.find(sub)
+            if index >= 0:
+                return start + index
+            start += self.CHUNK_SIZE
+        return -1
+
+    def readline(self, start: int) -> tuple[bytes, int]:
+        """ :returns: the line at `start`, without its line terminator, and the offset of the next line. """
+        end = self.find(b'\n', start, self.size)
+        next_start = self.size if end < 0 else end + 1
+        return self.read(start, next_start).rstrip(b'\r\n'), next_start
+
+    def find_line(self, tag: bytes, start: int, end: int) -> int:
+        """ :returns: the offset of the first line in [start, end) that is exactly `tag`, or -1. """
+        if start >= end:
+            return -1
+        candidate = start if self.read(start, start + len(tag)) == tag else -1
+        pos = start
+        while True:
+            if candidate < 0:
+                index = self.find(b'\n' + tag, pos, end)
+                if index < 0:
+                    return -1
+                candidate = index + 1
+            after = self.read(candidate + len(tag), candidate + len(tag) + 2)
+            if not after or after[:1] == b'\n' or after == b'\r\n':
+                return candidate
+            pos = candidate
+            candidate = -1
+
+    def sections(self) -> Iterator[Section]:
+        """
+        Yield the sections of the submission as they end: <SEC-HEADER>, then for each <DOCUMENT>,
+        the <XML> sections inside its <TEXT>, the <TEXT> section, and the <DOCUMENT> itself.
+        """
+        pos = 0
+        document_start = None
+        while pos < self.size:
+            line, next_pos = self.readline(pos)
+            if line.startswith(b'<SEC-HEADER>'):
+                end = self.find_line(b'</SEC-HEADER>', next_pos, self.size)
+                if end < 0:
+                    end = self.size
+                yield Section('SEC-HEADER', next_pos, end)
+                next_pos = end
+            elif line == b'<DOCUMENT>':
+                document_start = next_pos
+            elif line == b'</DOCUMENT>' and document_start is not None:
+                yield Section('DOCUMENT', document_start, pos)
+                document_start = None
+            elif line == b'<TEXT>':
+                end = self.find_line(b'</TEXT>', next_pos, self.size)
+                if end < 0:
+                    end = self.size
+                xml_pos = next_pos
+                while (xml_start := self.find_line(b'<XML>', xml_pos, end)) >= 0:
+                    _, xml_start = self.readline(xml_start)
+                    xml_end = self.find_line(b'</XML>', xml_start, end)
+                    if xml_end < 0:
+                        break
+                    yield Section('XML', xml_start, xml_end)
+                    _, xml_pos = self.readline(xml_end)
+                yield Section('TEXT', next_pos, end)
+                next_pos = end
+            pos = next_pos
+
+
+class TestSubmission(unittest.TestCase):
+
+    SUBMISSION = (
+        "<SEC-DOCUMENT>0000000000-18-000001.txt : 20180830\n"
+        "<SEC-HEADER>0000000000-18-000001.hdr.sgml : 20180830\n"
+        "<SERIES>\n"
+        "<SERIES-NAME>Some Fund\n"
+        "</SERIES>\n"
+        "</SEC-HEADER>\n"
+        "<DOCUMENT>\n"
+        "<TYPE>N-PX\n"
+        "<TEXT>\n"
+        "<XML>\n"
+        "<proxyVoteTable/>\n"
+        "</XML>\n"
+        "</TEXT>\n"
+        "</DOCUMENT>\n"
+        "<DOCUMENT>\n"
+        "<TEXT>\n"
+        "Votes </TEXT>\n"
+        "Tesla café\n"
+        "</TEXT>\n"
+        "</DOCUMENT>\n"
+        "</SEC-DOCUMENT>\n"
+    )
+
+    def check_submission(self, content: bytes, chunk_size: int | None = None):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'filing.txt')
+            with open(path, 'wb') as f:
+                f.write(content)
+            with Submission(path) as submission:
+                if chunk_size is not None:  # Exercise the non-mmap path
+                    submission.data.close()
+                    submission.data = None
+                    submission.CHUNK_SIZE = chunk_size
+                sections = list(submission.sections())
+                self.assertEqual(['SEC-HEADER', 'XML', 'TEXT', 'DOCUMENT', 'TEXT', 'DOCUMENT'],
+                                 [section.tag for section in sections])
+                self.assertEqual("<SERIES>\n<SERIES-NAME>Some Fund\n</SERIES>\n", submission.text(sections[0]))
+                self.assertEqual("<proxyVoteTable/>\n", submission.text(sections[1]))
+                self.assertEqual("<XML>\n<proxyVoteTable/>\n</XML>\n", submission.text(sections[2]))
+                self.assertEqual("Votes </TEXT>\nTesla café\n", submission.text(sections[4]))
+
+    def test_sections(self):
+        self.check_submission(self.SUBMISSION.encode('utf-8'))
+
+    def test_sections_crlf(self):
+        self.check_submission(self.SUBMISSION.replace('\n', '\r\n').encode('utf-8'))
+
+    def test_sections_chunked(self):
+        self.check_submission(self.SUBMISSION.encode('utf-8'), chunk_size=7)
@@ -1,11 +1,35 @@
 import argparse
+import bisect
+import contextlib
+import copy
+import hashlib
+import io
+import itertools
 import json
 import os
 import re
 import sys
+import tempfile
+import time
+import traceback
 import unittest
+from multiprocessing import Pool
+from operator import itemgetter, methodcaller
+from typing import Iterable, Iterator
 
-from utils import ensure_text_filing
+import filing_store
+import manifest
+import strategies
+from html_to_plain import VERSION as HTML_TO_PLAIN_VERSION, html_to_plain
+from line_index import PlainLines
+from sgml import Submission
+from utils import ensure_text_filing, filing_format, load_tables, tables_file
+from watchlist import DEFAULT_WATCHLIST, TESLA, Issuer, load_watchlist
+
+
+# Version of the blocks, bump it when the splitting changes so that filings are split again
+VERSION = 7
+STAGE_VERSION = f"split_blocks {VERSION}, html_to_plain {HTML_TO_PLAIN_VERSION}"
 
 
 def custom_serializer(obj):
@@ -19,92 +43,282 @@ def json_dumps(obj, **kwargs):
 
 
 class Block:
+    """
+    Lines [start, end) of the plain text filing. Blocks split from a huge table are a row of the table:
+    they hold the headers of the table and the cells of the row instead, and `table` tells where to read
+    them back from: {'sidecar': index of the table in the tables sidecar} or {'headers': [...], 'columns':
+    [[start, end], ...] of the cells in the line of the row}. The cells of the latter are sliced from the line
+    when the text is requested, so that rows that are not relevant are never sliced.
+    A block mentioning several securities of the watchlist is written once per security, tagged with its key.
+    """
 
-    def __init__(self, start, end, lines):
+    def __init__(self, start, end, headers=None, values=None, table=None):
         self.start = start
         self.end = end
         self.needle = None
-        self.lines = lines
+        self.security = None
+        self.headers = headers
+        self.values = values
+        self.table = table
+
+    def text(self, lines) -> str:
+        if self.values is None and self.table is not None and 'columns' in self.table:
+            self.headers = self.table['headers']
+            self.values = ColumnSpec(self.table['columns']).values(lines[self.start])
+        if self.headers is not None:
+            return "\n".join(f"{header}: {value}" for header, value in zip(self.headers, self.values))
+        return "\n".join(lines[self.start:self.end])
 
     def to_dict(self):
         return {
             'start': self.start,
             'end': self.end,
-            'lines': self.lines,
+            'needle': self.needle,
+            'security': self.security,
         }
 
 
-def needle_found(line):
-    return re.search(r'\b(TSLA|TESLA)\b', line, re.IGNORECASE) is not None
+class ColumnSpec:
+    """
+    Columns of a table laid out in plain text by the HTML conversion, derived once from its rule line
+    ("  | ------ | ---- |"): the cells of a row are sliced by an itemgetter of the column slices.
+    """
+
+    RULE_RE = re.compile(r'-+(?=[^-])')  # A column ends one character after its dashes
+
+    def __init__(self, columns: list[tuple[int, int]]):
+        self.columns = columns
+        if len(columns) > 1:
+            self.cells = itemgetter(*(slice(start, end) for start, end in columns))
+        elif columns:
+            start, end = columns[0]
+            self.cells = lambda line: (line[start:end],)
+        else:
+            self.cells = lambda line: ()
+
+    @classmethod
+    def from_rule(cls, line: str) -> 'ColumnSpec':
+        return cls([(match.start(), match.end() + 1) for match in cls.RULE_RE.finditer(line)])
+
+    def values(self, line: str) -> list[str]:
+        return list(map(str.strip, self.cells(line)))
+
+
+class Needles:
+    """
+    Needles of the securities of a watchlist, all found in a single pass: one case-insensitive regular
+    expression, with a named group per needle. Needles of all the securities are tried longest first, so that
+    e.g. 'Apple Hospitality REIT' is found rather than 'Apple' of another security.
+    """
+
+    def __init__(self, issuers: list[Issuer]):
+        self.keys = [issuer.key for issuer in issuers]
+        needles = sorted(((needle, issuer.key) for issuer in issuers for needle in issuer.needles),
+                         key=lambda item: len(item[0]), reverse=True)
+        # Security of each group
+        self.group_keys = {f"n{index}": key for index, (_, key) in enumerate(needles)}
+        self.regex = re.compile('|'.join(f"(?P<n{index}>{self.needle_pattern(needle)})"
+                                         for index, (needle, _) in enumerate(needles)), re.IGNORECASE)
+        # Longest word of each needle, to look for in raw filings, see raw_needle_found
+        self.words = [max(re.findall(r'[a-z0-9]+', needle.lower()), key=len, default='').encode()
+                      for issuer in issuers for needle in issuer.needles]
+        # Identifies the needles in the version of the stage
+        self.digest = hashlib.sha256(json.dumps([[issuer.key, sorted(issuer.needles)] for issuer in issuers])
+                                     .encode('utf-8')).hexdigest()[:12]
+
+    @staticmethod
+    def needle_pattern(needle: str) -> str:
+        # Whole words: e.g. 'Tesla, Inc.' ends with a non-word character, \b would require a word after it
+        pattern = re.escape(needle)
+        if re.match(r'\w', needle):
+            pattern = r'\b' + pattern
+        if re.search(r'\w$', needle):
+            pattern += r'\b'
+        return pattern
+
+    def found(self, line: str) -> bool:
+        return self.regex.search(line) is not None
+
+    def securities(self, line: str) -> list[str]:
+        """ :returns: the keys of the securities mentioned in the line. """
+        return [self.group_keys[match.lastgroup] for match in self.regex.finditer(line)]
+
+
+DEFAULT_NEEDLES = Needles(DEFAULT_WATCHLIST)
+
+# Non-ASCII characters that match ASCII letters in case-insensitive regular expressions
+CASE_FOLDS = {'I': '\u0130\u0131', 'K': '\u212a', 'S': '\u017f'}
+
+TAG_RE = re.compile(rb'<!--.*?-->|<[^<>]*>', re.DOTALL)
+CHARACTER_REFERENCE_RE = re.compile(rb'&#(?:([0-9]+)|x([0-9a-f]+));?')  # In lowercase text
+
+
+def _fold_case(data: bytes) -> bytes:
+    data = data.lower()
+    for letter, chars in CASE_FOLDS.items():
+        for char in chars:
+            data = data.replace(char.encode('utf-8'), letter.lower().encode())
+    return data
+
+
+def _decode_character_reference(match: re.Match[bytes]) -> bytes:
+    code = int(match[1]) if match[1] else int(match[2], 16)
+    try:
+        return chr(code).encode('utf-8')
+    except (ValueError, OverflowError):
+        return match[0]
+
+
+def raw_needle_found(data: bytes, needles: Needles = DEFAULT_NEEDLES) -> bool:
+    """
+    Whether a needle may be found once the raw (HTML or plain text) filing is converted to plain text,
+    without converting it. In HTML, the letters of a needle may be written as numeric character references
+    or separated by tags: they are decoded and removed before looking for the longest word of each needle,
+    ignoring word boundaries. It may return True when no needle is found, but not the other way round.
+    """
+    words = needles.words
+    if not all(words):  # Needle without letters or digits
+        return True
+    text = _fold_case(data)
+    if any(word in text for word in words):
+        return True
+    text = TAG_RE.sub(b'', text)
+    if b'&#' in text:
+        text = _fold_case(CHARACTER_REFERENCE_RE.sub(_decode_character_reference, text))
+    return any(word in text for word in words)
+
+
+def needle_found(line, needles: Needles = DEFAULT_NEEDLES):
+    return needles.found(line)
+
+
+def needle_lines(lines: list[str], needles: Needles = DEFAULT_NEEDLES) -> list[int]:
+    """
+    :returns: the sorted indices of the lines mentioning a security of the watchlist, computed once per filing.
+        Only the lines containing the longest word of a needle (see raw_needle_found) are matched against the
+        needles: substring searches in the whole filing are several times faster than a regular expression
+        search per line.
+    """
+    if not all(needles.words):  # Needle without letters or digits
+        return list(itertools.compress(range(len(lines)), map(needles.regex.search, lines)))
+    text = _fold_case("\n".join(lines).encode('utf-8'))
+    candidates = set()
+    for word in needles.words:
+        line_index = 0
+        counted = 0  # Newlines are counted up to this offset
+        position = text.find(word)
+        while position >= 0:
+            line_index += text.count(b'\n', counted, position)
+            counted = position
+            candidates.add(line_index)
+            line_end = text.find(b'\n', position)
+            if line_end < 0:
+                break
+            position = text.find(word, line_end)
+    return sorted(index for index in candidates if needles.regex.search(lines[index]))
+
+
+def relevant_blocks(blocks: Iterable[Block], positions: list[int]) -> Iterator[Block]:
+    """
+    Blocks containing one of the needle lines `positions`, with `needle` set to the first of them: a bisection
+    per block instead of searching its lines again. Blocks come in line order, so splitting stops after the
+    last needle line.
+    """
+    if not positions:
+        return
+    last_position = positions[-1]
+    for block in blocks:
+        if block.start > last_position:
+            break
+        index = bisect.bisect_left(positions, block.start)
+        if index < len(positions) and positions[index] < block.end:
+            block.needle = positions[index]
+            yield block
 
 
 def split_blocks_separator(lines, separator):
     print(f"Splitting using separator {separator}")
-    blocks = []
     start = 0
     for i, line in enumerate(lines):
         if separator in line:
             if i > start:
-                blocks.append(Block(start, i, lines[start:i]))
+                yield Block(start, i)
             start = i
     if len(lines) > start:
-        blocks.append(Block(start, len(lines), lines[start:]))
-    return blocks
+        yield Block(start, len(lines))
 
 
 def split_block_double_separator(lines, separator):
     print(f"Splitting using double separator {separator}")
     # 0001579982-0001144204-18-042736
-    blocks = []
     start = 0
     for i, line in enumerate(lines):
         if i + 2 < len(lines) and separator in lines[i] and separator in lines[i + 2]:
             if i > start:
-                blocks.append(Block(start, i, lines[start:i]))
+                yield Block(start, i)
             start = i
     if start < len(lines):
-        blocks.append(Block(start, len(lines), lines[start:]))
-    return blocks
+        yield Block(start, len(lines))
 
 
 def split_blocks_indentation(lines):
     print(f"Splitting using indentation")
     # 0001432353-0001135428-18-000216
-    blocks = []
     start = 0
     for i, line in enumerate(lines):
         if line and line[0] != ' ':  # New block
             if i > start:
-                blocks.append(Block(start, i, lines[start:i]))
+                yield Block(start, i)
             start = i
     if start < len(lines):
-        blocks.append(Block(start, len(lines), lines[start:]))
-    return blocks
+        yield Block(start, len(lines))
 
 
 def split_blocks_marker(lines, marker, offset):
     # Split blocks `offset` lines before each occurrence of the marker.
     # 0000071516-0000051931-18-000837
     print("Using marker block split")
-    blocks = []
     start = 0
     for i, line in enumerate(lines):
         if marker in line:
-            blocks.append(Block(start, i - offset, lines[start:i - offset]))
+            yield Block(start, i - offset)
             start = i - offset
     if start < len(lines):
-        blocks.append(Block(start, len(lines), lines[start:]))
-    return blocks
+        yield Block(start, len(lines))
+
+
+def table_rows(start: int, end: int, positions: list[int] | None) -> Iterable[int]:
+    """ Lines [start, end) of the rows of a table, or only those in `positions` if given. """
+    if positions is None:
+        return range(start, end)
+    return positions[bisect.bisect_left(positions, start):bisect.bisect_left(positions, end)]
+
 
+def table_first_row(table: dict) -> int:
+    """ Line of the first row after the headers of a table of the tables sidecar. """
+    return table['start'] + 1 + table.get('header_lines', 1)
 
-def split_blocks_huge_table(lines):
+
+def split_blocks_huge_table(lines, tables=None, positions=None):
     # Examples include:
     # 0000355767-0001193125-18-240576.txt
     # 0000811161-0000897101-18-000869.txt
     # 0000811161-0000897101-18-000869.txt
-    blocks = []
+    # Each row is a block: given the needle lines `positions`, only the rows on these lines are yielded,
+    # without going through the other rows.
     index = 0
 
+    if tables is not None:
+        # Cells recorded by the HTML conversion, see html_to_plain.Document
+        for table_index, table in enumerate(tables):
+            print("Begin new table")
+            headers = table['headers']
+            source = {'sidecar': table_index}
+            first_row = table_first_row(table)
+            for index in table_rows(first_row, first_row + len(table['rows']), positions):
+                yield Block(index, index + 1, headers, table['rows'][index - first_row], source)
+        return
+
     line = ""
     while index < len(lines):
 
@@ -119,154 +333,602 @@ def split_blocks_huge_table(lines):
         print("Begin new table")
 
         # Parse column width line, data fields are contiguous blocks of '-' characters.
-        column_positions = []
-        in_frame = True
-        column_start = 0
-        for i, c in enumerate(line):
-            if in_frame:
-                if c == '-':
-                    in_frame = False
-                    column_start = i
-            else:
-                if c != '-':
-                    in_frame = True
-                    column_positions.append((column_start, i + 1))
+        columns = ColumnSpec.from_rule(line)
 
         # Assume the next line contains headers, split it into columns.
-        header_line = lines[index + 1]
-        headers = []
-        for start, end in column_positions:
-            headers.append(header_line[start:end].strip())
-        # print(f"Headers: {headers}")
+        headers = columns.values(lines[index + 1])
+        print(f"Headers: {headers}")
         index += 2  # Skip column widths and header lines
+        source = {'headers': headers, 'columns': columns.columns}
 
-        # Collect data from subsequent rows, transposing the table
-        while index < len(lines):
-            line = lines[index]
-            if not line.startswith('  |'):  # End of table
-                break
-            values = []
-            for start, end in column_positions:
-                values.append(line[start:end].strip())
-            # Zip with headers
-            block_lines = []
-            print(f"Headers: {headers}")
-            print(f"Values: {values}")
-            for header, value in zip(headers, values):
-                block_lines.append(f"{header}: {value}")
-            blocks.append(Block(index, index + 1, block_lines))
-            index += 1
-
-    return blocks
+        # Rows are transposed into records by Block.text, when the row is relevant
+        end = index + sum(1 for _ in itertools.takewhile(methodcaller('startswith', '  |'),
+                                                          itertools.islice(lines, index, None)))
+        for row in table_rows(index, end, positions):
+            yield Block(row, row + 1, table=source)
+        index = end
 
 
-def split_blocks(lines: list[str]) -> tuple[str, list[Block]]:
-    """ Find the index of the first line mentioning the relevant security,
-        identify the block separator, and split the blocks accordingly.
+# Split methods splitting blocks a number of lines before each occurrence of a marker
+MARKERS = {
+    'tabular, company name': ('Company Name: ', 0),  # 0000917124-0001398344-18-012935
+    'tabular, security1': ('| Security', 1),
+    'tabular, security2': ('| Security: ', 2),
+}
 
-        :returns: the separator type and the blocks.
-    """
-    needle_index = 0
-    while needle_index < len(lines):
-        line = lines[needle_index]
-        if needle_found(line):
-            break
-        needle_index += 1
-    if needle_index == len(lines):
-        print("No lines mentioning relevant security")
-        return 'none', []
-    print("Line  : " + lines[needle_index])
-    print("Line+1: " + lines[needle_index + 1])
-    if 'Company Name: ' in lines[needle_index]:  # 0000917124-0001398344-18-012935
-        return 'tabular, company name', split_blocks_marker(lines, 'Company Name: ', 0)
-    if '| Security' in lines[needle_index + 1]:
-        return 'tabular, security1', split_blocks_marker(lines, '| Security', 1)
-    if '| Security: ' in lines[needle_index + 2]:
-        return 'tabular, security2', split_blocks_marker(lines, '| Security: ', 2)
-    if '---' in lines[needle_index - 1] and '---' in lines[needle_index + 1]:
-        return 'double_sep, ---', split_block_double_separator(lines, '---')
 
+def is_huge_table(lines: list[str], needle_index: int) -> bool:
     # If we can find 'FOR' or 'AGAINST' at and before or after the needle line, we have a huge table.
     needle_upper = lines[needle_index].upper()
     if 'FOR' in needle_upper or 'AGAINST' in needle_upper:
         around_upper = (lines[needle_index - 1] + " " + lines[needle_index + 1]).upper()
         if 'FOR' in around_upper or 'AGAINST' in around_upper:
-            return 'huge_table', split_blocks_huge_table(lines)
+            return True
     if '| F |' in needle_upper or '| N |' in needle_upper:
         around_upper = (lines[needle_index - 1] + " " + lines[needle_index + 1]).upper()
         if '| F |' in around_upper or '| N |' in around_upper:
-            return 'huge_table', split_blocks_huge_table(lines)
+            return True
+    return False
+
 
-    sep = None
+def find_separator(lines: list[str], needle_index: int) -> str | None:
     for distance in range(1, 25):
         line = lines[needle_index - distance].strip()
         if not line:
             continue
         if re.compile(r"\s*[=_-]{3,}\s*").match(line):
-            sep = line
-            break
+            return line
         if '---' in line:
-            sep = '---'
-            break
+            return '---'
         if '===' in line:
-            sep = '==='
-            break
+            return '==='
         if '___' in line:
-            sep = '___'
-            break
+            return '___'
+    return None
+
+
+def detect_split_method(lines: list[str], needle_index: int) -> str:
+    """ Identify the block separator from the lines around the first line mentioning a security. """
+    for split_method, (marker, offset) in MARKERS.items():
+        if marker in lines[needle_index + offset]:
+            return split_method
+    if '---' in lines[needle_index - 1] and '---' in lines[needle_index + 1]:
+        return 'double_sep, ---'
+    if is_huge_table(lines, needle_index):
+        return 'huge_table'
+    sep = find_separator(lines, needle_index)
     if sep is not None:
-        return f'sep, {sep}', split_blocks_separator(lines, sep)
+        return f'sep, {sep}'
+    return 'indentation'
 
-    return 'indentation', split_blocks_indentation(lines)
 
+def split_method_matches(lines: list[str], tables: list[dict] | None, needle_index: int, split_method: str) -> bool:
+    """
+    Cheap check that a split method used for other filings of the filer fits this filing, looking only at the
+    lines around the needle: the marker of the method is found, the separator is found before the needle (and
+    not right after it, as blocks of two separators would be split apart), the table of the needle was recorded
+    or the layout looks like a huge table, or no separator is found for indentation.
+    """
+    def line(offset: int) -> str:
+        index = needle_index + offset
+        return lines[index] if 0 <= index < len(lines) else ''
+
+    if split_method in MARKERS:
+        marker, offset = MARKERS[split_method]
+        return marker in line(offset)
+    if split_method == 'double_sep, ---':
+        return '---' in line(-1) and '---' in line(1)
+    if split_method == 'huge_table':
+        if tables:
+            return any(table['start'] <= needle_index < table_first_row(table) + len(table['rows']) for table in tables)
+        return 0 < needle_index < len(lines) - 1 and is_huge_table(lines, needle_index)
+    if split_method.startswith('sep, '):
+        sep = split_method[len('sep, '):]
+        return sep not in line(1) and any(sep in line for line in lines[max(0, needle_index - 24):needle_index])
+    if split_method == 'indentation':
+        return find_separator(lines, needle_index) is None
+    return False
+
+
+def split_with_method(lines: list[str], tables: list[dict] | None, positions: list[int],
+                      split_method: str) -> Iterator[Block]:
+    if split_method in MARKERS:
+        return split_blocks_marker(lines, *MARKERS[split_method])
+    if split_method == 'double_sep, ---':
+        return split_block_double_separator(lines, '---')
+    if split_method == 'huge_table':
+        return split_blocks_huge_table(lines, tables, positions)
+    if split_method.startswith('sep, '):
+        return split_blocks_separator(lines, split_method[len('sep, '):])
+    if split_method == 'indentation':
+        return split_blocks_indentation(lines)
+    raise ValueError(f"Unknown split method {split_method}")
+
+
+def split_blocks(lines: list[str], tables: list[dict] | None = None, needles: Needles = DEFAULT_NEEDLES,
+                 positions: list[int] | None = None, cached_methods: Iterable[str] = ()) -> tuple[str, Iterator[Block]]:
+    """ Find the index of the first line mentioning a security of the watchlist,
+        identify the block separator, and split the blocks accordingly.
+        Tables recorded by the HTML conversion, if any, are read instead of parsing their layout.
 
-def split_filing(filename: str, output_filename: str):
-    print(f"\n\n\n---------- {filename} ----------\n")
-    with open(os.path.join('filings', filename), 'r', encoding="utf-8") as f:
-        filing = f.read()
+        :param positions: the lines mentioning a security, see needle_lines.
+        :param cached_methods: split methods used for other filings of the filer, see strategies. The first
+            one that fits the filing (see split_method_matches) is used without detecting the separator.
+        :returns: the separator type and the blocks, split as they are iterated.
+    """
+    if positions is None:
+        positions = needle_lines(lines, needles)
+    if not positions:
+        print("No lines mentioning relevant security")
+        return 'none', iter([])
+    needle_index = positions[0]
+    print("Line  : " + lines[needle_index])
+    print("Line+1: " + lines[needle_index + 1])
+    for split_method in cached_methods:
+        if split_method_matches(lines, tables, needle_index, split_method):
+            print(f"Using the split method of the filer: {split_method}")
+            return split_method, split_with_method(lines, tables, positions, split_method)
+    split_method = detect_split_method(lines, needle_index)
+    return split_method, split_with_method(lines, tables, positions, split_method)
 
-    # Split at the "<TEXT>" line
-    parts = filing.split('<TEXT>\n')
-    filing = parts[1].split('</TEXT>\n')[0]
-    if len(parts) > 2:
-        print("Warning: multiple <TEXT> sections")
+
+def split_filing(filename: str, output_filename: str, needles: Needles = DEFAULT_NEEDLES) -> tuple[str, int]:
+    """
+    Split a filing into blocks, and keep those mentioning the securities of the watchlist: the lines mentioning
+    any of them are found in a single scan, so that the cost does not grow with the number of securities.
+
+    :returns: the split method and the number of blocks mentioning a security (counted once per security).
+    """
+    print(f"\n\n\n---------- {filename} ----------\n")
+    # Extract the first <TEXT> section
+    with Submission(os.path.join('filings', filename)) as submission:
+        text_sections = [section for section in submission.sections() if section.tag == 'TEXT']
+        if len(text_sections) > 1:
+            print("Warning: multiple <TEXT> sections")
+        # Skip the conversion of filings that cannot mention the relevant security
+        raw_filing = submission.read(text_sections[0].start, text_sections[0].end)
+        if not raw_needle_found(raw_filing, needles):
+            print("No lines mentioning relevant security (raw filing)")
+            fmt = filing_format(raw_filing[:4096].decode('utf-8', 'replace').strip())
+            write_blocks(output_filename, filename, fmt, 'none', [], needles)
+            return 'none', 0
+        filing = submission.text(text_sections[0])
 
     # Detect html filing and convert to text
     filing, fmt = ensure_text_filing(filename, filing)
     lines = filing.split('\n')
+    tables = load_tables(filename) if fmt == 'html' else None
+
+    # Extract vote blocks from the filing and write out their offsets
+    # Lines mentioning a security, in one scan of the filing
+    positions = needle_lines(lines, needles)
+    split_method, blocks = split_blocks(lines, tables, needles, positions, strategies.lookup(filename))
+
+    # Keep the blocks mentioning a security, once per security, with the first line mentioning it
+    security_blocks = {key: [] for key in needles.keys}
+    for block in relevant_blocks(blocks, positions):
+        first = bisect.bisect_left(positions, block.needle)
+        last = bisect.bisect_left(positions, block.end, first)
+        for line_index in positions[first:last]:
+            for security in needles.securities(lines[line_index]):
+                if not security_blocks[security] or security_blocks[security][-1].start != block.start:
+                    security_block = copy.copy(block)
+                    security_block.needle = line_index
+                    security_block.security = security
+                    security_blocks[security].append(security_block)
+    security_blocks = [block for key in needles.keys for block in security_blocks[key]]
+    print(f"Found {len(security_blocks)} blocks by method {split_method}")
+
+    write_blocks(output_filename, filename, fmt, split_method, security_blocks, needles)
+    return split_method, len(security_blocks)
+
+
+def write_blocks(output_filename: str, filename: str, fmt: str, split_method: str, blocks: list[Block],
+                 needles: Needles = DEFAULT_NEEDLES):
+    """
+    Write the blocks of a filing as JSON lines: a header, then the offsets of each block, their text being
+    read back from the plain text filing. The rows of a huge table are written as one line per security: the
+    lines of the rows, and where to read the cells from. The header holds the hashes of the files the blocks
+    are read from, see block_sources.
+    The file is written atomically: an interrupted run does not leave a truncated file.
+    """
+    sources = block_sources(filename) if blocks else {}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_filename) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            f.write(json_dumps({'filename': filename, 'format': fmt, 'split_method': split_method,
+                                'watchlist': needles.keys, 'sources': sources}) + "\n")
+            for _, group in itertools.groupby(blocks, key=lambda block: (id(block.table), block.security)):
+                group = list(group)
+                if group[0].table is None:
+                    for block in group:
+                        f.write(json_dumps(block) + "\n")
+                else:
+                    f.write(json_dumps({'table': group[0].table, 'security': group[0].security,
+                                        'rows': [block.start for block in group]}) + "\n")
+        os.replace(tmp_path, output_filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    # Blocks written before the JSON lines format
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.splitext(output_filename)[0] + '.json')
+
+
+def blocks_file(filename: str) -> str:
+    return os.path.join('blocks', filename).replace('.txt', '.jsonl')
+
+
+def block_sources(filename: str) -> dict[str, str]:
+    """ :returns: the hashes of the plain text filing and of its tables sidecar, if any, by path. """
+    paths = [os.path.join('plain', filename), tables_file(filename)]
+    return {path: manifest.file_hash(path) for path in paths if filing_store.exists(path)}
+
+
+class StaleBlocksError(Exception):
+    """ The plain text filing changed since its blocks were split: their offsets are not valid anymore. """
+
+
+class FilingBlocks:
+    """
+    Blocks of a filing, as written by write_blocks. Iterating yields the blocks with their text, read on
+    demand from the plain text filing or the tables sidecar: only the lines of the blocks are read.
+    Blocks written in the previous format (blocks/x.json, with the lines of each block) are read as well.
 
-    # Extract vote blocks from the filing and write them out as JSON
-    split_method, blocks = split_blocks(lines)
-    print(f"Found {len(blocks)} blocks by method {split_method}")
-
-    # Filter out blocks that do not mention TSLA or TESLA
-    relevant_blocks = []
-    for block in blocks:
-        # Find the line index of the first line mentioning TSLA or TESLA
-        for line_index in range(block.start, block.end):
-            if needle_found(lines[line_index]):
-                block.needle = line_index
-                relevant_blocks.append(block)
-                break
+    :param security: key of the security whose blocks are read, all of them by default. Blocks written before
+        the watchlist are not tagged with a security, and are always read.
+    :raises StaleBlocksError: if the plain text filing or its tables changed since the blocks were split.
+    """
 
-    with open(output_filename, 'w', encoding="utf-8") as f:
-        f.write(json_dumps({
-            'filename': filename,
-            'format': fmt,
-            'split_method': split_method,
-            'blocks': relevant_blocks,
-        }, indent=2))
-
-
-def split_filings():
-    for filename in os.listdir('filings'):
-        if filename.endswith('.txt'):
-            output_filename = os.path.join('blocks', filename)
-            output_filename = output_filename.replace('.txt', '.json')
-            if os.path.exists(output_filename):
-                print(f"Skipping {filename}")
+    def __init__(self, filename: str, security: str | None = None):
+        self.filename = os.path.basename(filename)
+        self.lines = None
+        self.sidecar_lines = None
+        self.sidecar_tables = {}
+        self.legacy_lines = None
+        self.blocks = []
+        try:
+            with open(blocks_file(self.filename), 'r', encoding='utf-8') as f:
+                self.header = json.loads(f.readline())
+                records = [json.loads(line) for line in f]
+        except FileNotFoundError:
+            with open(blocks_file(self.filename).replace('.jsonl', '.json'), 'r', encoding='utf-8') as f:
+                self.header = json.load(f)
+            records = self.header.pop('blocks')
+            self.legacy_lines = []
+        for path, source_hash in self.header.get('sources', {}).items():
+            if not filing_store.exists(path) or manifest.file_hash(path) != source_hash:
+                raise StaleBlocksError(f"{path} changed since the blocks of {self.filename} were split")
+        for record in records:
+            if security is not None and record.get('security', security) != security:
+                continue
+            if 'rows' in record:
+                for row in record['rows']:
+                    block = Block(row, row + 1, table=record['table'])
+                    block.needle = row
+                    block.security = record.get('security')
+                    self.blocks.append(block)
             else:
-                split_filing(filename, output_filename)
+                block = Block(record['start'], record['end'])
+                block.needle = record.get('needle')
+                block.security = record.get('security')
+                self.blocks.append(block)
+                if self.legacy_lines is not None:
+                    self.legacy_lines.append(record['lines'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for lines in [self.lines, self.sidecar_lines]:
+            if lines is not None:
+                lines.close()
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __iter__(self) -> Iterator[tuple[Block, str]]:
+        for index, block in enumerate(self.blocks):
+            if self.legacy_lines is not None:
+                yield block, "\n".join(self.legacy_lines[index])
+                continue
+            if block.table is not None and 'sidecar' in block.table:
+                table = self.sidecar_table(block.table['sidecar'])
+                block.headers = table['headers']
+                block.values = table['rows'][block.start - table_first_row(table)]
+            else:
+                if self.lines is None:
+                    self.lines = PlainLines(os.path.join('plain', self.filename))
+            yield block, block.text(self.lines)
+
+    def sidecar_table(self, index: int) -> dict:
+        """ Table `index` of the tables sidecar: the sidecar has a table per line. """
+        if index not in self.sidecar_tables:
+            if self.sidecar_lines is None:
+                self.sidecar_lines = PlainLines(tables_file(self.filename))
+            self.sidecar_tables[index] = json.loads(self.sidecar_lines[index])
+        return self.sidecar_tables[index]
+
+
+def split_filing_job(args: tuple[str, bool, Needles]) -> tuple[str, str, str | None, str, float, str]:
+    """
+    Worker entry point: split a filing unless its blocks are up to date with the filing and the splitting code,
+    and record them in the manifest. Errors are caught so that they do not stop the other filings.
+
+    :returns: the filename, what was done ('split', 'cached' or 'failed'), the split method if the filing was
+        split, the split method and number of blocks or the formatted error, the processing time, and what the
+        splitting printed.
+    """
+    filename, force, needles = args
+    start_time = time.perf_counter()
+    log = io.StringIO()
+    # Blocks depend on the watchlist as well
+    version = f"{STAGE_VERSION}, watchlist {needles.digest}"
+    try:
+        with contextlib.redirect_stdout(log):
+            output_filename = blocks_file(filename)
+            input_hash = manifest.file_hash(os.path.join('filings', filename))
+            if not force and manifest.is_fresh('blocks', filename, input_hash, version, [output_filename],
+                                               adopt=True):
+                return filename, 'cached', None, '', time.perf_counter() - start_time, log.getvalue()
+            split_method, block_count = split_filing(filename, output_filename, needles)
+            manifest.record('blocks', filename, input_hash, version, [output_filename])
+        return (filename, 'split', split_method, f"{block_count} blocks by method {split_method}",
+                time.perf_counter() - start_time, log.getvalue())
+    except Exception:
+        return filename, 'failed', None, traceback.format_exc(), time.perf_counter() - start_time, log.getvalue()
+
+
+def split_filings(filenames: list[str], jobs: int, force: bool = False, verbose: bool = False,
+                  needles: Needles = DEFAULT_NEEDLES) -> list[str]:
+    """
+    Split filings on a pool of `jobs` processes, largest filings first so that they do not end up running
+    alone at the end. Failures are reported at the end instead of stopping the run.
+    Each filing is scanned once for all the securities of the watchlist.
+    The split methods are recorded for the filers once all the filings are split, so that the filings of a run
+    are split the same way whatever the order in which the processes handle them.
+
+    :returns: the names of the filings that could not be split.
+    """
+    filenames = sorted(filenames, key=lambda name: filing_store.size(os.path.join('filings', name)), reverse=True)
+    failed = {}
+    counts = {'split': 0, 'cached': 0}
+    split_methods = {}
+    start_time = time.perf_counter()
+    with Pool(jobs) as pool:
+        results = pool.imap_unordered(split_filing_job, [(filename, force, needles) for filename in filenames])
+        for filename, status, split_method, detail, elapsed, log in results:
+            if verbose:
+                print(log, end='')
+            if status == 'failed':
+                print(f"Error splitting {filename}:\n{detail}", file=sys.stderr)
+                failed[filename] = detail.strip().split('\n')[-1]
+                continue
+            counts[status] += 1
+            if status == 'split':
+                print(f"{filename}: {detail} in {elapsed:.2f}s")
+                if split_method != 'none':
+                    split_methods[filename] = split_method
+    for filename, split_method in sorted(split_methods.items()):
+        strategies.record(filename, split_method)
+    print(f"Split {counts['split']} filings in {time.perf_counter() - start_time:.2f}s "
+          f"({counts['cached']} up to date, {len(failed)} failed)")
+    if failed:
+        width = max(len(filename) for filename in failed)
+        print(f"\n{'Failed filing':<{width}}  Error")
+        for filename, error in sorted(failed.items()):
+            print(f"{filename:<{width}}  {error}")
+    return list(failed)
+
+
+class TestSplitBlocks(unittest.TestCase):
+
+    VOTES = ''.join(f"<p>Fund {i}</p><p>Apple Inc</p><p>For</p>" for i in range(10))
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        for directory in ['filings', 'plain', 'blocks']:
+            os.makedirs(directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def write_filing(filename: str, text: str):
+        with open(os.path.join('filings', filename), 'w', encoding='utf-8') as f:
+            f.write(f"<DOCUMENT>\n<TYPE>N-PX\n<TEXT>\n{text}\n</TEXT>\n</DOCUMENT>\n")
+
+    def test_huge_table_sidecar(self):
+        html_content = "<html><body><p>Votes</p><table><tr><th>Issuer</th><th>Proposal</th><th>Vote</th></tr>"
+        for issuer, vote in [("Tesla Inc", "For"), ("Apple Inc", "Against"), ("TESLA INC", "Against")]:
+            html_content += f"<tr><td>{issuer}</td><td>Elect Director</td><td>{vote}</td></tr>"
+        html_content += "</table><p>More votes</p><table><tr><th>Name</th><th>Vote</th></tr>"
+        html_content += "<tr><td>TSLA</td><td>For</td></tr></table></body></html>"
+        buffer = io.StringIO()
+        tables = io.StringIO()
+        html_to_plain(html_content, buffer, tables)
+        lines = buffer.getvalue().split('\n')
+        tables = [json.loads(line) for line in tables.getvalue().splitlines()]
+        expected = [(block.to_dict(), block.text(lines)) for block in split_blocks_huge_table(lines)]
+        self.assertEqual(4, len(expected))
+        self.assertEqual("Issuer: Tesla Inc\nProposal: Elect Director\nVote: For", expected[0][1])
+        self.assertEqual(expected, [(block.to_dict(), block.text(lines))
+                                    for block in split_blocks_huge_table(lines, tables)])
+        # Only the rows on the needle lines
+        positions = needle_lines(lines)
+        relevant = [item for item in expected if item[0]['start'] in positions]
+        self.assertEqual(3, len(relevant))
+        for huge_tables in [None, tables]:
+            self.assertEqual(relevant, [(block.to_dict(), block.text(lines))
+                                        for block in split_blocks_huge_table(lines, huge_tables, positions)])
+
+    def test_column_spec(self):
+        columns = ColumnSpec.from_rule("  | ------ | -- | ---")
+        self.assertEqual([(4, 11), (13, 16)], columns.columns)  # Dashes ending the line are not a column
+        self.assertEqual(["Tesla", "For"], columns.values("  | Tesla  | For | x"))
+        self.assertEqual(["Tesla"], ColumnSpec([(4, 11)]).values("  | Tesla  | For |"))
+        self.assertEqual([], ColumnSpec.from_rule("  |").values("  | Tesla"))
+
+    def test_relevant_blocks(self):
+        lines = [f"{'' if i % 3 == 0 else '  '}{'Tesla' if i % 7 == 0 else 'Apple'} {i}" for i in range(100)]
+        lines[95], lines[96], lines[97] = "  TSLAX tesla", "  TSLA", "TE\u017fLA"
+        positions = needle_lines(lines)
+        self.assertEqual([i for i, line in enumerate(lines) if needle_found(line)], positions)
+        expected = []
+        for block in split_blocks_indentation(lines):
+            needle = next((i for i in range(block.start, block.end) if needle_found(lines[i])), None)
+            if needle is not None:
+                expected.append((block.start, block.end, needle))
+        self.assertEqual(expected, [(block.start, block.end, block.needle)
+                                    for block in relevant_blocks(split_blocks_indentation(lines), positions)])
+        self.assertEqual([], list(relevant_blocks(split_blocks_indentation(lines), [])))
+
+    def test_raw_needle_found(self):
+        for fragment in ["Tesla", "tsla", "T<b>esla</b>", "&#84;esla", "&#x54;&#X53LA", "TE<!-- <a> -->SLA",
+                         "te\u017fla", "&#x17F;la", "&amp;TSLA", "TESLA&#65;", "Tes<span\nclass=x>la</span> Inc",
+                         "Apple", "<i>A</i>TSLA", "TSLA<b>X</b>", "<p>Te</p><p>sla</p>", "<pre><TSLA></pre>"]:
+            html_content = f"<html><body><p>Votes of {fragment} shares</p></body></html>"
+            buffer = io.StringIO()
+            html_to_plain(html_content, buffer)
+            raw_match = raw_needle_found(html_content.encode('utf-8'))
+            if needle_found(buffer.getvalue()):
+                self.assertTrue(raw_match, fragment)
+            if fragment == "Apple":
+                self.assertFalse(raw_match, fragment)
+        for letter, folds in CASE_FOLDS.items():
+            pattern = re.compile(letter, re.IGNORECASE)
+            self.assertEqual(folds, ''.join(chr(code) for code in range(0x80, 0x110000)
+                                            if pattern.fullmatch(chr(code))))
+
+    def test_split_filing_prefilter(self):
+        self.write_filing('apple.txt', f"<html><body>{self.VOTES}</body></html>")
+        self.write_filing('tesla.txt', f"<html><body>{self.VOTES}<p>Te<b>sla</b></p>{self.VOTES}</body></html>")
+        for filename in ['apple.txt', 'tesla.txt']:
+            split_filing(filename, blocks_file(filename))
+        with FilingBlocks('apple.txt') as blocks:
+            self.assertEqual(('html', 'none'), itemgetter('format', 'split_method')(blocks.header))
+        self.assertFalse(filing_store.exists(os.path.join('plain', 'apple.txt')))
+        self.assertTrue(filing_store.exists(os.path.join('plain', 'tesla.txt')))
+
+    def test_split_filings(self):
+        self.write_filing('tesla.txt', f"<html><body>{self.VOTES}<p>Tesla</p>{self.VOTES}</body></html>")
+        with open(os.path.join('filings', 'broken.txt'), 'w', encoding='utf-8') as f:
+            f.write("<DOCUMENT>\n<TYPE>N-PX\n</DOCUMENT>\n")  # No <TEXT>
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(['broken.txt'], split_filings(['broken.txt', 'tesla.txt'], jobs=2))
+        self.assertEqual(['tesla.jsonl'], os.listdir('blocks'))
+        self.assertEqual(('tesla.txt', 'cached'), split_filing_job(('tesla.txt', False, DEFAULT_NEEDLES))[:2])
+        self.assertEqual(('tesla.txt', 'split'), split_filing_job(('tesla.txt', True, DEFAULT_NEEDLES))[:2])
+        # A different watchlist splits the filing again
+        needles = Needles([TESLA, Issuer('AAPL', names=['Apple Inc'])])
+        self.assertEqual(('tesla.txt', 'split'), split_filing_job(('tesla.txt', False, needles))[:2])
+
+    def test_watchlist(self):
+        needles = Needles([TESLA, Issuer('AAPL', names=['Apple, Inc.'], tickers=['AAPL'])])
+        self.assertEqual(['TSLA', 'AAPL', 'TSLA'], needles.securities("Tesla vs Apple, Inc. (TSLA)"))
+        self.assertEqual([], needles.securities("Teslas and Apple, Incorporated"))
+        # Overlapping needles of different securities, in either order
+        apple = Issuer('AAPL', names=['Apple'])
+        apple_hospitality = Issuer('APLE', names=['Apple Hospitality REIT'])
+        for issuers in [[apple, apple_hospitality], [apple_hospitality, apple]]:
+            self.assertEqual(['APLE', 'AAPL'], Needles(issuers).securities("Apple Hospitality REIT, Inc. vs Apple"))
+        self.assertEqual([b'tsla', b'tesla', b'apple', b'aapl'], needles.words)
+        self.assertTrue(raw_needle_found(b"<p>A<b>APL</b></p>", needles))
+        self.assertFalse(raw_needle_found(b"<p>A<b>APL</b></p>"))
+        self.write_filing('sep.txt', f"<html><body>{self.VOTES}<p>---</p><p>Tesla</p><p>For</p><p>---</p>"
+                                     f"<p>AAPL</p><p>Against</p><p>---</p><p>Apple, Inc. and TSLA</p><p>---</p>"
+                                     f"{self.VOTES}</body></html>")
+        split_filing('sep.txt', blocks_file('sep.txt'), needles)
+        with FilingBlocks('sep.txt') as filing_blocks:
+            self.assertEqual(['TSLA', 'AAPL'], filing_blocks.header['watchlist'])
+            tagged = [(block.security, text) for block, text in filing_blocks]
+        self.assertEqual([('TSLA', "---\nTesla\nFor"), ('TSLA', "---\nApple, Inc. and TSLA"),
+                          ('AAPL', "---\nAAPL\nAgainst"), ('AAPL', "---\nApple, Inc. and TSLA")], tagged)
+        with FilingBlocks('sep.txt', security='AAPL') as filing_blocks:
+            self.assertEqual(tagged[2:], [(block.security, text) for block, text in filing_blocks])
+
+    def test_cached_split_method(self):
+        votes = "\n".join(f"Fund {i}\n---\nApple\nFor" for i in range(5))
+        self.write_filing('0000000001-0000000002-18-000001.txt', f"{votes}\n---\nTesla\nFor\n---\n{votes}")
+        # Two filings of the filer split in the same run are detected independently, and recorded afterwards
+        self.write_filing('0000000001-0000000002-18-000002.txt', f"{votes}\n===\nTesla\nFor\n===\n{votes}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual([], split_filings(['0000000001-0000000002-18-000001.txt',
+                                                '0000000001-0000000002-18-000002.txt'], jobs=2))
+        for filename, split_method in [('0000000001-0000000002-18-000001.txt', 'sep, ---'),
+                                       ('0000000001-0000000002-18-000002.txt', 'sep, ===')]:
+            with FilingBlocks(filename) as filing_blocks:
+                self.assertEqual(split_method, filing_blocks.header['split_method'])
+        self.assertEqual(['sep, ==='], strategies.lookup('0000000001-0000000002-19-000001.txt'))
+        strategies.record('0000000001-0000000002-18-000001.txt', 'sep, ---')
+        # Next year, the filer separates blocks with two lines: detection wins, the vote stays in the block
+        filing = f"{votes}\n---\nTesla\n---\nAgainst\n{votes}"
+        self.write_filing('0000000001-0000000002-19-000001.txt', filing)
+        self.assertEqual(('double_sep, ---', 1), split_filing('0000000001-0000000002-19-000001.txt',
+                                                              blocks_file('0000000001-0000000002-19-000001.txt')))
+        with FilingBlocks('0000000001-0000000002-19-000001.txt') as filing_blocks:
+            self.assertEqual([["Tesla", "---", "Against"]],
+                             [text.split('\n')[1:4] for block, text in filing_blocks])
+        # A nearer separator is detected, but the separator of the filer is found as well
+        filing = f"{votes}\n---\nFund 5\n=====\nTesla\nFor\n---\n{votes}"
+        lines = filing.split('\n')
+        self.assertEqual('sep, =====', detect_split_method(lines, needle_lines(lines)[0]))
+        self.write_filing('0000000001-0000000002-20-000001.txt', filing)
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            self.assertEqual(('sep, ---', 1), split_filing('0000000001-0000000002-20-000001.txt', 'c.jsonl'))
+        self.assertIn("Using the split method of the filer: sep, ---", log.getvalue())
+        # The separator of the filer is not found
+        self.write_filing('0000000001-0000000002-21-000001.txt', filing.replace('---', ''))
+        self.assertEqual(('sep, =====', 1), split_filing('0000000001-0000000002-21-000001.txt', 'd.jsonl'))
+        # split_filing does not record the split method
+        self.assertEqual(['sep, ---'], strategies.lookup('0000000001-0000000003-22-000001.txt'))
+
+    def test_filing_blocks(self):
+        table = ("<table><tr><th>Issuer</th><th>Vote</th></tr>" +
+                 "".join(f"<tr><td>{issuer}</td><td>For</td></tr>" for issuer in ["Apple", "Tesla", "Ford"]) +
+                 "</table>")
+        self.write_filing('sep.txt', f"<html><body>{self.VOTES}<p>---</p><p>Tesla</p><p>For</p><p>---</p>"
+                                     f"{self.VOTES}<p>TSLA</p></body></html>")
+        self.write_filing('table.txt', f"<html><body>{self.VOTES}{table}{table}</body></html>")
+        self.write_filing('layout.txt', "Votes\n  | ------ | ---- |\n  | Issuer | Vote |\n  | Tesla  | For  |\n"
+                                        "  | Apple  | For  |\n  | TSLA   | For  |\n\nEnd")
+        for filename in ['sep.txt', 'table.txt', 'layout.txt']:
+            split_filing(filename, blocks_file(filename))
+            with filing_store.open_text(os.path.join('plain', filename)) as f:
+                lines = f.read().split('\n')
+            split_method, blocks = split_blocks(lines, load_tables(filename))
+            expected = [(block.start, block.end, block.text(lines)) for block in blocks
+                        if any(needle_found(line) for line in lines[block.start:block.end])]
+            with FilingBlocks(filename) as filing_blocks:
+                self.assertEqual(split_method, filing_blocks.header['split_method'])
+                self.assertEqual(expected, [(block.start, block.end, text) for block, text in filing_blocks])
+            self.assertEqual(2, len(expected))
+        with open(blocks_file('table.txt'), 'r', encoding='utf-8') as f:
+            f.readline()
+            self.assertEqual([{'sidecar': 0}, {'sidecar': 1}], [json.loads(line)['table'] for line in f])
+        with open(blocks_file('layout.txt'), 'r', encoding='utf-8') as f:
+            f.readline()
+            table = {'headers': ['Issuer', 'Vote'], 'columns': [[4, 11], [13, 18]]}
+            self.assertEqual([{'table': table, 'security': 'TSLA', 'rows': [3, 5]}], [json.loads(line) for line in f])
+        # Converted again since the blocks were split
+        with filing_store.open_write(os.path.join('plain', 'layout.txt')) as f:
+            f.write("Votes\n")
+        with self.assertRaises(StaleBlocksError):
+            FilingBlocks('layout.txt')
+        # Previous format
+        os.remove(blocks_file('sep.txt'))
+        with open(os.path.join('blocks', 'sep.json'), 'w', encoding='utf-8') as f:
+            json.dump({'filename': 'sep.txt', 'format': 'html', 'split_method': 'sep, ---',
+                       'blocks': [{'start': 1, 'end': 3, 'lines': ["Tesla", "For"]}]}, f, indent=2)
+        with FilingBlocks('sep.txt') as filing_blocks:
+            self.assertEqual([(1, 3, "Tesla\nFor")], [(block.start, block.end, text) for block, text in filing_blocks])
 
 
 def main():
@@ -274,7 +936,14 @@ def main():
         prog='split_blocks',
         description='Split blocks from filings')
     parser.add_argument('-c', '--clear', action='store_true')
-    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the details of the splitting of each filing')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of filings split in parallel')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='split filings again even if their blocks are up to date')
+    parser.add_argument('-w', '--watchlist', type=str, metavar='PATH',
+                        help='JSON watchlist of the securities to extract blocks for (default: Tesla)')
     parser.add_argument('-t', '--test', action='store_true')
     parser.add_argument('filings', metavar='FILING', type=str, nargs='*',
                         help='names of the filings to split (no path, with ext)')
@@ -290,17 +959,16 @@ def main():
 
     if args.clear:
         for filename in os.listdir('blocks'):
-            if filename.endswith('.json'):
+            if filename.endswith('.json') or filename.endswith('.jsonl'):
                 os.remove(os.path.join('blocks', filename))
 
+    needles = Needles(load_watchlist(args.watchlist) if args.watchlist else DEFAULT_WATCHLIST)
     if args.filings:
-        for filename in args.filings:
-            output_filename = os.path.join('blocks', filename)
-            output_filename = output_filename.replace('.txt', '.json')
-            split_filing(filename, output_filename)
+        failed = split_filings(args.filings, args.jobs, force=True, verbose=args.verbose, needles=needles)
     else:
-        split_filings()
-    exit(0)
+        filenames = [filename for filename in filing_store.listdir('filings') if filename.endswith('.txt')]
+        failed = split_filings(filenames, args.jobs, args.force, args.verbose, needles)
+    exit(1 if failed else 0)
 
 
 # main
@@ -0,0 +1,138 @@
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+# Split methods of the filers, so that their filings of other years are split the same way.
+#
+# Filings are named <CIK>-<accession number>.txt, the accession number starting with the CIK of the filer agent
+# which submitted the filing. The split method of a filing is recorded for its CIK and its filer agent:
+# split_blocks tries the method of the CIK, then of the filer agent, before detecting the separator.
+STRATEGIES_PATH = os.environ.get('STRATEGIES_PATH', 'strategies.sqlite')
+
+FILENAME_RE = re.compile(r'(\d+)-(\d{10})-\d{2}-\d+')
+
+
+def _connect() -> sqlite3.Connection:
+    # Filings are split in several processes: wait for the other writers
+    conn = sqlite3.connect(STRATEGIES_PATH, timeout=60)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS strategies (
+        filer TEXT PRIMARY KEY,
+        split_method TEXT,
+        filename TEXT
+    )""")
+    return conn
+
+
+def filer_keys(filename: str) -> list[str]:
+    """ :returns: the keys of the CIK and filer agent of a filing, most specific first. """
+    match = FILENAME_RE.fullmatch(os.path.splitext(os.path.basename(filename))[0])
+    if match is None:
+        return []
+    return [f"cik:{match[1]}", f"agent:{match[2]}"]
+
+
+def lookup(filename: str) -> list[str]:
+    """ :returns: the split methods recorded for the CIK and filer agent of a filing, most specific first. """
+    keys = filer_keys(filename)
+    if not keys:
+        return []
+    conn = _connect()
+    try:
+        methods = dict(conn.execute(f"SELECT filer, split_method FROM strategies "
+                                    f"WHERE filer IN ({', '.join('?' * len(keys))})", keys).fetchall())
+    finally:
+        conn.close()
+    return list(dict.fromkeys(methods[key] for key in keys if key in methods))
+
+
+def record(filename: str, split_method: str):
+    """ Record the split method of a filing for its CIK and filer agent. """
+    keys = filer_keys(filename)
+    if not keys:
+        return
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO strategies (filer, split_method, filename) VALUES (?, ?, ?)",
+                             [(key, split_method, os.path.basename(filename)) for key in keys])
+    finally:
+        conn.close()
+
+
+def forget(filer: str | None = None):
+    """ Forget the split method of a filer (cik:... or agent:...), or of all, so that it is detected again. """
+    conn = _connect()
+    try:
+        with conn:
+            if filer is None:
+                conn.execute("DELETE FROM strategies")
+            else:
+                conn.execute("DELETE FROM strategies WHERE filer = ?", (filer,))
+    finally:
+        conn.close()
+
+
+class TestStrategies(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_filer_keys(self):
+        self.assertEqual(['cik:0000917124', 'agent:0001398344'],
+                         filer_keys('filings/0000917124-0001398344-18-012935.txt'))
+        self.assertEqual([], filer_keys('tesla.txt'))
+
+    def test_lookup(self):
+        self.assertEqual([], lookup('0000917124-0001398344-18-012935.txt'))
+        record('0000917124-0001398344-18-012935.txt', 'sep, ---')
+        self.assertEqual(['sep, ---'], lookup('0000917124-0001398344-19-000001.txt'))
+        # Other fund of the same filer agent
+        self.assertEqual(['sep, ---'], lookup('0000071516-0001398344-19-000002.txt'))
+        record('0000071516-0001398344-19-000002.txt', 'indentation')
+        self.assertEqual(['sep, ---', 'indentation'], lookup('0000917124-0001398344-20-000003.txt'))
+        forget('agent:0001398344')
+        self.assertEqual(['sep, ---'], lookup('0000917124-0000000000-20-000003.txt'))
+        record('tesla.txt', 'sep, ---')
+        self.assertEqual([], lookup('tesla.txt'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='strategies',
+        description='Split methods of the filers')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('command', nargs='?', choices=['status', 'forget'])
+    parser.add_argument('filer', nargs='?', help='filer to forget (cik:... or agent:...), all by default')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    if args.command == 'status':
+        conn = _connect()
+        for split_method, ciks, agents in conn.execute(
+                "SELECT split_method, SUM(filer LIKE 'cik:%'), SUM(filer LIKE 'agent:%') FROM strategies "
+                "GROUP BY split_method ORDER BY split_method"):
+            print(f"{split_method}: {ciks} CIKs, {agents} filer agents")
+        conn.close()
+    elif args.command == 'forget':
+        forget(args.filer)
+    exit(0)
+
+
+# main
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,100 @@
+import json
 import os
 import re
 import unittest
 
-from html_to_plain import html_to_plain
+import filing_store
+import html_engines
+import manifest
+from html_to_plain import VERSION as HTML_TO_PLAIN_VERSION
 
 
-def ensure_text_filing(filename: str, filing: str) -> tuple[str, str]:
-    filename = os.path.basename(filename)
-    filing = filing.strip()
+def tables_file(filename: str) -> str:
+    """ Path of the sidecar holding the tables of the plain text conversion of an HTML filing. """
+    return os.path.join('plain', os.path.splitext(os.path.basename(filename))[0] + '.tables.jsonl')
+
+
+def load_tables(filename: str) -> list[dict] | None:
+    """ Tables recorded by html_to_plain for the filing, or None if they were not recorded. """
+    path = tables_file(filename)
+    if not filing_store.exists(path):
+        return None
+    with filing_store.open_text(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def filing_format(filing: str) -> str:
+    """ :returns: 'html' if the (stripped) text of the filing is an HTML document, 'plain' otherwise. """
     first_line_end = filing.find('\n')
     first_line = filing[:first_line_end].lower()
     if first_line.startswith('<html>') or first_line.startswith('<!doctype html'):
-        fmt = 'html'
-        plain_file = os.path.join('plain', filename)
-        if os.path.exists(plain_file):
-            print("Using cached HTML conversion")
+        return 'html'
+    return 'plain'
+
+
+def convert_html_filing(filename: str, filing: str, text_hash: str | None = None):
+    """
+    Convert an HTML filing to plain/, with its tables sidecar. Files are written atomically.
+    The engine is the one recorded for the filing by compare_engines.py, if any and if it was compared on
+    the same text (of hash `text_hash`, see manifest.text_hash).
+    """
+    # Using html2text (unsatisfactory, table layout is sometimes broken):
+    #   h = html2text.HTML2Text()
+    #   h.body_width = 0  # Disable line wrapping -- 0001314414-0001580642-18-003578.txt
+    #   h.pad_tables = True  # Enable table padding -- 0001314414-0001580642-18-003578.txt
+    #   filing = h.handle(filing)
+    #
+    # Using pandoc (unsatisfactory, no support for multiple table header rows):
+    #   with tempfile.NamedTemporaryFile(suffix=".html", mode='w', encoding='utf-8') as temp_html_file:
+    #       temp_html_file.write(filing)
+    #       temp_html_path = temp_html_file.name
+    #       subprocess.run(["pandoc", temp_html_path, "-f", "html", "-t", "plain", "-o", plain_file])
+    plain_file = os.path.join('plain', os.path.basename(filename))
+    engine = html_engines.engine_for(filename, text_hash or manifest.text_hash(filing))
+    with filing_store.open_write(plain_file) as f, filing_store.open_write(tables_file(filename)) as tables:
+        html_engines.convert(filing, f, tables, engine)
+
+
+def update_text_filing(filename: str, filing: str, fmt: str, force: bool = False) -> bool:
+    """
+    Write the plain text version of a (stripped) filing to plain/, unless the manifest shows it is up to date.
+
+    :returns: True if it was written.
+    """
+    filename = os.path.basename(filename)
+    plain_file = os.path.join('plain', filename)
+    if fmt == 'html':
+        outputs = [plain_file, tables_file(filename)]
+        version = f"html_to_plain {HTML_TO_PLAIN_VERSION}"
+    else:
+        outputs = [plain_file]
+        version = 'copy'
+    input_hash = manifest.text_hash(filing)
+    if not force and manifest.is_fresh('plain', filename, input_hash, version, outputs, adopt=True):
+        return False
+    if fmt == 'html':
+        convert_html_filing(filename, filing, input_hash)
+    else:
+        with filing_store.open_write(plain_file) as f:
+            f.write(filing)
+    manifest.record('plain', filename, input_hash, version, outputs)
+    return True
+
+
+def ensure_text_filing(filename: str, filing: str) -> tuple[str, str]:
+    filename = os.path.basename(filename)
+    filing = filing.strip()
+    fmt = filing_format(filing)
+    if fmt == 'html':
+        if update_text_filing(filename, filing, fmt):
+            print("Converted HTML filing")
         else:
-            print("Converting HTML filing")
-            # Using html2text (unsatisfactory, table layout is sometimes broken):
-            #   h = html2text.HTML2Text()
-            #   h.body_width = 0  # Disable line wrapping -- 0001314414-0001580642-18-003578.txt
-            #   h.pad_tables = True  # Enable table padding -- 0001314414-0001580642-18-003578.txt
-            #   filing = h.handle(filing)
-            #
-            # Using pandoc (unsatisfactory, no support for multiple table header rows):
-            #   with tempfile.NamedTemporaryFile(suffix=".html", mode='w', encoding='utf-8') as temp_html_file:
-            #       temp_html_file.write(filing)
-            #       temp_html_path = temp_html_file.name
-            #       subprocess.run(["pandoc", temp_html_path, "-f", "html", "-t", "plain", "-o", plain_file])
-            with open(plain_file, 'w', encoding="utf-8") as f:
-                html_to_plain(filing, f)
-        with open(plain_file, 'r', encoding="utf-8") as f:
+            print("Using cached HTML conversion")
+        with filing_store.open_text(os.path.join('plain', filename)) as f:
             filing = f.read()
     else:
         print("Using plain text filing")
-        fmt = 'plain'
-        plain_file = os.path.join('plain', filename)
-        if not os.path.exists(plain_file):
-            with open(plain_file, 'w', encoding="utf-8") as f:
-                f.write(filing)
+        update_text_filing(filename, filing, fmt)
     return filing, fmt
 
 
@@ -0,0 +1,102 @@
+import json
+import re
+import unittest
+
+
+def normalize_name(text: str) -> str:
+    # Case-insensitive, ignore non-alphanum
+    return re.sub(r'[^A-Z0-9]', '', text.upper())
+
+
+class Issuer:
+    """
+    A security of interest, with the identifiers used to find it in filings.
+    """
+
+    def __init__(self, key: str, names: list[str], cusips: list[str] = None, isins: list[str] = None,
+                 tickers: list[str] = None, needles: list[str] = None,
+                 exclude_meeting_dates: list[str] = None, exclude_votes: str = None):
+        self.key = key
+        self.names = names
+        self.cusips = cusips or []
+        self.isins = isins or []
+        self.tickers = tickers or []
+        # Words identifying the issuer in plain text filings
+        self.needles = needles or names + self.tickers
+        self.exclude_meeting_dates = set(exclude_meeting_dates or [])
+        # We exclude irrelevant votes rather than attempting to match all relevant votes
+        # since there are many different formulations of the proposals.
+        self.exclude_votes = re.compile(exclude_votes, re.IGNORECASE) if exclude_votes else None
+
+    def match_vote(self, text: str) -> bool:
+        """ Return True if the vote is relevant, based on its description. """
+        return self.exclude_votes is None or not self.exclude_votes.search(text)
+
+    def __str__(self):
+        return self.key
+
+
+TESLA = Issuer(
+    'TSLA', ['Tesla, Inc.'], cusips=['88160R101'], isins=['US88160R1014'], tickers=['TSLA'],
+    needles=['TSLA', 'TESLA'],
+    # Exclude votes from 2023-05-16
+    exclude_meeting_dates=['05/16/2023'],
+    exclude_votes=r'stockholder proposal|shareholder proposal|s/h proposal|appointment|james murdoch|kimbal musk|non.*binding|delaware|metrics|director|harassment|electromagnetic|collective|non-interference|simple majority|sustainability|moratorium|miscellaneous|auditor')
+
+DEFAULT_WATCHLIST = [TESLA]
+
+
+def load_watchlist(path: str) -> list[Issuer]:
+    """
+    Load issuers from a JSON file, a list of objects with the arguments of Issuer, e.g.
+    [{"key": "AAPL", "names": ["Apple Inc."], "cusips": ["037833100"], "tickers": ["AAPL"]}]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [Issuer(**entry) for entry in json.load(f)]
+
+
+class IssuerIndex:
+    """
+    Hash index over the names, CUSIPs and ISINs of a watchlist: matching costs the same for one issuer or many.
+    """
+
+    def __init__(self, issuers: list[Issuer]):
+        self.issuers = issuers
+        self.by_name = {}
+        self.by_cusip = {}
+        self.by_isin = {}
+        for issuer in issuers:
+            for name in issuer.names:
+                self.by_name[normalize_name(name)] = issuer
+            for cusip in issuer.cusips:
+                self.by_cusip[cusip.upper()] = issuer
+            for isin in issuer.isins:
+                self.by_isin[isin.upper()] = issuer
+
+    def match(self, name: str | None, cusip: str | None = None, isin: str | None = None) -> Issuer | None:
+        if cusip:
+            issuer = self.by_cusip.get(cusip.strip().upper())
+            if issuer is not None:
+                return issuer
+        if isin:
+            issuer = self.by_isin.get(isin.strip().upper())
+            if issuer is not None:
+                return issuer
+        if name:
+            return self.by_name.get(normalize_name(name))
+        return None
+
+
+class TestIssuerIndex(unittest.TestCase):
+
+    def test_match(self):
+        apple = Issuer('AAPL', ['Apple Inc.'], cusips=['037833100'])
+        index = IssuerIndex([TESLA, apple])
+        self.assertIs(TESLA, index.match("TESLA, INC."))
+        self.assertIs(TESLA, index.match("Tesla Motors", isin="us88160r1014"))
+        self.assertIs(apple, index.match("APPLE COMPUTER", cusip="037833100"))
+        self.assertIsNone(index.match("TESLA ENERGY OPERATIONS", cusip="000000000"))
+
+    def test_match_vote(self):
+        self.assertTrue(TESLA.match_vote("Approve Stock Option Grant to Elon Musk"))
+        self.assertFalse(TESLA.match_vote("Elect Director Kimbal Musk"))
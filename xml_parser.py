@@ -1,9 +1,37 @@
+import argparse
+import contextlib
+import csv
+import importlib.util
 import io
 import os
 import re
+import sqlite3
+import sys
+import time
+import tracemalloc
+import unittest
+from multiprocessing import Pool
+from typing import Iterator, TextIO
 from xml.etree import ElementTree
 import traceback
 
+from lxml import etree
+
+import filing_store
+from sgml import Submission
+from watchlist import DEFAULT_WATCHLIST, Issuer, IssuerIndex, load_watchlist
+
+# Same database as the other stages
+year = 2018
+
+# XML namespace
+NS = {'inf': 'http://www.sec.gov/edgar/document/npxproxy/informationtable'}
+INF = '{http://www.sec.gov/edgar/document/npxproxy/informationtable}'
+# Elements identifying the security of a proxyTable, in the order of the arguments of IssuerIndex.match
+IDENTIFIER_TAGS = [INF + 'issuerName', INF + 'cusip', INF + 'isin']
+# Elements reported by the incremental parsing: the vote records make up most of a table
+STREAMING_TAGS = [INF + 'proxyTable', *IDENTIFIER_TAGS, INF + 'vote', INF + 'voteRecord']
+
 
 class Series:
 
@@ -28,21 +56,44 @@ class Series:
         return self.name == other.original_name
 
 
-def match_security(text: str) -> bool:
-    # Case-insensitive, ignore non-alphanum
-    text = text.upper()
-    text = re.sub(r'[^A-Z0-9]', '', text)
-    return text == "TESLAINC"
-
-def match_vote(text: str) -> bool:
+class VoteRecord:
     """
-    Return True if the vote is relevant, based on its description.
-    We exclude irrelevant votes rather than attempting to match all relevant votes
-    since there are many different formulations of the proposal.
+    A vote on a relevant proposal, as cast by one series (fund).
     """
-    return not re.search(
-        r'stockholder proposal|shareholder proposal|s/h proposal|appointment|james murdoch|kimbal musk|non.*binding|delaware|metrics|director|harassment|electromagnetic|collective|non-interference|simple majority|sustainability|moratorium|miscellaneous|auditor',
-        text, re.IGNORECASE)
+
+    COLUMNS = ['filename', 'issuer', 'series_id', 'series_name', 'ticker_symbols', 'meeting_date',
+               'shares_voted', 'shares_for', 'shares_against', 'vote', 'description']
+
+    def __init__(self, filename: str, issuer: str, series_id: str, series_name: str | None, ticker_symbols: str | None,
+                 meeting_date: str, shares_voted: float, shares_for: float, shares_against: float,
+                 vote: str, description: str):
+        self.filename = filename
+        self.issuer = issuer
+        self.series_id = series_id
+        self.series_name = series_name
+        self.ticker_symbols = ticker_symbols
+        self.meeting_date = meeting_date
+        self.shares_voted = shares_voted
+        self.shares_for = shares_for
+        self.shares_against = shares_against
+        self.vote = vote
+        self.description = description
+
+    def to_row(self) -> tuple:
+        return (self.filename, self.issuer, self.series_id, self.series_name, self.ticker_symbols, self.meeting_date,
+                self.shares_voted, self.shares_for, self.shares_against, self.vote, self.description)
+
+    def to_dict(self):
+        return dict(zip(self.COLUMNS, self.to_row()))
+
+    def __eq__(self, other):
+        return self.to_row() == other.to_row()
+
+    def __repr__(self):
+        return f"VoteRecord{self.to_row()}"
+
+
+DEFAULT_INDEX = IssuerIndex(DEFAULT_WATCHLIST)
 
 
 def extract_text(element: ElementTree.Element) -> str:
@@ -61,84 +112,147 @@ def extract_number(element: ElementTree.Element) -> float | None:
     return float(text.replace(',', ''))
 
 
-def parse_proxy_vote_table(filename: str, root: ElementTree.Element, series_by_id: dict[str, Series]):
-    # XML namespace
-    ns = {'inf': 'http://www.sec.gov/edgar/document/npxproxy/informationtable'}
+def parse_proxy_vote_table(filename: str, root: ElementTree.Element, series_by_id: dict[str, Series],
+                           index: IssuerIndex = DEFAULT_INDEX) -> list[VoteRecord]:
+    ns = NS
+    votes = []
 
     # Each vote is held in a proxyTable element
     for proxy_table in root.findall('inf:proxyTable', ns):
-        # The issuerName element contains the security name
-        issuer_name = proxy_table.find('inf:issuerName', ns)
-        if issuer_name is None or not match_security(issuer_name.text):
+        # The issuerName, cusip and isin elements identify the security
+        issuer = index.match(proxy_table.findtext('inf:issuerName', namespaces=ns),
+                             proxy_table.findtext('inf:cusip', namespaces=ns),
+                             proxy_table.findtext('inf:isin', namespaces=ns))
+        if issuer is None:
             continue
 
-        # The vote element contains the vote records
-        vote = proxy_table.find('inf:vote', ns)
-        if not vote:
-            continue
-        vote_records = vote.findall('inf:voteRecord', ns)
-        if not vote_records:
-            continue
+        vote = parse_proxy_table(filename, proxy_table, series_by_id, issuer)
+        if vote is not None:
+            votes.append(vote)
+    return votes
 
-        # Exclude votes from 2023-05-16
-        meeting_date = proxy_table.find('inf:meetingDate', ns)
-        if meeting_date.text == '05/16/2023':
-            continue
 
-        # Extract the number of shares voted, skip if 0
-        shares_voted = extract_number(proxy_table.find('inf:sharesVoted', ns))
-        if shares_voted is None or shares_voted == 0:
+def parse_proxy_vote_table_streaming(filename: str, events: Iterator[tuple[str, etree._Element]],
+                                     series_by_id: dict[str, Series], index: IssuerIndex = DEFAULT_INDEX) -> list[VoteRecord]:
+    """
+    Same as parse_proxy_vote_table, from the events of the incremental parsing of the document (see
+    STREAMING_TAGS). The issuerName, cusip and isin elements come before the vote in a proxyTable: the issuer is
+    checked when the vote starts, and the vote records of a table of another issuer are cleared as they end, so
+    that they are not kept. Tables are discarded once parsed, so memory does not grow with the number of tables.
+    """
+    votes = []
+    proxy_table = None
+    for event, element in events:
+        tag = element.tag
+        if tag == INF + 'proxyTable':
+            if event == 'start':
+                proxy_table = element
+                identifiers = {}
+                issuer = None
+                checked = False
+                continue
+            if not checked:
+                issuer = index.match(*(identifiers.get(name) for name in IDENTIFIER_TAGS))
+            if issuer is not None:
+                vote = parse_proxy_table(filename, proxy_table, series_by_id, issuer)
+                if vote is not None:
+                    votes.append(vote)
+            # Drop the table, and any previous siblings
+            proxy_table.clear()
+            root = proxy_table.getparent()
+            while proxy_table.getprevious() is not None:
+                del root[0]
+            proxy_table = None
+        elif proxy_table is None:
             continue
-
-        # Initialize counters for FOR and AGAINST votes
-        shares_for = 0
-        shares_against = 0
-        for vote_record in vote_records:
-            how_voted = vote_record.find('inf:howVoted', ns)
-            shares_voted_record = extract_number(vote_record.find('inf:sharesVoted', ns))
-            if how_voted is not None and shares_voted_record is not None:
-                if how_voted.text == "FOR":
-                    shares_for += shares_voted_record
-                elif how_voted.text == "AGAINST":
-                    shares_against += shares_voted_record
-
-        # Determine the final vote decision
-        if shares_for > shares_against:
-            final_vote = "FOR"
+        elif event == 'start':
+            if tag == INF + 'vote' and not checked:
+                # The issuerName, cusip and isin elements identify the security
+                checked = True
+                issuer = index.match(*(identifiers.get(name) for name in IDENTIFIER_TAGS))
+        elif tag in IDENTIFIER_TAGS:
+            if element.getparent() is proxy_table:
+                identifiers[tag] = element.text or ''
+        elif checked and issuer is None:
+            # Vote record or vote of another issuer
+            element.clear()
+    return votes
+
+
+def parse_proxy_table(filename: str, proxy_table: ElementTree.Element, series_by_id: dict[str, Series],
+                      issuer: Issuer) -> VoteRecord | None:
+    """
+    :returns: the vote, or None if the vote is irrelevant or incomplete.
+    """
+    ns = NS
+
+    # The vote element contains the vote records
+    vote = proxy_table.find('inf:vote', ns)
+    if vote is None or len(vote) == 0:
+        return
+    vote_records = vote.findall('inf:voteRecord', ns)
+    if not vote_records:
+        return
+
+    # Exclude votes from irrelevant meetings
+    meeting_date = proxy_table.find('inf:meetingDate', ns)
+    if meeting_date.text in issuer.exclude_meeting_dates:
+        return
+
+    # Extract the number of shares voted, skip if 0
+    shares_voted = extract_number(proxy_table.find('inf:sharesVoted', ns))
+    if shares_voted is None or shares_voted == 0:
+        return
+
+    # Initialize counters for FOR and AGAINST votes
+    shares_for = 0
+    shares_against = 0
+    for vote_record in vote_records:
+        how_voted = vote_record.find('inf:howVoted', ns)
+        shares_voted_record = extract_number(vote_record.find('inf:sharesVoted', ns))
+        if how_voted is not None and shares_voted_record is not None:
+            if how_voted.text == "FOR":
+                shares_for += shares_voted_record
+            elif how_voted.text == "AGAINST":
+                shares_against += shares_voted_record
+
+    # Determine the final vote decision
+    if shares_for > shares_against:
+        final_vote = "FOR"
+    else:
+        final_vote = "AGAINST"
+
+    # Build the vote description, collecting information for all the places that may contain it.
+    vote_description = extract_text(proxy_table.find('inf:voteDescription', ns))
+    vote_other_info = extract_text(proxy_table.find('inf:voteOtherInfo', ns))
+    vote_categories = []
+    for category in proxy_table.findall('inf:voteCategory', ns):
+        vote_categories.append(extract_text(category))
+    # Filter out unwanted votes
+    all_text = " ".join([vote_description, vote_other_info] + vote_categories)
+    if not issuer.match_vote(all_text):
+        return
+
+    # Vote series is a key corresponding to the fund.
+    # TODO: look up in the filing's edgarSubmission section.
+    fund_name = None
+    ticker_symbols = None
+    vote_series = proxy_table.find('inf:voteSeries', ns)
+    if vote_series is not None:
+        fund = series_by_id.get(vote_series.text)
+        if fund is None:
+            fund_name = vote_series.text
         else:
-            final_vote = "AGAINST"
-
-        # Build the vote description, collecting information for all the places that may contain it.
-        vote_description = extract_text(proxy_table.find('inf:voteDescription', ns))
-        vote_other_info = extract_text(proxy_table.find('inf:voteOtherInfo', ns))
-        vote_categories = []
-        for category in proxy_table.findall('inf:voteCategory', ns):
-            vote_categories.append(extract_text(category))
-        # Filter out unwanted votes
-        all_text = " ".join([vote_description, vote_other_info] + vote_categories)
-        if not match_vote(all_text):
-            continue
+            fund_name = fund.name
+            ticker_symbols = " ".join(fund.ticker_symbols)
 
-        # Vote series is a key corresponding to the fund.
-        # TODO: look up in the filing's edgarSubmission section.
-        fund_name = None
-        ticker_symbols = None
-        vote_series = proxy_table.find('inf:voteSeries', ns)
-        if vote_series is not None:
-            fund = series_by_id.get(vote_series.text)
-            if fund is None:
-                fund_name = vote_series.text
-            else:
-                fund_name = fund.name
-                ticker_symbols = " ".join(fund.ticker_symbols)
-
-        # Ensure all elements are found before printing
-        if vote_series is None or meeting_date is None or vote_description is None:
-            # TODO: warn that some information is missing, we may want to investigate
-            continue
+    # Ensure all elements are found before returning the vote
+    if vote_series is None or meeting_date is None or vote_description is None:
+        # TODO: warn that some information is missing, we may want to investigate
+        return None
 
-        # TODO: proper CSV formatting
-        print(f'{filename};"{fund_name}";"{ticker_symbols}";{meeting_date.text};{shares_voted};{final_vote};"{all_text}"')
+    return VoteRecord(filename, issuer.key, vote_series.text, fund_name, ticker_symbols, meeting_date.text,
+                      shares_voted, shares_for, shares_against, final_vote, all_text)
 
 
 def extract_series(header: str) -> list[Series]:
@@ -170,68 +284,398 @@ def extract_series(header: str) -> list[Series]:
     return series
 
 
-def process_filing(filename: str, file_path: str):
-
-    # Read the file
-    with open(file_path, 'r') as file:
-        content = file.read()
-
-    # Scan the file for <XML> and </XML> delimiters
-    lines = content.split('\n')
-    xml_ranges = []
-    xml_start = None
-    sec_header_end = None
-    for i, line in enumerate(lines):
-        if xml_start is None and line == '<XML>':
-            xml_start = i
-        elif xml_start is not None and line == '</XML>':
-            xml_ranges.append((xml_start, i))
-            xml_start = None
-        elif line == '</SEC-HEADER>':
-            sec_header_end = i
-
-    if sec_header_end is None:
+def process_filing(filename: str, file_path: str, streaming: bool = True,
+                   index: IssuerIndex = DEFAULT_INDEX) -> list[VoteRecord]:
+    votes = []
+
+    # Walk the sections of the file, decoding them one at a time.
+    # The header comes first, then the <XML> sections.
+    with Submission(file_path) as submission:
+        series_by_id = None
+        for section in submission.sections():
+            if section.tag == 'SEC-HEADER':
+                # Extract the header
+                series = extract_series(submission.text(section))
+
+                # Index series by id
+                series_by_id = {fund.id: fund for fund in series}
+            elif section.tag == 'XML':
+                if series_by_id is None:
+                    raise ValueError("SEC-HEADER not found")
+                if streaming:
+                    votes += parse_xml_section_streaming(filename, submission.read(section.start, section.end),
+                                                         series_by_id, index)
+                else:
+                    votes += parse_xml_section(filename, submission.text(section), series_by_id, index)
+
+    if series_by_id is None:
         raise ValueError("SEC-HEADER not found")
+    return votes
+
+
+def parse_xml_section(filename: str, source: str, series_by_id: dict[str, Series],
+                      index: IssuerIndex = DEFAULT_INDEX) -> list[VoteRecord]:
+
+    # Fix a bad entity
+    source = re.sub(r'&#2;', ' ', source)
+
+    # Parse XML and dispatch based on root element
+    tree = ElementTree.parse(io.StringIO(source))
+    root = tree.getroot()
+    if root.tag == '{http://www.sec.gov/edgar/npx}edgarSubmission':
+        # TODO: parse_edgar_submission(root) to extract metadata
+        pass
+    elif root.tag == '{http://www.sec.gov/edgar/document/npxproxy/informationtable}proxyVoteTable':
+        return parse_proxy_vote_table(filename, root, series_by_id, index)
+    else:
+        print(f"warning: unknown element {root.tag}", file=sys.stderr)
+    return []
+
+
+def parse_xml_section_streaming(filename: str, source: bytes, series_by_id: dict[str, Series],
+                                index: IssuerIndex = DEFAULT_INDEX) -> list[VoteRecord]:
+
+    # Fix a bad entity
+    source = source.replace(b'&#2;', b' ')
+
+    # Peek at the root element to dispatch, only the vote tables are large
+    _, root = next(etree.iterparse(io.BytesIO(source), events=('start',), huge_tree=True))
+    if root.tag == '{http://www.sec.gov/edgar/npx}edgarSubmission':
+        # TODO: parse_edgar_submission(root) to extract metadata
+        pass
+    elif root.tag == INF + 'proxyVoteTable':
+        events = etree.iterparse(io.BytesIO(source), events=('start', 'end'), tag=STREAMING_TAGS, huge_tree=True)
+        return parse_proxy_vote_table_streaming(filename, events, series_by_id, index)
+    else:
+        print(f"warning: unknown element {root.tag}", file=sys.stderr)
+    return []
+
+
+def synthetic_proxy_vote_table(num_tables: int, match_every: int = 1000) -> bytes:
+    """ Build a proxyVoteTable document, with a Tesla vote every `match_every` tables. """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<proxyVoteTable xmlns="http://www.sec.gov/edgar/document/npxproxy/informationtable">\n']
+    for i in range(num_tables):
+        issuer = "TESLA, INC." if i % match_every == 0 else f"ISSUER {i} CORP"
+        parts.append(
+            f"<proxyTable><issuerName>{issuer}</issuerName><cusip>000000000</cusip>"
+            f"<meetingDate>06/13/2023</meetingDate><voteDescription>Approve plan {i}</voteDescription>"
+            f"<sharesVoted>1,000</sharesVoted><sharesOnLoan>0</sharesOnLoan>"
+            f"<vote><voteRecord><howVoted>FOR</howVoted><sharesVoted>600</sharesVoted>"
+            f"<managementRecommendation>FOR</managementRecommendation></voteRecord>"
+            f"<voteRecord><howVoted>AGAINST</howVoted><sharesVoted>400</sharesVoted>"
+            f"<managementRecommendation>FOR</managementRecommendation></voteRecord></vote>"
+            f"<voteSeries>S000000001</voteSeries></proxyTable>\n")
+    parts.append('</proxyVoteTable>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def benchmark(num_tables: int):
+    source = synthetic_proxy_vote_table(num_tables)
+    series_by_id = {'S000000001': Series('S000000001', 'Some Fund', ['SFND'])}
+    print(f"{num_tables} proxy tables, {len(source) / 1e6:.1f} MB")
+    outputs = []
+    for name, parse in [('tree', lambda: parse_xml_section('bench', source.decode('utf-8'), series_by_id)),
+                        ('streaming', lambda: parse_xml_section_streaming('bench', source, series_by_id))]:
+        start_time = time.perf_counter()
+        outputs.append(parse())
+        elapsed = time.perf_counter() - start_time
+        # Measure memory in a separate run, tracing slows down parsing
+        tracemalloc.start()
+        parse()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Only Python allocations are traced, not the C allocations made by lxml
+        print(f"{name:>10}: {elapsed:.2f}s, peak Python memory {peak / 1e6:.1f} MB")
+    print("Outputs are identical" if outputs[0] == outputs[1] else "Warning: outputs differ")
+
+
+class VoteSink:
+    """
+    Bulk writer for vote records, in the order they are given: CSV, the proxy_votes table, and optionally Parquet.
+    All database writes happen in a single transaction, committed by close().
+    """
 
-    # Extract the header
-    header = "\n".join(lines[:sec_header_end])
-    series = extract_series(header)
-
-    # Index series by id
-    series_by_id = {fund.id: fund for fund in series}
+    BATCH_SIZE = 10000
+
+    def __init__(self, csv_file: TextIO | None = None, conn: sqlite3.Connection | None = None,
+                 parquet_path: str | None = None):
+        self.csv_writer = None
+        if csv_file is not None:
+            self.csv_writer = csv.writer(csv_file)
+            self.csv_writer.writerow(VoteRecord.COLUMNS)
+        self.conn = conn
+        if conn is not None:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS proxy_votes (
+                filename TEXT,
+                issuer TEXT,
+                series_id TEXT,
+                series_name TEXT,
+                ticker_symbols TEXT,
+                meeting_date TEXT,
+                shares_voted REAL,
+                shares_for REAL,
+                shares_against REAL,
+                vote TEXT,
+                description TEXT
+            );
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS proxy_votes_filename ON proxy_votes (filename)")
+            conn.commit()
+        self.parquet_writer = None
+        if parquet_path is not None:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise RuntimeError("Parquet output requires pyarrow (pip install pyarrow)")
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([
+                (column, pyarrow.float64() if column.startswith('shares_') else pyarrow.string())
+                for column in VoteRecord.COLUMNS])
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(parquet_path, self.schema)
+        self.rows = []
+
+    def clear(self, filename: str):
+        """ Remove the votes previously recorded for a filing, without flushing the pending batch. """
+        self.rows = [row for row in self.rows if row[0] != filename]
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM proxy_votes WHERE filename = ?", (filename,))
+
+    def write(self, records: list[VoteRecord]):
+        self.rows.extend(record.to_row() for record in records)
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.csv_writer is not None:
+            self.csv_writer.writerows(self.rows)
+        if self.conn is not None:
+            self.conn.executemany("""
+                INSERT INTO proxy_votes (
+                    filename, issuer, series_id, series_name, ticker_symbols, meeting_date,
+                    shares_voted, shares_for, shares_against, vote, description
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, self.rows)
+        if self.parquet_writer is not None:
+            columns = list(zip(*self.rows))
+            self.parquet_writer.write_table(self.pyarrow.Table.from_arrays(
+                [self.pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.commit()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+# Issuer index of a worker process, sent once when the process starts rather than with each filing
+worker_index = DEFAULT_INDEX
+
+
+def init_worker(index: IssuerIndex):
+    global worker_index
+    worker_index = index
+
+
+def process_filing_isolated(args: tuple[str, bool]) -> tuple[str, list[VoteRecord], str | None, float]:
+    """
+    Worker entry point: process a filing, catching any error so that it does not stop the other filings.
+    Issuers are matched with the index given to init_worker.
 
-    # Parse the XML sections
-    for start, end in xml_ranges:
+    :returns: the filename, the vote records, the formatted error if any, and the processing time.
+    """
+    filename, streaming = args
+    start_time = time.perf_counter()
+    try:
+        votes = process_filing(filename, os.path.join('filings', filename), streaming, worker_index)
+        return filename, votes, None, time.perf_counter() - start_time
+    except Exception:
+        return filename, [], traceback.format_exc(), time.perf_counter() - start_time
 
-        xml_start = start + 1  # Skip <XML> line
-        source = "\n".join(lines[xml_start:end])
 
-        # Fix a bad entity
-        source = re.sub(r'&#2;', ' ', source)
+def process_filings(filenames: list[str], sink: VoteSink, jobs: int, streaming: bool = True,
+                    index: IssuerIndex = DEFAULT_INDEX) -> list[str]:
+    """
+    Process filings on a pool of `jobs` processes, largest filings first so that they do not end up
+    running alone at the end. Results are written from this process, in scheduling order.
 
-        # Parse XML and dispatch based on root element
-        tree = ElementTree.parse(io.StringIO(source))
-        root = tree.getroot()
-        if root.tag == '{http://www.sec.gov/edgar/npx}edgarSubmission':
-            # TODO: parse_edgar_submission(root) to extract metadata
-            continue
-        elif root.tag == '{http://www.sec.gov/edgar/document/npxproxy/informationtable}proxyVoteTable':
-            parse_proxy_vote_table(filename, root, series_by_id)
-        else:
-            print(f"warning: unknown element {root.tag}")
+    :returns: the names of the filings that could not be processed.
+    """
+    filenames = sorted(filenames, key=lambda name: filing_store.size(os.path.join('filings', name)), reverse=True)
+    failed = []
+    start_time = time.perf_counter()
+    with Pool(jobs, initializer=init_worker, initargs=(index,)) as pool:
+        for filename, votes, error, elapsed in pool.imap(process_filing_isolated,
+                                                         [(filename, streaming) for filename in filenames]):
+            if error is not None:
+                print(f"Error processing {filename}:\n{error}", file=sys.stderr)
+                failed.append(filename)
+                continue
+            sink.clear(filename)
+            sink.write(votes)
+            print(f"{filename}: {len(votes)} votes in {elapsed:.2f}s", file=sys.stderr)
+    sink.close()
+    print(f"Processed {len(filenames)} filings in {time.perf_counter() - start_time:.2f}s, "
+          f"{len(failed)} failed", file=sys.stderr)
+    return failed
+
+
+class TestXmlParser(unittest.TestCase):
+
+    def test_streaming_matches_tree(self):
+        source = synthetic_proxy_vote_table(50, match_every=20)
+        series_by_id = {'S000000001': Series('S000000001', 'Some Fund', ['SFND'])}
+        rows = parse_xml_section('test', source.decode('utf-8'), series_by_id)
+        self.assertEqual(3, len(rows))
+        self.assertEqual(VoteRecord('test', 'TSLA', 'S000000001', 'Some Fund', 'SFND', '06/13/2023',
+                                    1000.0, 600.0, 400.0, 'FOR', 'Approve plan 20 '), rows[1])
+        self.assertEqual(rows, parse_xml_section_streaming('test', source, series_by_id))
+
+    def test_streaming_skips_tables(self):
+        source = synthetic_proxy_vote_table(50, match_every=20)
+        series_by_id = {'S000000001': Series('S000000001', 'Some Fund', ['SFND'])}
+        vote_records = []
+
+        def record_events(events):
+            for event, element in events:
+                if event == 'end' and element.tag == INF + 'voteRecord':
+                    vote_records.append(element)
+                yield event, element
+
+        events = etree.iterparse(io.BytesIO(source), events=('start', 'end'), tag=STREAMING_TAGS)
+        self.assertEqual(3, len(parse_proxy_vote_table_streaming('test', record_events(events), series_by_id)))
+        # Only the votes of the Tesla tables are kept until their table ends
+        self.assertEqual(100, len(vote_records))
+        self.assertEqual(6, sum(1 for element in vote_records if len(element)))
+        # Same root element in another namespace
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.assertEqual([], parse_xml_section_streaming('test', source.replace(
+                b'npxproxy/informationtable', b'npxproxy/other'), series_by_id))
+        self.assertIn("unknown element {http://www.sec.gov/edgar/document/npxproxy/other}proxyVoteTable",
+                      stderr.getvalue())
+
+    def test_watchlist(self):
+        source = synthetic_proxy_vote_table(50, match_every=20).replace(
+            b"<issuerName>ISSUER 7 CORP</issuerName><cusip>000000000</cusip>",
+            b"<issuerName>APPLE INC</issuerName><cusip>037833100</cusip>")
+        series_by_id = {'S000000001': Series('S000000001', 'Some Fund', ['SFND'])}
+        index = IssuerIndex([Issuer('TSLA', ['Tesla Inc']), Issuer('AAPL', ['Apple Computer'], cusips=['037833100'])])
+        votes = parse_xml_section_streaming('test', source, series_by_id, index)
+        self.assertEqual(['TSLA', 'AAPL', 'TSLA', 'TSLA'], [vote.issuer for vote in votes])
+        self.assertEqual(votes, parse_xml_section('test', source.decode('utf-8'), series_by_id, index))
+
+    @unittest.skipIf(importlib.util.find_spec('pyarrow') is None, "pyarrow is not installed")
+    def test_vote_sink(self):
+        import tempfile
+        vote = VoteRecord('test', 'TSLA', 'S1', 'Some Fund', None, '06/13/2023', 10.0, 6.0, 4.0, 'FOR', 'Approve plan')
+        conn = sqlite3.connect(':memory:')
+        with tempfile.TemporaryDirectory() as tmp:
+            parquet_path = os.path.join(tmp, 'votes.parquet')
+            sink = VoteSink(None, conn, parquet_path)
+            sink.write([vote] * 25000)
+            sink.close()
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(parquet_path)
+            self.assertEqual(25000, table.num_rows)
+            self.assertEqual(vote.to_dict(), table.slice(0, 1).to_pylist()[0])
+        self.assertEqual((25000, 150000.0), conn.execute("SELECT COUNT(*), SUM(shares_for) FROM proxy_votes").fetchone())
+
+    def test_vote_sink_clear(self):
+        vote = VoteRecord('a.txt', 'TSLA', 'S1', 'Some Fund', None, '06/13/2023', 10.0, 6.0, 4.0, 'FOR', 'Approve')
+        conn = sqlite3.connect(':memory:')
+        sink = VoteSink(None, conn)
+        sink.write([vote] * 3)
+        sink.flush()
+        sink.write([VoteRecord('b.txt', *vote.to_row()[1:])] * 2)
+        sink.clear('a.txt')
+        self.assertEqual(2, len(sink.rows))  # The pending batch is not flushed
+        sink.write([vote] * 4)
+        sink.close()
+        self.assertEqual([('a.txt', 4), ('b.txt', 2)], conn.execute(
+            "SELECT filename, COUNT(*) FROM proxy_votes GROUP BY filename ORDER BY filename").fetchall())
+
+    def test_process_filings(self):
+        import tempfile
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                os.makedirs('filings')
+                header = ("<SEC-HEADER>\n<SERIES>\n<SERIES-ID>S000000001\n<SERIES-NAME>Some Fund\n</SERIES>\n"
+                          "</SEC-HEADER>\n<DOCUMENT>\n<TEXT>\n<XML>\n")
+                for name, num_tables in [('a.txt', 30), ('b.txt', 3)]:
+                    with open(os.path.join('filings', name), 'wb') as f:
+                        f.write(header.encode() + synthetic_proxy_vote_table(num_tables, 10) + b"</XML>\n</TEXT>\n")
+                with open(os.path.join('filings', 'broken.txt'), 'w') as f:
+                    f.write("<DOCUMENT>\n<TEXT>\n<XML>\n<proxyVoteTable>\n</XML>\n</TEXT>\n")
+                conn = sqlite3.connect(':memory:')
+                csv_file = io.StringIO()
+                failed = process_filings(['b.txt', 'broken.txt', 'a.txt'], VoteSink(csv_file, conn), 2)
+                self.assertEqual(['broken.txt'], failed)
+                self.assertEqual([('a.txt',), ('a.txt',), ('a.txt',), ('b.txt',)],
+                                 conn.execute("SELECT filename FROM proxy_votes").fetchall())
+                self.assertEqual(5, len(csv_file.getvalue().splitlines()))
+                # Watchlist given to the workers
+                index = IssuerIndex([Issuer('ISS5', ['Issuer 5 Corp'])])
+                sink = VoteSink(None, conn)
+                self.assertEqual([], process_filings(['a.txt', 'b.txt'], sink, 2, index=index))
+                self.assertEqual([('a.txt', 'ISS5')], conn.execute(
+                    "SELECT filename, issuer FROM proxy_votes WHERE issuer != 'TSLA'").fetchall())
+            finally:
+                os.chdir(cwd)
 
 
 def main():
-    for filename in os.listdir('filings'):
-        if filename.endswith('.txt'):
-            try:
-                process_filing(filename, os.path.join('filings', filename))
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-                traceback.print_exception(None, e, e.__traceback__)
+    parser = argparse.ArgumentParser(
+        prog='xml_parser',
+        description='Extract votes from structured (XML) N-PX filings')
+    parser.add_argument('--tree', action='store_true',
+                        help='parse each XML section as a whole instead of incrementally')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of filings processed in parallel')
+    parser.add_argument('-o', '--output', type=str, default='-',
+                        help='CSV output file, - for standard output')
+    parser.add_argument('-w', '--watchlist', type=str, metavar='PATH',
+                        help='JSON file listing the issuers to extract (default: Tesla)')
+    parser.add_argument('--parquet', type=str, metavar='PATH',
+                        help='also write the votes to a Parquet file (requires pyarrow)')
+    parser.add_argument('--no-db', action='store_true',
+                        help='do not write votes into the proxy_votes table')
+    parser.add_argument('-b', '--bench', type=int, metavar='NUM_TABLES', nargs='?', const=200000,
+                        help='compare the tree and streaming parsers on a synthetic filing')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('filings', metavar='FILING', type=str, nargs='*',
+                        help='names of the filings to process (no path, with ext)')
+    args = parser.parse_args()
+
+    if args.test:
+        sys.argv = sys.argv[:1]  # unittest.main() will not recognize the --test argument
+        unittest.main()
+        exit(0)
+
+    if args.bench:
+        benchmark(args.bench)
+        exit(0)
+
+    index = IssuerIndex(load_watchlist(args.watchlist) if args.watchlist else DEFAULT_WATCHLIST)
+    conn = None
+    if not args.no_db:
+        conn = sqlite3.connect(os.environ.get('SQLITE_PATH', f'{year}.sqlite'))
+    filenames = args.filings or [name for name in filing_store.listdir('filings') if name.endswith('.txt')]
+    with contextlib.ExitStack() as stack:
+        csv_file = sys.stdout if args.output == '-' else stack.enter_context(
+            open(args.output, 'w', encoding='utf-8', newline=''))
+        sink = VoteSink(csv_file, conn, args.parquet)
+        failed = process_filings(filenames, sink, args.jobs, streaming=not args.tree, index=index)
+    exit(1 if failed else 0)
 
 
 if __name__ == '__main__':
     main()
-
-